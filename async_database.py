@@ -0,0 +1,109 @@
+# async_database.py — non-blocking face of database.py for the event loop
+#
+# Same function names as database.py, but every call is awaited:
+# writes go to one dedicated writer thread (SQLite allows a single
+# writer anyway, so this also removes "database is locked" retries),
+# reads go to a small reader pool. Each thread keeps its own pooled
+# connection from database._connect(), and WAL lets readers run while
+# a write is in flight. Every call is timed in its thread
+# (metrics.db_seconds, labelled by function name).
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from time import perf_counter
+
+import database
+from metrics import db_seconds
+
+READER_THREADS = 4
+
+_writer_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+_reader_pool = ThreadPoolExecutor(max_workers=READER_THREADS, thread_name_prefix="db-reader")
+
+
+# ---------------------------------------------------------
+# GENERIC RUNNERS
+# ---------------------------------------------------------
+
+async def run_read(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_reader_pool, partial(_timed, fn, args, kwargs))
+
+
+async def run_write(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_writer_pool, partial(_timed, fn, args, kwargs))
+
+
+def _timed(fn, args, kwargs):
+    start = perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        db_seconds.labels(getattr(fn, "__name__", "other")).observe(perf_counter() - start)
+
+
+def _read(fn):
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run_read(fn, *args, **kwargs)
+    return wrapper
+
+
+def _write(fn):
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run_write(fn, *args, **kwargs)
+    return wrapper
+
+
+def shutdown():
+    """
+    Drains pending writes, then closes every pooled connection.
+    """
+    _writer_pool.shutdown(wait=True)
+    _reader_pool.shutdown(wait=True)
+    database.close_db()
+
+
+# ---------------------------------------------------------
+# DATABASE API
+# ---------------------------------------------------------
+
+init_db = _write(database.init_db)
+
+create_user = _write(database.create_user)
+save_last_active = _write(database.save_last_active)
+get_last_active = _read(database.get_last_active)
+get_last_active_many = _read(database.get_last_active_many)
+update_user_state = _write(database.update_user_state)
+get_user_state = _read(database.get_user_state)
+get_session = _read(database.get_session)
+load_sessions = _read(database.load_sessions)
+
+set_partner = _write(database.set_partner)
+clear_partner = _write(database.clear_partner)
+get_partner = _read(database.get_partner)
+pair_users = _write(database.pair_users)
+link_pairs = _write(database.link_pairs)
+unpair = _write(database.unpair)
+rematch = _write(database.rematch)
+
+update_gender = _write(database.update_gender)
+update_region = _write(database.update_region)
+get_user_gender = _read(database.get_user_gender)
+update_wanted_gender = _write(database.update_wanted_gender)
+update_wanted_region = _write(database.update_wanted_region)
+get_match_profile = _read(database.get_match_profile)
+
+add_to_queue = _write(database.add_to_queue)
+remove_from_queue = _write(database.remove_from_queue)
+get_queue = _read(database.get_queue)
+load_queue = _read(database.load_queue)
+save_queue_snapshot = _write(database.save_queue_snapshot)
+sweep_queue = _read(database.sweep_queue)
+
+log_events = _write(database.log_events)
+record_sessions = _write(database.record_sessions)
+hourly_session_stats = _read(database.hourly_session_stats)
@@ -0,0 +1,989 @@
+# bench.py — micro-benchmarks for ChatRoulette internals
+#
+# Usage:
+#   python bench.py            (all)
+#   python bench.py db batch cleaner commits prefs
+#   python bench.py updates    (exits 1 if a user's updates run out of order)
+#   python bench.py metrics    (exits 1 if a relay-path observation costs >= 1 µs)
+#   python bench.py events     (action log: buffered batches vs a commit per action)
+#   python bench.py coord      (exits 1 if a coordination backend misbehaves;
+#                               the Redis one runs on fakeredis if installed)
+#   python bench.py sessions   (exits 1 if the hourly rollups disagree with
+#                               the raw sessions table)
+#   python bench.py recent     (repeat partners after /next, with and without
+#                               the recent-partner ring)
+#   python bench.py ledger     (exits 1 if racing debits overdraw, a payment
+#                               applies twice or an audit misses a mismatch)
+#   python bench.py disconnect (exits 1 if /stop racing a matcher tick leaves
+#                               the session cache disagreeing with the DB)
+#   python bench.py wakeup     (exits 1 if bot.match_loop never re-pairs two
+#                               ex-partners left alone in the queue)
+#
+# Every benchmark runs against a throwaway database in a temp dir,
+# never against chatroulette.db.
+#
+# Correctness tests live in tests/:
+#   python -m pytest tests
+
+import asyncio
+import os
+import random
+import sys
+import sqlite3
+import tempfile
+import threading
+from bisect import bisect_left
+from collections import deque
+from types import SimpleNamespace
+from time import perf_counter, time
+
+_TMP = tempfile.mkdtemp(prefix="chatroulette-bench-")
+os.environ["DB_PATH"] = os.path.join(_TMP, "bench.db")
+
+import database  # noqa: E402  (DB_PATH must be set first)
+from match_queue import MatchQueue, Profile  # noqa: E402
+
+
+def _report(name, ops, seconds):
+    print(f"{name:<28} {ops:>8} ops  {seconds:8.3f}s  {ops / seconds:>12,.0f} ops/sec")
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def _fresh_db(users, genders=("male", "female", None)):
+    database.close_db()
+    for suffix in ("", "-wal", "-shm"):
+        path = database.DB_PATH + suffix
+        if os.path.exists(path):
+            os.remove(path)
+    database.init_db()
+    conn = database._connect()
+    conn.executemany(
+        "INSERT INTO users (id, gender, state, last_active) VALUES (?, ?, 'searching', ?)",
+        [(u, random.choice(genders), int(time())) for u in range(users)]
+    )
+    conn.commit()
+
+
+# ---------------------------------------------------------
+# DB: pooled connections vs open-per-call
+# ---------------------------------------------------------
+
+def _legacy_call(path, sql, args=(), write=True):
+    # What every database.py function did before the pool.
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    cur.execute(sql, args)
+    row = cur.fetchone()
+    if write:
+        conn.commit()
+    conn.close()
+    return row
+
+
+def _legacy_search_cycle(path, user_id):
+    now = int(time())
+    _legacy_call(path, "UPDATE users SET last_active=? WHERE id=?", (now, user_id))
+    _legacy_call(path, "DELETE FROM queue WHERE user_id=?", (user_id,))
+    _legacy_call(path, "UPDATE users SET partner_id=? WHERE id=?", (None, user_id))
+    _legacy_call(path, "UPDATE users SET state=?, last_active=? WHERE id=?", ("searching", now, user_id))
+    _legacy_call(
+        path,
+        "INSERT OR REPLACE INTO queue (user_id, priority, timestamp) VALUES (?, ?, ?)",
+        (user_id, 0, now),
+    )
+    _legacy_call(path, "SELECT state FROM users WHERE id=?", (user_id,), write=False)
+
+
+def _pooled_search_cycle(user_id):
+    # last_active is no longer written here (presence.py batches it)
+    database.remove_from_queue(user_id)
+    database.clear_partner(user_id)
+    database.update_user_state(user_id, "searching")
+    database.add_to_queue(user_id)
+    database.get_user_state(user_id)
+
+
+def bench_db(users=300, rounds=5):
+    """
+    One "round" = the /search path for every user; ops are searches
+    (6 statements each before, 5 now that presence.py batches last_active).
+    """
+    database.init_db()
+    for u in range(users):
+        database.create_user(u)
+
+    legacy_path = os.path.join(_TMP, "legacy.db")
+    conn = sqlite3.connect(legacy_path)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, state TEXT, partner_id INTEGER, last_active INTEGER)")
+    conn.execute("CREATE TABLE queue (user_id INTEGER PRIMARY KEY, priority INTEGER, timestamp INTEGER)")
+    conn.executemany("INSERT INTO users (id, state) VALUES (?, 'idle')", [(u,) for u in range(users)])
+    conn.commit()
+    conn.close()
+
+    ops = users * rounds
+
+    t = perf_counter()
+    for _ in range(rounds):
+        for u in range(users):
+            _legacy_search_cycle(legacy_path, u)
+    _report("open-per-call", ops, perf_counter() - t)
+
+    t = perf_counter()
+    for _ in range(rounds):
+        for u in range(users):
+            _pooled_search_cycle(u)
+    _report("pooled (WAL)", ops, perf_counter() - t)
+
+    database.close_db()
+
+
+# ---------------------------------------------------------
+# BATCH MATCHING
+# ---------------------------------------------------------
+
+ARRIVAL_WINDOW = 60     # simulated seconds over which the queue fills up
+TICK = 1                # seconds between matcher runs
+
+
+def _simulate_ticks(users, genders):
+    """
+    Users arrive uniformly over ARRIVAL_WINDOW; every TICK the matcher
+    drains the queue and commits the batch. Returns (pairs, busy seconds,
+    simulated waits).
+    """
+    arrivals = sorted((random.uniform(0, ARRIVAL_WINDOW), u) for u in range(users))
+    q = MatchQueue()
+    waits = []
+    arrived_at = {}
+    busy = 0.0
+    pairs_total = 0
+    i = 0
+    t = 0
+    while i < len(arrivals) or t <= ARRIVAL_WINDOW:
+        while i < len(arrivals) and arrivals[i][0] <= t:
+            at, u = arrivals[i]
+            q.push(u, Profile(genders[u], None, None, None), 0, at)
+            arrived_at[u] = at
+            i += 1
+
+        start = perf_counter()
+        pairs = q.pop_pairs()
+        if pairs:
+            database.link_pairs(pairs)
+        busy += perf_counter() - start
+
+        pairs_total += len(pairs)
+        for u1, u2 in pairs:
+            waits.append(t - arrived_at[u1])
+            waits.append(t - arrived_at[u2])
+        t += TICK
+    return pairs_total, busy, waits
+
+
+def _legacy_waits(users):
+    """
+    Old behaviour: at most one pair per tick (FIFO, gender ignored —
+    the best case for the old matcher).
+    """
+    arrivals = sorted(random.uniform(0, ARRIVAL_WINDOW) for _ in range(users))
+    waiting = deque()
+    waits = []
+    i = 0
+    t = 0
+    while i < len(arrivals) or len(waiting) >= 2:
+        while i < len(arrivals) and arrivals[i] <= t:
+            waiting.append(arrivals[i])
+            i += 1
+        if len(waiting) >= 2:
+            waits.append(t - waiting.popleft())
+            waits.append(t - waiting.popleft())
+        t += TICK
+    return waits
+
+
+def bench_batch(sizes=(1_000, 10_000, 100_000)):
+    for n in sizes:
+        _fresh_db(n)
+        genders = dict(database._connect().execute("SELECT id, gender FROM users"))
+
+        # one tick over a full queue
+        q = MatchQueue()
+        for u in range(n):
+            q.push(u, Profile(genders[u], None, None, None), random.choice((0, 0, 0, 5, 10)), u)
+        start = perf_counter()
+        pairs = q.pop_pairs()
+        database.link_pairs(pairs)
+        drain = perf_counter() - start
+
+        _fresh_db(n)
+        genders = dict(database._connect().execute("SELECT id, gender FROM users"))
+        matched, busy, waits = _simulate_ticks(n, genders)
+        legacy = _legacy_waits(n)
+
+        print(
+            f"n={n:>7}  drain: {len(pairs):>6} pairs in {drain * 1000:8.1f} ms "
+            f"({len(pairs) / drain:>10,.0f} matches/sec)  "
+            f"ticked: {matched / busy:>10,.0f} matches/sec  "
+            f"p99 wait {_percentile(waits, 99):5.1f}s "
+            f"(one pair/tick: {_percentile(legacy, 99):8.1f}s)"
+        )
+    database.close_db()
+
+
+# ---------------------------------------------------------
+# QUEUE CLEANER
+# ---------------------------------------------------------
+
+CLEANER_TIMEOUT = 30
+
+
+def _fill_queue_for_cleaner(n):
+    """
+    n queued users: ~10% inactive, ~5% already chatting,
+    ~5% with a partner link to someone not queued.
+    """
+    _fresh_db(0)
+    now = int(time())
+    users = []
+    for u in range(n):
+        roll = random.random()
+        last = now - 120 if roll < 0.10 else now
+        state = "chatting" if 0.10 <= roll < 0.15 else "searching"
+        partner = n + u if 0.15 <= roll < 0.20 else None
+        users.append((u, state, partner, last))
+
+    conn = database._connect()
+    conn.executemany(
+        "INSERT INTO users (id, state, partner_id, last_active) VALUES (?, ?, ?, ?)", users
+    )
+    conn.executemany(
+        "INSERT INTO queue (user_id, priority, timestamp) VALUES (?, 0, ?)",
+        [(u, now) for u in range(n)]
+    )
+    conn.commit()
+    return now
+
+
+def _legacy_clean(now):
+    # The pre-sweep cleaner: three lookups + one delete per queued user.
+    queue = database.get_queue()
+    removed = 0
+    for user_id in queue:
+        last = database.get_last_active(user_id)
+        if last and (now - last) > CLEANER_TIMEOUT:
+            database.remove_from_queue(user_id)
+            removed += 1
+            continue
+        state = database.get_user_state(user_id)
+        if state == "chatting":
+            database.remove_from_queue(user_id)
+            removed += 1
+            continue
+        partner = database.get_partner(user_id)
+        if partner and partner not in queue and state != "chatting":
+            database.remove_from_queue(user_id)
+            removed += 1
+    return removed
+
+
+def _arm_presence(presence, n):
+    # one inactivity timer per queued user, armed from their last_active
+    presence._watched.clear()
+    presence._timers.clear()
+    presence._seen.clear()
+    for user_id, last in database._connect().execute("SELECT id, last_active FROM users"):
+        presence.watch(user_id, CLEANER_TIMEOUT, since=last)
+
+
+def bench_cleaner(sizes=(10_000, 100_000), legacy_max=10_000):
+    import presence
+
+    for n in sizes:
+        now = _fill_queue_for_cleaner(n)
+        _arm_presence(presence, n)
+        start = perf_counter()
+        expired = presence.expired(now)
+        timers = perf_counter() - start
+
+        start = perf_counter()
+        stale = database.sweep_queue()
+        database.save_queue_snapshot([], expired + [u for u, _ in stale])
+        sweep = perf_counter() - start
+
+        line = (
+            f"n={n:>7}  timers: {len(expired):>6} inactive in {timers * 1000:6.1f} ms"
+            f"  sweep: {len(stale):>6} removed in {sweep * 1000:8.1f} ms"
+        )
+        if n <= legacy_max:
+            now = _fill_queue_for_cleaner(n)
+            start = perf_counter()
+            removed = _legacy_clean(now)
+            line += f"  per-user loop: {removed:>6} removed in {(perf_counter() - start) * 1000:8.1f} ms"
+        else:
+            line += "  per-user loop: skipped (O(n²) partner check)"
+        print(line)
+    database.close_db()
+
+
+# ---------------------------------------------------------
+# PREFERENCE MATCHING
+# ---------------------------------------------------------
+
+REGIONS = [f"region-{i}" for i in range(40)]
+
+
+def _random_profile():
+    # ~30% gender filter, ~20% region filter, everyone else takes anyone
+    gender = random.choice(("male", "female", None))
+    region = random.choice(REGIONS + [None])
+    want_gender = random.choice(("male", "female")) if random.random() < 0.3 else None
+    want_region = region if region and random.random() < 0.2 else None
+    return Profile(gender, region, want_gender, want_region)
+
+
+def bench_prefs(sizes=(1_000, 10_000, 50_000)):
+    """
+    Per-user matching cost must stay flat as the queue grows.
+    """
+    for n in sizes:
+        q = MatchQueue()
+        for u in range(n):
+            q.push(u, _random_profile(), random.choice((0, 0, 0, 5, 10)), u)
+
+        start = perf_counter()
+        pairs = q.pop_pairs()
+        seconds = perf_counter() - start
+        print(
+            f"n={n:>7}  {len(pairs):>6} pairs, {len(q):>5} left  "
+            f"{seconds * 1e6 / n:6.2f} µs per queued user"
+        )
+
+
+# ---------------------------------------------------------
+# COMMITS PER MATCH
+# ---------------------------------------------------------
+
+def _count_commits(fn, *args):
+    conn = database._connect()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        fn(*args)
+    finally:
+        conn.set_trace_callback(None)
+    return sum(1 for s in statements if s.strip().upper() == "COMMIT")
+
+
+def _legacy_match(pairs):
+    # The old matchmaker: re-read the queue, then six autocommitted writes.
+    for u1, u2 in pairs:
+        database.get_queue()
+        database.remove_from_queue(u1)
+        database.remove_from_queue(u2)
+        database.set_partner(u1, u2)
+        database.set_partner(u2, u1)
+        database.update_user_state(u1, "chatting")
+        database.update_user_state(u2, "chatting")
+
+
+def _atomic_match(pairs):
+    for u1, u2 in pairs:
+        database.pair_users(u1, u2)
+
+
+def bench_commits(matches=500):
+    _fresh_db(2 * matches)
+    pairs = [(2 * i, 2 * i + 1) for i in range(matches)]
+
+    for name, fn in (
+        ("one write per call", _legacy_match),
+        ("pair_users()", _atomic_match),
+        ("link_pairs() batch", database.link_pairs),
+    ):
+        database._connect().execute("UPDATE users SET state='searching', partner_id=NULL")
+        database._connect().commit()
+
+        start = perf_counter()
+        commits = _count_commits(fn, pairs)
+        seconds = perf_counter() - start
+        print(
+            f"{name:<22} {commits / matches:6.3f} commits/match  "
+            f"{matches / seconds:>10,.0f} matches/sec"
+        )
+    database.close_db()
+
+
+# ---------------------------------------------------------
+# ACTION LOG
+# ---------------------------------------------------------
+
+def _log_one_by_one(rows):
+    conn = database._connect()
+    for row in rows:
+        conn.execute("INSERT INTO events (user_id, action, timestamp) VALUES (?, ?, ?)", row)
+        conn.commit()
+
+
+def _log_batched(rows, batch):
+    for i in range(0, len(rows), batch):
+        database.log_events(rows[i:i + batch])
+
+
+def bench_events(n=20_000):
+    import events
+
+    start = perf_counter()
+    for i in range(n):
+        events.register_action(i, "search")
+    seconds = perf_counter() - start
+    print(f"{'register_action()':<26} {seconds / n * 1e9:8.0f} ns/action, no DB work")
+    events._buffer.clear()
+
+    _fresh_db(0)
+    rows = [(i, "match", time()) for i in range(n)]
+    for name, fn in (
+        ("commit per action", _log_one_by_one),
+        (f"batches of {events._buffer.batch}", lambda r: _log_batched(r, events._buffer.batch)),
+    ):
+        start = perf_counter()
+        commits = _count_commits(fn, rows)
+        seconds = perf_counter() - start
+        print(f"{name:<26} {commits:>6} commits  {n / seconds:>12,.0f} actions/sec")
+    database.close_db()
+
+
+# ---------------------------------------------------------
+# CONCURRENT UPDATES
+# ---------------------------------------------------------
+
+async def _run_updates(processor, messages, users, handler_io, burst=3):
+    # Feeds the processor like Application._update_fetcher does: one task
+    # per update, created in arrival order. Users send `burst` updates back
+    # to back (/next, then a message...). Handlers sleep a random share of
+    # handler_io (the Bot API round trip) and log what they handled.
+    seen = {}
+    rng = random.Random(1)
+    updates = [
+        SimpleNamespace(effective_user=SimpleNamespace(id=(i // burst) % users), seq=i)
+        for i in range(messages)
+    ]
+
+    async def handle(update):
+        await asyncio.sleep(rng.uniform(0, 2 * handler_io))
+        seen.setdefault(update.effective_user.id, []).append(update.seq)
+
+    start = perf_counter()
+    await asyncio.gather(*(
+        asyncio.create_task(processor.process_update(u, handle(u))) for u in updates
+    ))
+    # queued coroutines finish in the task of the user's first update
+    seconds = perf_counter() - start
+    out_of_order = sum(s != sorted(s) for s in seen.values())
+    return seconds, out_of_order
+
+
+def bench_updates(inflight=(1, 8, 64), messages=2_000, users=200, handler_io=0.01):
+    """
+    messages/sec with N updates in flight; the stock processor for
+    comparison. Exits 1 if a user's updates ran out of order.
+    """
+    from telegram.ext import SimpleUpdateProcessor
+    from update_processor import PerUserUpdateProcessor
+
+    failed = 0
+    for n in inflight:
+        for name, cls in (("stock", SimpleUpdateProcessor), ("per-user", PerUserUpdateProcessor)):
+            seconds, out_of_order = asyncio.run(_run_updates(cls(n), messages, users, handler_io))
+            print(
+                f"{name:<9} in-flight={n:<3} {messages / seconds:>8,.0f} msgs/sec  "
+                f"{out_of_order:>4} of {users} users out of order"
+            )
+            if cls is PerUserUpdateProcessor:
+                failed += out_of_order
+
+    if failed:
+        raise SystemExit(1)
+
+
+# ---------------------------------------------------------
+# METRICS
+# ---------------------------------------------------------
+
+def bench_metrics(n=1_000_000):
+    """
+    Cost of one observation. The relay path does one histogram observe.
+    """
+    import metrics
+
+    c = metrics.Counter()
+    h = metrics.Histogram()
+    locked = metrics.Histogram(threadsafe=True)
+    values = [random.random() * 0.2 for _ in range(1024)]
+
+    costs = {}
+    for name, observe in (
+        ("counter inc", lambda i: c.inc()),
+        ("histogram observe", lambda i: h.observe(values[i & 1023])),
+        ("histogram observe (locked)", lambda i: locked.observe(values[i & 1023])),
+        ("empty call (overhead)", lambda i: None),
+    ):
+        start = perf_counter()
+        for i in range(n):
+            observe(i)
+        costs[name] = (perf_counter() - start) / n * 1e9
+        print(f"{name:<28} {costs[name]:7.0f} ns")
+
+    metrics.render()        # must not raise
+    if costs["histogram observe"] - costs["empty call (overhead)"] >= 1000:
+        raise SystemExit(1)
+
+
+# ---------------------------------------------------------
+# COORDINATION BACKENDS
+# ---------------------------------------------------------
+
+async def _check_backend(make_backend, events=10_000):
+    from coordination import MATCHER_LEASE
+
+    a, b = make_backend(), make_backend()
+    failures = []
+
+    def check(ok, what):
+        if not ok:
+            failures.append(what)
+
+    # lease: exclusive, renewable, expires, released only by its owner
+    check(await a.hold_lease(MATCHER_LEASE, "w1", 0.2), "first worker takes the lease")
+    check(not await b.hold_lease(MATCHER_LEASE, "w2", 0.2), "second worker is refused")
+    check(await a.hold_lease(MATCHER_LEASE, "w1", 0.2), "holder renews")
+    await b.release_lease(MATCHER_LEASE, "w2")
+    check(not await b.hold_lease(MATCHER_LEASE, "w2", 0.2), "non-owner cannot release")
+    await asyncio.sleep(0.3)
+    check(await b.hold_lease(MATCHER_LEASE, "w2", 0.2), "expired lease is taken over")
+    await b.release_lease(MATCHER_LEASE, "w2")
+    check(await a.hold_lease(MATCHER_LEASE, "w1", 0.2), "released lease is free")
+
+    # events: one worker pushes, the other pops them all, in order
+    start = perf_counter()
+    for i in range(events):
+        await a.push_event({"op": "push", "user": i, "priority": 0})
+    received = []
+    while len(received) < events:
+        batch = await b.pop_events(timeout=0.5)
+        if not batch:
+            break
+        received.extend(e["user"] for e in batch)
+    seconds = perf_counter() - start
+    check(received == list(range(events)), "events arrive once, in order")
+    check(await b.pop_events(timeout=0.1) == [], "empty queue times out")
+
+    # sessions written by one worker are visible to the other
+    await a.set_sessions({1: ("chatting", 2), 2: ("chatting", 1), 3: ("idle", None)})
+    check(await b.get_session(1) == ("chatting", 2), "session visible to other worker")
+    check(await b.get_session(3) == ("idle", None), "idle session round-trips")
+    check(await b.get_session(4) is None, "unknown user is a miss")
+
+    await a.close()
+    await b.close()
+    return failures, events, seconds
+
+
+def bench_coord():
+    """
+    Runs the same contract against every available backend. Two
+    instances stand for two workers sharing one store.
+    """
+    from coordination import MemoryBackend, RedisBackend
+
+    shared = MemoryBackend()
+    backends = {"memory": lambda: shared}
+    try:
+        import fakeredis
+        server = fakeredis.FakeServer()
+        backends["redis (fakeredis)"] = lambda: RedisBackend(
+            fakeredis.aioredis.FakeRedis(server=server, decode_responses=True),
+            prefix="bench",
+        )
+    except ImportError:
+        print("fakeredis not installed — skipping the Redis backend")
+
+    failed = 0
+    for name, make_backend in backends.items():
+        failures, events, seconds = asyncio.run(_check_backend(make_backend))
+        _report(f"{name} events", events, seconds)
+        for what in failures:
+            print(f"FAIL {name}: {what}")
+        failed += len(failures)
+
+    if failed:
+        raise SystemExit(1)
+
+
+# ---------------------------------------------------------
+# SESSION ROLLUPS
+# ---------------------------------------------------------
+
+def _session_ops(sessions, hours, seed=1):
+    # session_log ops with made-up clocks: `sessions` chats spread over
+    # `hours`, random length and message count, ended by /next or /stop
+    rng = random.Random(seed)
+    start = time() - hours * 3600
+    timeline = []
+    for i in range(sessions):
+        user1, user2 = 2 * i, 2 * i + 1
+        began = start + rng.uniform(0, hours * 3600)
+        length = rng.expovariate(1 / 120)
+        timeline.append((began, (0, user1, user2, began, rng.uniform(0, 30), rng.uniform(0, 30))))
+        for _ in range(rng.randrange(40)):
+            timeline.append((began + rng.uniform(0, length), (1, rng.choice((user1, user2)))))
+        timeline.append((began + length, (2, rng.choice((user1, user2)), began + length, rng.choice(("next", "stop")))))
+    timeline.sort(key=lambda item: item[0])
+    return [op for _, op in timeline]
+
+
+def _raw_hourly_stats():
+    # what a dashboard would do without rollups: scan every ended session
+    rows = database._connect().execute("""
+        SELECT CAST(ended_at / 3600 AS INTEGER) * 3600, ended_at - started_at, messages1 + messages2
+        FROM sessions WHERE ended_at IS NOT NULL AND end_reason != 'lost'
+    """).fetchall()
+    hours = {}
+    for hour, duration, messages in rows:
+        hours.setdefault(hour, []).append((duration, messages))
+    return {
+        hour: (len(v), _percentile([d for d, _ in v], 50), sum(d for d, _ in v) / len(v))
+        for hour, v in hours.items()
+    }
+
+
+def bench_sessions(sessions=20_000, hours=48, batch=1_000):
+    import session_log
+
+    _fresh_db(0)
+    ops = _session_ops(sessions, hours)
+    start = perf_counter()
+    commits = 0
+    for i in range(0, len(ops), batch):
+        commits += _count_commits(database.record_sessions, *session_log._fold(ops[i:i + batch]))
+    seconds = perf_counter() - start
+    print(f"{'record_sessions()':<26} {len(ops):>8} ops  {commits:>5} commits  {len(ops) / seconds:>10,.0f} ops/sec")
+
+    for name, fn in (("rollups", lambda: database.hourly_session_stats(0)), ("raw scan", _raw_hourly_stats)):
+        start = perf_counter()
+        for _ in range(20):
+            fn()
+        print(f"{'dashboard, ' + name:<26} {(perf_counter() - start) / 20 * 1e3:8.2f} ms/read")
+
+    raw = _raw_hourly_stats()
+    failed = 0
+    for hour, count, median, avg, _, _ in database.hourly_session_stats(0):
+        raw_count, raw_median, raw_avg = raw.get(hour, (0, 0, 0))
+        # the rollup median is the upper bound of the bucket holding it
+        bucket = bisect_left(database.DURATION_BUCKETS, raw_median)
+        low = database.DURATION_BUCKETS[bucket - 1] if bucket else 0
+        if raw_count != count or abs(raw_avg - avg) > 1e-6 or not low <= raw_median <= median:
+            print(f"FAIL hour {hour}: rollup {count} / {median} / {avg:.1f}, raw {raw_count} / {raw_median:.1f} / {raw_avg:.1f}")
+            failed += 1
+    total = sum(row[1] for row in database.hourly_session_stats(0))
+    print(f"{total} sessions in {len(raw)} hourly rollups, {failed} mismatches")
+    database.close_db()
+    if failed or total != sessions:
+        raise SystemExit(1)
+
+
+# ---------------------------------------------------------
+# RECENT PARTNERS
+# ---------------------------------------------------------
+
+def _next_loop(users, recent, ticks=600, chat=(5, 30)):
+    # `users` people, half of each gender, chat for a few seconds and hit
+    # /next, over and over. Returns (matches, repeats, seconds in pop_pairs):
+    # a repeat is meeting one of your last RECENT_PARTNERS partners again.
+    from config import MAX_QUEUE_WAIT
+    from recent_partners import RecentPartners
+    from scheduling import FairShare
+
+    rng = random.Random(1)
+    q = MatchQueue(FairShare(max_wait=MAX_QUEUE_WAIT), recent)
+    history = RecentPartners(ttl=float("inf"))
+    back_at = {}
+    for u in range(users):
+        q.push(u, Profile("male" if u % 2 else "female", None, None, None), 0, 0)
+    matches = repeats = 0
+    busy = 0.0
+    for t in range(ticks):
+        for u in [u for u, at in back_at.items() if at <= t]:
+            del back_at[u]
+            q.push(u, Profile("male" if u % 2 else "female", None, None, None), 0, t)
+
+        start = perf_counter()
+        pairs = q.pop_pairs(now=t)
+        busy += perf_counter() - start
+
+        for u1, u2 in pairs:
+            matches += 1
+            repeats += u2 in history.of(u1)
+            history.add(u1, u2, t)
+            if recent is not None:
+                recent.add(u1, u2, t)
+            back_at[u1] = back_at[u2] = t + rng.randint(*chat)
+    return matches, repeats, busy
+
+
+def bench_recent(sizes=(6, 20, 200)):
+    from recent_partners import RecentPartners
+
+    for n in sizes:
+        line = f"users={n:>4}"
+        for name, recent in (("no ring", None), ("ring", RecentPartners())):
+            matches, repeats, busy = _next_loop(n, recent)
+            line += f"  {name}: {repeats / matches:6.1%} repeats of {matches:>5} matches, {busy * 1e6 / matches:5.1f} µs/match"
+        print(line)
+
+
+# ---------------------------------------------------------
+# STARS LEDGER
+# ---------------------------------------------------------
+
+def _legacy_charge(user_id, price):
+    # premium_logic.charge_stars before the ledger: read, check, then debit
+    conn = database._connect()
+    (stars,) = conn.execute("SELECT stars FROM users WHERE id=?", (user_id,)).fetchone()
+    if stars < price:
+        return False
+    conn.execute("UPDATE users SET stars = stars - ? WHERE id=?", (price, user_id))
+    conn.commit()
+    conn.execute(
+        "INSERT INTO transactions (user_id, amount, feature, timestamp) VALUES (?, ?, 'buy', ?)",
+        (user_id, -price, int(time()))
+    )
+    conn.commit()
+    return True
+
+
+def _race(fn, threads, attempts):
+    # `threads` connections call fn() `attempts` times each, all at once
+    barrier = threading.Barrier(threads)
+    wins = []
+
+    def run():
+        barrier.wait()
+        wins.append(sum(bool(fn()) for _ in range(attempts)))
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return sum(wins)
+
+
+def bench_ledger(stars=200, threads=8, users=2_000, history=200, tail=5):
+    import ledger
+
+    failed = 0
+    for name, charge in (
+        ("read-check-write", lambda: _legacy_charge(0, 1)),
+        ("ledger.debit()", lambda: ledger.debit(0, 1, "buy")),
+    ):
+        _fresh_db(1)
+        database._connect().execute("UPDATE users SET stars=? WHERE id=0", (stars,))
+        database._connect().commit()
+        database.close_db()     # every racing thread opens its own connection
+        start = perf_counter()
+        bought = _race(charge, threads, stars // 2)
+        seconds = perf_counter() - start
+        left = ledger.balance(0)
+        print(f"{name:<18} {bought:>4} of {threads * (stars // 2)} debits for {stars} stars, "
+              f"balance {left:>4}  {bought / seconds:>8,.0f} debits/sec")
+        failed += name == "ledger.debit()" and (bought != stars or left != 0)
+
+    # the same successful_payment delivered to every thread at once
+    _fresh_db(1)
+    applied = _race(lambda: ledger.record_payment(0, "paid_vip_7", "charge-1", 50), threads, 1)
+    print(f"one charge id sent {threads}x: applied {applied}x")
+    failed += applied != 1
+
+    # audit: latest snapshot + tail vs replaying every user's whole history
+    _fresh_db(users)
+    rng = random.Random(1)
+    conn = database._connect()
+    rows = [(u, rng.randint(1, 50), "stars_added", 0) for u in range(users) for _ in range(history)]
+    conn.executemany("INSERT INTO transactions (user_id, amount, feature, timestamp) VALUES (?, ?, ?, ?)", rows)
+    conn.execute("UPDATE users SET stars = (SELECT SUM(amount) FROM transactions WHERE user_id = users.id)")
+    conn.commit()
+    ledger.snapshot_balances()
+    for u in range(users):
+        for _ in range(tail):
+            ledger.credit(u, rng.randint(1, 50))
+
+    start = perf_counter()
+    clean = ledger.audit()
+    audit_seconds = perf_counter() - start
+    start = perf_counter()
+    replayed = conn.execute("""
+        SELECT u.id FROM users u JOIN (SELECT user_id, SUM(amount) AS total FROM transactions GROUP BY user_id) t
+        ON t.user_id = u.id WHERE t.total != u.stars
+    """).fetchall()
+    replay_seconds = perf_counter() - start
+    conn.execute("UPDATE users SET stars = stars + 1 WHERE id=7")
+    conn.commit()
+    caught = ledger.audit()
+    print(f"audit of {users} users, {users * (history + tail)} entries: "
+          f"snapshot + tail {audit_seconds * 1e3:.0f} ms, full replay {replay_seconds * 1e3:.0f} ms")
+    print(f"clean ledger: {len(clean)} mismatches (full replay {len(replayed)}), "
+          f"after tampering with user 7: {caught}")
+    failed += bool(clean) or bool(replayed) or [u for u, _, _ in caught] != [7]
+
+    database.close_db()
+    if failed:
+        raise SystemExit(1)
+
+
+# ---------------------------------------------------------
+# DISCONNECT VS MATCHER TICK
+# ---------------------------------------------------------
+
+class _SilentBot:
+    async def send_message(self, *args, **kwargs):
+        pass
+
+
+async def _disconnect_race(rounds):
+    import matchmaking
+    import session_cache
+
+    bot = _SilentBot()
+    stale = 0
+    matchmaking._leader = True
+    for _ in range(rounds):
+        matchmaking.recent_partners.clear()     # or the ring keeps them apart
+        for user_id in (1, 2):
+            await matchmaking.prepare_for_search(user_id)
+            await matchmaking.enqueue(user_id)
+        # user 1 hits /stop while the tick that pairs them is in flight
+        await asyncio.gather(matchmaking.matchmaker(bot), matchmaking.disconnect_users(bot, 1))
+        for user_id in (1, 2):
+            stale += session_cache.get(user_id) != database.get_session(user_id)
+    matchmaking._leader = False
+    return stale
+
+
+def bench_disconnect(rounds=200):
+    _fresh_db(3)
+    stale = asyncio.run(_disconnect_race(rounds))
+    print(f"{rounds} /stop vs matcher tick races: {stale} stale cached sessions")
+    database.close_db()
+    if stale:
+        raise SystemExit(1)
+
+
+# ---------------------------------------------------------
+# MATCHER WAKE-UPS
+# ---------------------------------------------------------
+
+async def _pair_alone_exes(max_wait, ttl, timeout):
+    # users 1 and 2 just chatted and both hit /next: nobody else joins, so
+    # only time can pair them again (max_wait, or the ring entry expiring).
+    # Runs the real bot.match_loop. Returns seconds until paired, or None.
+    import bot
+    import matchmaking
+    import session_cache
+    from scheduling import FairShare
+
+    queue, recent = matchmaking.match_queue, matchmaking.recent_partners
+    saved = queue.policy, recent.ttl
+    queue.policy, recent.ttl = FairShare(max_wait=max_wait), ttl
+    recent.clear()
+    matchmaking._reset_queue()
+    matchmaking._leader = True
+    loop = asyncio.create_task(bot.match_loop(SimpleNamespace(bot=_SilentBot())))
+    try:
+        recent.add(1, 2)
+        for user_id in (1, 2):
+            await matchmaking.prepare_for_search(user_id)
+            await matchmaking.enqueue(user_id)
+        start = perf_counter()
+        while perf_counter() - start < timeout:
+            if session_cache.get(1) == ("chatting", 2):
+                return perf_counter() - start
+            await asyncio.sleep(0.02)
+        return None
+    finally:
+        loop.cancel()
+        await asyncio.gather(loop, return_exceptions=True)
+        matchmaking._leader = False
+        matchmaking._reset_queue()
+        recent.clear()
+        queue.policy, recent.ttl = saved
+
+
+async def _wakeup_cases(timeout):
+    # one event loop for all cases: the modules' asyncio.Events bind to it
+    failed = 0
+    for name, max_wait, ttl in (
+        ("overdue after max_wait=2s", 2, 600),
+        ("ring entry expires, ttl=1.5s", None, 1.5),
+    ):
+        _fresh_db(0)
+        conn = database._connect()
+        conn.executemany(
+            "INSERT INTO users (id, gender, state) VALUES (?, ?, 'idle')", ((1, "male"), (2, "female"))
+        )
+        conn.commit()
+        seconds = await _pair_alone_exes(max_wait, ttl, timeout)
+        if seconds is None:
+            failed += 1
+            print(f"FAIL {name:<30} not paired within {timeout:g}s")
+        else:
+            print(f"ok   {name:<30} paired by match_loop after {seconds:.2f}s")
+        database.close_db()
+    return failed
+
+
+def bench_wakeup(timeout=10.0):
+    if asyncio.run(_wakeup_cases(timeout)):
+        raise SystemExit(1)
+
+
+# ---------------------------------------------------------
+# ENTRY
+# ---------------------------------------------------------
+
+BENCHMARKS = {
+    "db": bench_db,
+    "batch": bench_batch,
+    "cleaner": bench_cleaner,
+    "commits": bench_commits,
+    "prefs": bench_prefs,
+    "updates": bench_updates,
+    "metrics": bench_metrics,
+    "events": bench_events,
+    "coord": bench_coord,
+    "sessions": bench_sessions,
+    "recent": bench_recent,
+    "ledger": bench_ledger,
+    "disconnect": bench_disconnect,
+    "wakeup": bench_wakeup,
+}
+
+
+def main(argv):
+    names = argv or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"unknown benchmark: {name} (choose from {', '.join(BENCHMARKS)})")
+            return 1
+        print(f"== {name}")
+        BENCHMARKS[name]()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,6 +1,7 @@
 # bot.py — Telegram Stars VIP System (FINAL CLEAN A-MODEL)
 
 import asyncio
+import signal
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
 from telegram.ext import (
     ApplicationBuilder,
@@ -11,21 +12,63 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
-
-from config import BOT_TOKEN
-from database import (
-    init_db,
+from telegram.error import RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+
+from config import (
+    BOT_TOKEN,
+    LEASE_TTL,
+    WEBHOOK_URL,
+    WEBHOOK_SECRET,
+    WEBHOOK_PATH,
+    PORT,
+    CONCURRENT_UPDATES,
+    METRICS_HOST,
+    METRICS_PORT,
+)
+from database import init_db
+from async_database import (
+    run_read,
+    run_write,
+    shutdown as shutdown_db,
     create_user,
-    add_to_queue,
-    get_partner,
-    get_user_state,
+    load_sessions,
     update_gender,
-    update_last_active,
+    update_region,
+    get_match_profile,
 )
 
-from matchmaking import prepare_for_search, matchmaker, disconnect_users
-from premium_logic import has_vip, grant_vip
-from queue_cleaner import clean_queue
+from matchmaking import (
+    prepare_for_search,
+    matchmaker,
+    disconnect_users,
+    enqueue,
+    update_queued_profile,
+    wait_for_queue,
+    lookup_session,
+    is_leader,
+    hold_matcher_lease,
+    release_matcher_lease,
+    pump_queue_events,
+    save_queue,
+    rematch,
+)
+from coordination import backend
+import presence
+import session_cache
+import session_log
+from relay import relay_message
+from outbox import outbox
+from premium_logic import has_vip, warm_vip_cache, VIP_REFRESH
+from ledger import snapshot_balances, SNAPSHOT_INTERVAL
+from payment_engine import process_payment, verify_star_payment
+import catalog
+from features import apply_gender_filter, apply_region_filter
+from queue_cleaner import clean_queue, evict_inactive
+from webhook import run_webhook, default_secret
+from update_processor import PerUserUpdateProcessor
+from events import flush_loop, flush as flush_events
+import metrics
 
 
 # ---------------------------------------------------------
@@ -34,12 +77,13 @@ from queue_cleaner import clean_queue
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user.id
-    create_user(user)
-    update_last_active(user)
+    await create_user(user)
+    presence.touch(user)
 
     await update.message.reply_text(
         "🎭 Добро пожаловать в ChatRoulette!\n\n"
         "/gender — выбрать пол\n"
+        "/region — указать регион\n"
         "/search — поиск собеседника\n"
         "/premium — премиум меню (VIP)"
     )
@@ -51,10 +95,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user.id
-    update_last_active(user)
 
-    prepare_for_search(user)
-    add_to_queue(user)
+    await prepare_for_search(user)
+    await enqueue(user)
 
     await update.message.reply_text("🔎 Поиск собеседника...")
 
@@ -66,9 +109,9 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def next_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user.id
 
-    await disconnect_users(context.bot, user)
-    prepare_for_search(user)
-    add_to_queue(user)
+    await disconnect_users(context.bot, user, reason="next")
+    await prepare_for_search(user)
+    await enqueue(user)
 
     await update.message.reply_text("🔄 Ищем следующего...")
 
@@ -93,12 +136,10 @@ async def premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
     kb = []
 
     if not vip:
-        kb.extend([
-            [InlineKeyboardButton("💎 VIP 7 дней — 50⭐", callback_data="buy_vip_7")],
-            [InlineKeyboardButton("💠 VIP 30 дней — 150⭐", callback_data="buy_vip_30")],
-            [InlineKeyboardButton("🔥 VIP 90 дней — 350⭐", callback_data="buy_vip_90")],
-            [InlineKeyboardButton("👑 VIP Навсегда — 1200⭐", callback_data="buy_vip_life")],
-        ])
+        kb.extend(
+            [InlineKeyboardButton(p.button, callback_data=catalog.BUY_PREFIX + p.payload)]
+            for p in catalog.invoice_products()
+        )
     else:
         kb.append([InlineKeyboardButton("🟢 VIP активен", callback_data="vip_active")])
 
@@ -128,24 +169,13 @@ async def callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await q.answer()
     vip = has_vip(user)
 
-    # Buy VIP options
-    if data == "buy_vip_7":
-        await send_vip_invoice(user, context, 50, "vip_7", "VIP 7 дней")
-        await q.edit_message_text("💎 Открываю оплату...")
-        return
-
-    if data == "buy_vip_30":
-        await send_vip_invoice(user, context, 150, "vip_30", "VIP 30 дней")
-        await q.edit_message_text("💎 Открываю оплату...")
-        return
-
-    if data == "buy_vip_90":
-        await send_vip_invoice(user, context, 350, "vip_90", "VIP 90 дней")
-        await q.edit_message_text("💎 Открываю оплату...")
-        return
-
-    if data == "buy_vip_life":
-        await send_vip_invoice(user, context, 1200, "vip_life", "VIP Навсегда")
+    # Buy VIP options (catalog.json)
+    if data.startswith(catalog.BUY_PREFIX):
+        product = catalog.get(data[len(catalog.BUY_PREFIX):])
+        if product is None or not product.invoice:
+            await q.edit_message_text("❌ Этот тариф больше недоступен. /premium")
+            return
+        await send_vip_invoice(user, context, product.price, product.payload, product.title)
         await q.edit_message_text("💎 Открываю оплату...")
         return
 
@@ -155,29 +185,98 @@ async def callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Gender change
     if data == "set_gender_male":
-        update_gender(user, "male")
+        await update_gender(user, "male")
+        await update_queued_profile(user)
         await q.edit_message_text("Ваш пол: 👨 Мужчина")
         return
 
     if data == "set_gender_female":
-        update_gender(user, "female")
+        await update_gender(user, "female")
+        await update_queued_profile(user)
         await q.edit_message_text("Ваш пол: 👩 Женщина")
         return
 
+    # Gender filter choice
+    if data in WANT_GENDER:
+        result = await run_write(apply_gender_filter, user, WANT_GENDER[data])
+        if result["success"]:
+            await update_queued_profile(user)
+            await q.edit_message_text("⭐ Гендер-фильтр сохранён.")
+        else:
+            await q.edit_message_text("❌ Недостаточно звёзд.")
+        return
+
     # VIP features
     if data in ["gf", "rf", "pr", "rm"]:
-        if vip:
-            msg = {
-                "gf": "⭐ Гендер-фильтр активирован.",
-                "rf": "🌍 Регион-фильтр активирован.",
-                "pr": "⚡ Приоритет включён.",
-                "rm": "⏩ Рематч активирован.",
-            }[data]
-            await q.edit_message_text(msg)
-        else:
+        if not vip:
             await q.edit_message_text("❌ Доступно только VIP.")
+            return
+
+        if data == "gf":
+            kb = [
+                [InlineKeyboardButton("👨 Мужчины", callback_data="want_gender_male")],
+                [InlineKeyboardButton("👩 Женщины", callback_data="want_gender_female")],
+                [InlineKeyboardButton("👥 Все", callback_data="want_gender_any")],
+            ]
+            await q.edit_message_text("⭐ Кого искать?", reply_markup=InlineKeyboardMarkup(kb))
+            return
+
+        if data == "rf":
+            await region_filter(q, user)
+            return
+
+        if data == "rm":
+            await rematch_last(q, context, user)
+            return
+
+        msg = {
+            "pr": "⚡ Приоритет включён.",
+        }[data]
+        await q.edit_message_text(msg)
+        return
+
+
+WANT_GENDER = {
+    "want_gender_male": "male",
+    "want_gender_female": "female",
+    "want_gender_any": None,
+}
+
+
+async def rematch_last(q, context, user):
+    # VIP: back to the partner the user just left, without the queue
+    state, _ = await lookup_session(user)
+    if state == "chatting":
+        await q.edit_message_text("⏩ Сначала завершите текущий чат: /next или /stop")
+        return
+
+    if await rematch(context.bot, user):
+        await q.edit_message_text("⏩ Рематч: соединяем с прошлым собеседником.")
+    else:
+        await q.edit_message_text("⏩ Прошлый собеседник уже недоступен.")
+
+
+async def region_filter(q, user):
+    # Toggles "only my region" for the user's own region.
+    row = await get_match_profile(user)
+    region, want_region = (row[1], row[3]) if row else (None, None)
+
+    if not region:
+        await q.edit_message_text("🌍 Сначала укажите регион: /region <название>")
+        return
+
+    target = None if want_region else region
+    result = await run_write(apply_region_filter, user, target)
+    if not result["success"]:
+        await q.edit_message_text("❌ Недостаточно звёзд.")
         return
 
+    await update_queued_profile(user)
+    if target:
+        await q.edit_message_text(f"🌍 Регион-фильтр активирован: {target}")
+    else:
+        await q.edit_message_text("🌍 Регион-фильтр выключен.")
+
 
 # ---------------------------------------------------------
 # Send Invoice
@@ -204,7 +303,12 @@ async def send_vip_invoice(user_id, context, stars, payload, label):
 # ---------------------------------------------------------
 
 async def precheckout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.pre_checkout_query.answer(ok=True)
+    query = update.pre_checkout_query
+    if query.currency == "XTR" and verify_star_payment(query.total_amount, query.invoice_payload):
+        await query.answer(ok=True)
+    else:
+        # the plan was changed or removed since the invoice went out
+        await query.answer(ok=False, error_message="Тариф изменился. Откройте /premium ещё раз.")
 
 
 async def successful_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -215,54 +319,152 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
         return
 
     payload = payment.invoice_payload
+    result = await run_write(
+        process_payment, user, payload, payment.total_amount, payment.telegram_payment_charge_id
+    )
 
-    if payload == "vip_7":
-        grant_vip(user, 7)
-    elif payload == "vip_30":
-        grant_vip(user, 30)
-    elif payload == "vip_90":
-        grant_vip(user, 90)
-    elif payload == "vip_life":
-        grant_vip(user, 9999)
+    if result.get("error") == "duplicate":
+        # Telegram redelivered a payment that was already applied
+        metrics.duplicate_payments.inc()
+        return
+    if not result["success"]:
+        await update.message.reply_text("⚠️ Оплата получена, но этот тариф больше не продаётся.")
+        return
 
+    metrics.vip_purchases.labels(payload).inc()
     await update.message.reply_text("💎 VIP активирован!")
 
 
 # ---------------------------------------------------------
 # Chat Relay
 # ---------------------------------------------------------
+# New content messages only: service messages (pins, members, ...),
+# invoices and payments cannot be copied, copy_message rejects them.
+
+RELAYABLE = (
+    filters.UpdateType.MESSAGE
+    & ~filters.COMMAND
+    & ~filters.StatusUpdate.ALL
+    & ~filters.INVOICE
+    & ~filters.SUCCESSFUL_PAYMENT
+)
+
 
 async def chat_forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user.id
-    if get_user_state(user) != "chatting":
+    state, partner = await lookup_session(user)
+    if state != "chatting":
         return
 
-    partner = get_partner(user)
     if partner:
-        await context.bot.send_message(partner, update.message.text)
+        await relay_message(context.bot, partner, update.message)
+        session_log.message(user)
 
 
 # ---------------------------------------------------------
 # Background Loops
 # ---------------------------------------------------------
 
+_background = []
+_metrics_server = None
+
+
 async def start_background(app):
-    asyncio.create_task(match_loop(app))
-    asyncio.create_task(clean_loop(app))
+    global _metrics_server
+    session_cache.load(await load_sessions())
+    await run_read(warm_vip_cache)
+    await hold_matcher_lease()      # the leader loads the queue snapshot
+    if hasattr(signal, "SIGHUP"):
+        # kill -HUP <pid>: re-read catalog.json
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, catalog.reload)
+    outbox.start()
+    for loop in (lease_loop, event_loop, match_loop, clean_loop, presence_loop, ledger_loop):
+        _background.append(asyncio.create_task(loop(app)))
+    if backend.shared:
+        _background.append(asyncio.create_task(vip_loop(app)))
+    _background.append(asyncio.create_task(flush_loop()))
+    _background.append(asyncio.create_task(session_log.flush_loop()))
+    _background.append(asyncio.create_task(presence.flush_loop()))
+    if METRICS_PORT:
+        _metrics_server = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+
+
+async def stop_background(app):
+    for task in _background:
+        task.cancel()
+    await asyncio.gather(*_background, return_exceptions=True)
+    _background.clear()
+    if _metrics_server:
+        await _metrics_server.cleanup()
+
+    await outbox.stop()
+    await release_matcher_lease()   # saves the queue if we were the leader
+    await backend.close()
+    await flush_events()            # buffered actions
+    await session_log.flush()
+    await presence.flush()          # last_active
+    shutdown_db()
+    print("Session cache:", session_cache.stats())
+    print("Outbox:", outbox.stats())
+
+
+async def lease_loop(app):
+    # every worker competes for the matcher lease; the holder renews it
+    while True:
+        await asyncio.sleep(LEASE_TTL / 3)
+        await hold_matcher_lease()
+
+
+async def event_loop(app):
+    # queue ops forwarded by other workers
+    while True:
+        if is_leader():
+            await pump_queue_events()
+        else:
+            await asyncio.sleep(1)
 
 
 async def match_loop(app):
+    # event-driven: sleeps until enqueue() signals a queue change
     while True:
-        await matchmaker(app.bot)
-        await asyncio.sleep(1)
+        await wait_for_queue()
+        if is_leader():
+            await matchmaker(app.bot)
 
 
 async def clean_loop(app):
+    # queue snapshot every 5 s; the chatting / broken-link sweep every 30 s
+    rounds = 0
     while True:
-        await clean_queue(app.bot)
+        if is_leader():
+            if rounds % 6 == 0:
+                await clean_queue(app.bot)     # also flushes the queue snapshot
+            else:
+                await save_queue()
+        rounds += 1
         await asyncio.sleep(5)
 
 
+async def presence_loop(app):
+    # inactive searchers leave the queue when their timer is due
+    await presence.expire_loop(lambda user_ids: evict_inactive(app.bot, user_ids))
+
+
+async def vip_loop(app):
+    # several workers: VIP bought through another one (see premium_logic)
+    while True:
+        await asyncio.sleep(VIP_REFRESH)
+        await run_read(warm_vip_cache)
+
+
+async def ledger_loop(app):
+    # balance snapshots, so audits only replay recent entries
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        if is_leader():
+            await run_write(snapshot_balances)
+
+
 # ---------------------------------------------------------
 # Gender Menu
 # ---------------------------------------------------------
@@ -276,16 +478,70 @@ async def gender(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # ---------------------------------------------------------
-# MAIN
+# Region
 # ---------------------------------------------------------
 
-def main():
-    init_db()
+async def region(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user.id
+    name = " ".join(context.args).strip().lower()[:64]
+
+    if not name:
+        await update.message.reply_text("Укажите регион: /region Москва")
+        return
 
-    app = ApplicationBuilder().token(BOT_TOKEN).post_init(start_background).build()
+    await update_region(user, name)
+    await update_queued_profile(user)
+    await update.message.reply_text(f"🌍 Ваш регион: {name}")
+
+
+# ---------------------------------------------------------
+# MAIN
+# ---------------------------------------------------------
+
+class CountedRequest(HTTPXRequest):
+    """
+    Counts failed Bot API calls in the metrics: sends through the outbox
+    and direct calls alike (replies, callback and checkout answers,
+    invoices, getUpdates).
+    """
+
+    async def post(self, *args, **kwargs):
+        try:
+            return await super().post(*args, **kwargs)
+        except RetryAfter:
+            metrics.telegram_retry_after.inc()
+            raise
+        except TelegramError as e:
+            metrics.telegram_errors.labels(type(e).__name__).inc()
+            raise
+
+
+def build_application(token=BOT_TOKEN, webhook=False, base_url=None):
+    """
+    webhook=True: no Updater (webhook.py feeds the update queue).
+    Updates run concurrently, each user's in order. base_url points the
+    bot at another Bot API server (loadtest.py uses a local fake).
+    """
+    catalog.load()      # a broken catalog.json stops startup here
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .post_init(start_background)
+        .post_stop(stop_background)     # the bot can still send while the outbox drains
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        # ApplicationBuilder's default pool sizes
+        .request(CountedRequest(connection_pool_size=256))
+        .get_updates_request(CountedRequest(connection_pool_size=1))
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if webhook:
+        builder = builder.updater(None)
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("gender", gender))
+    app.add_handler(CommandHandler("region", region))
     app.add_handler(CommandHandler("search", search))
     app.add_handler(CommandHandler("next", next_user))
     app.add_handler(CommandHandler("stop", stop))
@@ -294,10 +550,20 @@ def main():
     app.add_handler(CallbackQueryHandler(callbacks))
     app.add_handler(PreCheckoutQueryHandler(precheckout_handler))
     app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat_forward))
+    app.add_handler(MessageHandler(RELAYABLE, chat_forward))
+    return app
+
 
-    print("ChatRoulette running…")
-    app.run_polling()
+def main():
+    init_db()
+    app = build_application(webhook=bool(WEBHOOK_URL))
+
+    if WEBHOOK_URL:
+        print(f"ChatRoulette running (webhook, port {PORT})…")
+        run_webhook(app, WEBHOOK_URL, WEBHOOK_SECRET or default_secret(BOT_TOKEN), WEBHOOK_PATH, port=PORT)
+    else:
+        print("ChatRoulette running…")
+        app.run_polling()
 
 
 if __name__ == "__main__":
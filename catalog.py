@@ -0,0 +1,151 @@
+# catalog.py — what the bot sells, loaded from catalog.json
+#
+# One entry per product, keyed by its payload (the invoice payload, and
+# the name charge_stars() prices a feature by):
+#   feature   what the purchase gives, one of FEATURES
+#   price     in Stars
+#   days      how long VIP lasts (VIP products only)
+#   invoice   true: sold from the /premium menu through a Telegram Stars
+#             invoice (title and button are its texts); false: paid from
+#             the user's star balance. VIP is invoice-only: a balance
+#             charge takes the stars and delivers nothing.
+#
+# Lookups are dict gets. load() validates the whole file before swapping
+# it in, so a bad edit leaves the running catalog as it was. bot.py loads
+# it at startup and again on SIGHUP: adding a plan needs no restart.
+#
+# Usage:
+#   python catalog.py [path]      (checks a file before you reload it)
+
+import json
+import logging
+import sys
+from collections import namedtuple
+
+from config import CATALOG_PATH
+
+log = logging.getLogger(__name__)
+
+INVOICE_FEATURES = ("vip",)     # what payment_engine.FULFIL can deliver
+FEATURES = INVOICE_FEATURES + ("gender_filter", "region_filter", "priority", "instant_rematch")
+FIELDS = {"feature", "price", "days", "invoice", "title", "button"}
+BUY_PREFIX = "buy_"             # callback_data of the /premium buttons
+MAX_CALLBACK_DATA = 64          # bytes, Telegram's limit
+
+Product = namedtuple("Product", "payload feature price days invoice title button")
+
+_products = {}
+_invoice = ()       # invoice products in file order: the /premium menu
+
+
+# ---------------------------------------------------------
+# Loading
+# ---------------------------------------------------------
+
+def _positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def _text(value):
+    return isinstance(value, str) and value.strip() != ""
+
+
+def parse(data):
+    """
+    {payload: Product} from the decoded JSON. Raises ValueError naming
+    the first invalid entry.
+    """
+    if not isinstance(data, dict) or not data:
+        raise ValueError("catalog: expected a non-empty object of products")
+
+    products = {}
+    for payload, entry in data.items():
+        where = f"catalog: {payload!r}"
+        if not isinstance(entry, dict):
+            raise ValueError(f"{where}: expected an object")
+        unknown = set(entry) - FIELDS
+        if unknown:
+            raise ValueError(f"{where}: unknown fields {sorted(unknown)}")
+
+        feature = entry.get("feature")
+        price = entry.get("price")
+        days = entry.get("days")
+        invoice = entry.get("invoice", False)
+        title = entry.get("title")
+        button = entry.get("button")
+
+        if feature not in FEATURES:
+            raise ValueError(f"{where}: feature must be one of {', '.join(FEATURES)}")
+        if not _positive_int(price):
+            raise ValueError(f"{where}: price must be a positive integer")
+        if feature == "vip" and not _positive_int(days):
+            raise ValueError(f"{where}: VIP needs a positive integer 'days'")
+        if feature != "vip" and days is not None:
+            raise ValueError(f"{where}: only VIP products have 'days'")
+        if not isinstance(invoice, bool):
+            raise ValueError(f"{where}: invoice must be true or false")
+        if feature in INVOICE_FEATURES and not invoice:
+            raise ValueError(f"{where}: {feature} is only sold by invoice")
+        if invoice:
+            if feature not in INVOICE_FEATURES:
+                raise ValueError(f"{where}: {feature} cannot be sold by invoice")
+            if not (_text(title) and _text(button)):
+                raise ValueError(f"{where}: invoice products need 'title' and 'button'")
+            if len((BUY_PREFIX + payload).encode()) > MAX_CALLBACK_DATA:
+                raise ValueError(f"{where}: payload too long for callback data")
+
+        products[payload] = Product(payload, feature, price, days, invoice, title, button)
+    return products
+
+
+def load(path=CATALOG_PATH):
+    """
+    Reads, validates and swaps in the catalog. Returns the number of
+    products; raises (keeping the current catalog) if the file is invalid.
+    """
+    global _products, _invoice
+    with open(path, encoding="utf-8") as f:
+        products = parse(json.load(f))
+    _products = products
+    _invoice = tuple(p for p in products.values() if p.invoice)
+    return len(products)
+
+
+def reload(path=CATALOG_PATH):
+    # SIGHUP handler: a broken file is logged, not fatal
+    try:
+        count = load(path)
+    except (OSError, ValueError) as e:      # json errors are ValueErrors
+        log.error("catalog reload failed, keeping the current one: %s", e)
+        return False
+    log.info("catalog reloaded: %d products", count)
+    return True
+
+
+# ---------------------------------------------------------
+# Lookups
+# ---------------------------------------------------------
+
+def get(payload):
+    return _products.get(payload)
+
+
+def invoice_products():
+    return _invoice
+
+
+def main(argv):
+    path = argv[0] if argv else CATALOG_PATH
+    try:
+        load(path)
+    except (OSError, ValueError) as e:
+        print(e)
+        return 1
+    for p in _products.values():
+        sold = "invoice" if p.invoice else "balance"
+        print(f"{p.payload:<18} {p.feature:<16} {p.price:>6}⭐  {sold:<8} {p.days or '':>5}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,6 +1,7 @@
 # config.py — Telegram Stars version (FINAL)
 
 import os
+import socket
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -8,18 +9,35 @@ load_dotenv()
 # BOT TOKEN from .env
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
+# Webhook mode (unset WEBHOOK_URL = long polling)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")          # public https base, e.g. https://bot.example.com
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")    # default: derived from BOT_TOKEN
+WEBHOOK_PATH = "/telegram"
+PORT = int(os.getenv("PORT", "8080"))
+CONCURRENT_UPDATES = 64     # users whose updates are handled at once
+
+# Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics (0 = off)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
 # Database
-DB_PATH = "chatroulette.db"
+DB_PATH = os.getenv("DB_PATH", "chatroulette.db")
 
 # Matching
-MATCH_CHECK_INTERVAL = 1
-MAX_QUEUE_WAIT = 60
-
-# Premium feature star costs (what user spends)
-FEATURE_PRICES = {
-    "gender_filter": 5,
-    "region_filter": 3,
-    "priority": 2,
-    "instant_rematch": 1,
-    "vip_week": 10,
-}
+MATCH_COALESCE_WINDOW = 0.005   # seconds to batch queue events per matcher run
+MAX_QUEUE_WAIT = 60             # seconds; longer waiters pick a partner before anyone else
+INACTIVE_TIMEOUT = 180          # seconds without activity before a searcher leaves the queue
+RECENT_PARTNERS = 3             # last partners the matcher will not pick again...
+RECENT_PARTNER_TTL = 600        # ...for this many seconds; also the VIP rematch window
+
+# waiting is not activity: a searcher must outlast the cap to benefit from it
+if INACTIVE_TIMEOUT <= MAX_QUEUE_WAIT:
+    raise ValueError("INACTIVE_TIMEOUT must be longer than MAX_QUEUE_WAIT")
+
+# Several workers (unset REDIS_URL = one process, nothing shared)
+REDIS_URL = os.getenv("REDIS_URL")
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TTL = 10       # seconds; the matcher lease is renewed every LEASE_TTL / 3
+
+# Products and prices (catalog.py; reloaded on SIGHUP)
+CATALOG_PATH = os.getenv("CATALOG_PATH", "catalog.json")
@@ -0,0 +1,185 @@
+# coordination.py — shared state for running several bot workers
+#
+# Any worker can take any update. Exactly one of them holds the "matcher"
+# lease and owns the in-memory MatchQueue; the others forward their queue
+# operations to it as events. Chat sessions (state, partner) live in the
+# backend too, so whichever worker receives a message can relay it.
+#
+# MemoryBackend  — single process (the default, and the local stand-in
+#                  for tests); leases and events never leave the process.
+# RedisBackend   — several processes/hosts. Works with any redis.asyncio
+#                  compatible client, e.g. a local redis-server or
+#                  fakeredis.aioredis.FakeRedis() for tests.
+#
+# The SQLite file is still the durable store, so workers must share it.
+
+import asyncio
+import json
+from collections import deque
+from time import monotonic
+
+from config import REDIS_URL
+
+try:
+    import redis.asyncio as aioredis
+    from redis.exceptions import WatchError
+except ImportError:      # only needed when REDIS_URL is set
+    aioredis = None
+    WatchError = None
+
+MATCHER_LEASE = "matcher"
+EVENT_BATCH = 500
+
+
+class MemoryBackend:
+    shared = False
+
+    def __init__(self):
+        self._leases = {}           # name -> (owner, expires_at)
+        self._events = deque()
+        self._has_events = asyncio.Event()
+        self._sessions = {}
+
+    # ---- leases ----
+
+    async def hold_lease(self, name, owner, ttl):
+        """
+        Takes the lease if free/expired, renews it if we hold it.
+        """
+        now = monotonic()
+        holder = self._leases.get(name)
+        if holder and holder[0] != owner and holder[1] > now:
+            return False
+        self._leases[name] = (owner, now + ttl)
+        return True
+
+    async def release_lease(self, name, owner):
+        holder = self._leases.get(name)
+        if holder and holder[0] == owner:
+            del self._leases[name]
+
+    # ---- queue events ----
+
+    async def push_event(self, event):
+        self._events.append(event)
+        self._has_events.set()
+
+    async def pop_events(self, limit=EVENT_BATCH, timeout=1.0):
+        if not self._events:
+            self._has_events.clear()
+            try:
+                await asyncio.wait_for(self._has_events.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        batch = []
+        while self._events and len(batch) < limit:
+            batch.append(self._events.popleft())
+        return batch
+
+    # ---- sessions ----
+
+    async def set_sessions(self, sessions):
+        self._sessions.update(sessions)
+
+    async def get_session(self, user_id):
+        return self._sessions.get(user_id)
+
+    async def close(self):
+        pass
+
+
+class RedisBackend:
+    shared = True
+
+    def __init__(self, client, prefix="chatroulette"):
+        self._r = client
+        self._prefix = prefix
+        self._events_key = f"{prefix}:queue_events"
+        self._sessions_key = f"{prefix}:sessions"
+
+    @classmethod
+    def from_url(cls, url):
+        if aioredis is None:
+            raise RuntimeError("REDIS_URL is set but the 'redis' package is not installed")
+        return cls(aioredis.from_url(url, decode_responses=True))
+
+    def _lease_key(self, name):
+        return f"{self._prefix}:lease:{name}"
+
+    # ---- leases ----
+
+    async def hold_lease(self, name, owner, ttl):
+        key = self._lease_key(name)
+        ttl_ms = int(ttl * 1000)
+        if await self._r.set(key, owner, nx=True, px=ttl_ms):
+            return True
+
+        # renew only if it is still ours (WATCH makes check + PEXPIRE atomic)
+        async with self._r.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                if await pipe.get(key) != owner:
+                    await pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.pexpire(key, ttl_ms)
+                await pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    async def release_lease(self, name, owner):
+        key = self._lease_key(name)
+        async with self._r.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                if await pipe.get(key) != owner:
+                    await pipe.unwatch()
+                    return
+                pipe.multi()
+                pipe.delete(key)
+                await pipe.execute()
+            except WatchError:
+                pass
+
+    # ---- queue events ----
+
+    async def push_event(self, event):
+        await self._r.rpush(self._events_key, json.dumps(event))
+
+    async def pop_events(self, limit=EVENT_BATCH, timeout=1.0):
+        first = await self._r.blpop([self._events_key], timeout=timeout)
+        if not first:
+            return []
+        raw = [first[1]]
+        if limit > 1:
+            raw.extend(await self._r.lpop(self._events_key, limit - 1) or [])
+        return [json.loads(r) for r in raw]
+
+    # ---- sessions ----
+
+    async def set_sessions(self, sessions):
+        await self._r.hset(self._sessions_key, mapping={
+            user_id: f"{state or ''}|{partner or ''}"
+            for user_id, (state, partner) in sessions.items()
+        })
+
+    async def get_session(self, user_id):
+        raw = await self._r.hget(self._sessions_key, user_id)
+        if raw is None:
+            return None
+        state, partner = raw.split("|")
+        return (state or None, int(partner) if partner else None)
+
+    async def close(self):
+        close = getattr(self._r, "aclose", None) or self._r.close
+        await close()
+
+
+def get_backend():
+    if REDIS_URL:
+        return RedisBackend.from_url(REDIS_URL)
+    return MemoryBackend()
+
+
+backend = get_backend()
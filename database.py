@@ -1,6 +1,9 @@
 # database.py — SQLite database layer for ChatRoulette
 
 import sqlite3
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
 from time import time
 from config import DB_PATH
 
@@ -8,9 +11,73 @@ from config import DB_PATH
 # ---------------------------------------------------------
 # INTERNAL CONNECTION
 # ---------------------------------------------------------
+# One long-lived connection per thread instead of open/close per call.
+# WAL lets readers run next to the writer, synchronous=NORMAL drops the
+# fsync from every commit, and the statement cache keeps every query in
+# this module prepared.
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+STATEMENT_CACHE = 256
+
+_local = threading.local()
+_pool = []
+_pool_lock = threading.Lock()
+_generation = 0
+
 
 def _connect():
-    return sqlite3.connect(DB_PATH)
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.generation == _generation:
+        return conn
+
+    conn = sqlite3.connect(
+        DB_PATH,
+        cached_statements=STATEMENT_CACHE,
+        check_same_thread=False,
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+
+    _local.conn = conn
+    _local.generation = _generation
+    with _pool_lock:
+        _pool.append(conn)
+    return conn
+
+
+def close_db():
+    """
+    Closes every pooled connection (shutdown / tests).
+    Threads reconnect lazily on their next call.
+    """
+    global _generation
+    with _pool_lock:
+        for conn in _pool:
+            conn.close()
+        _pool.clear()
+        _generation += 1
+
+
+@contextmanager
+def transaction():
+    """
+    BEGIN IMMEDIATE … COMMIT on this thread's connection.
+    The write lock is taken up front, so read-check-write inside is atomic.
+    """
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
 
 
 # ---------------------------------------------------------
@@ -74,7 +141,133 @@ def init_db():
     """)
 
     conn.commit()
-    conn.close()
+    migrate()
+
+
+# ---------------------------------------------------------
+# SCHEMA MIGRATIONS
+# ---------------------------------------------------------
+# PRAGMA user_version = number of steps applied. Steps are append-only:
+# never edit a shipped one, add a new one at the end. init_db() creates
+# the original tables, migrate() brings any older file up to date.
+
+MIGRATIONS = [
+    # 1 — indexes for the hot queries
+    (
+        # get_queue / load_queue order, covering so the table isn't touched
+        "CREATE INDEX IF NOT EXISTS idx_queue_order ON queue (priority DESC, timestamp ASC, user_id)",
+        # inactivity scans
+        "CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active)",
+        # per-user history and time-range analytics
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user_time ON transactions (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_time ON transactions (timestamp)",
+    ),
+    # 2 — match preferences (NULL = no filter)
+    (
+        "ALTER TABLE users ADD COLUMN want_gender TEXT",
+        "ALTER TABLE users ADD COLUMN want_region TEXT",
+    ),
+    # 3 — append-only action log (events.py); no index, inserts stay cheap
+    (
+        """
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            action TEXT,
+            timestamp REAL
+        )
+        """,
+    ),
+    # 4 — session lifecycle (session_log.py) and hourly rollups
+    (
+        "ALTER TABLE sessions ADD COLUMN ended_at REAL",
+        "ALTER TABLE sessions ADD COLUMN end_reason TEXT",
+        "ALTER TABLE sessions ADD COLUMN messages1 INTEGER DEFAULT 0",
+        "ALTER TABLE sessions ADD COLUMN messages2 INTEGER DEFAULT 0",
+        # open sessions are found by either member
+        "CREATE INDEX IF NOT EXISTS idx_sessions_open_user1 ON sessions (user1) WHERE ended_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_open_user2 ON sessions (user2) WHERE ended_at IS NULL",
+        """
+        CREATE TABLE IF NOT EXISTS session_rollups (
+            hour INTEGER PRIMARY KEY,
+            sessions INTEGER DEFAULT 0,
+            duration_sum REAL DEFAULT 0,
+            messages INTEGER DEFAULT 0,
+            matches INTEGER DEFAULT 0,
+            match_wait_sum REAL DEFAULT 0
+        )
+        """,
+        # duration histogram per hour, for the median
+        """
+        CREATE TABLE IF NOT EXISTS session_duration_buckets (
+            hour INTEGER,
+            bucket INTEGER,
+            count INTEGER DEFAULT 0,
+            PRIMARY KEY (hour, bucket)
+        ) WITHOUT ROWID
+        """,
+    ),
+    # 5 — who a user last walked away from, for the VIP rematch
+    (
+        "ALTER TABLE users ADD COLUMN last_partner INTEGER",
+        "ALTER TABLE users ADD COLUMN last_partner_at REAL",
+    ),
+    # 6 — Stars ledger (ledger.py): balance after each entry, payment
+    # dedupe, append-only history, balance snapshots
+    (
+        "ALTER TABLE transactions ADD COLUMN balance INTEGER",
+        "ALTER TABLE transactions ADD COLUMN charge_id TEXT",
+        "ALTER TABLE transactions ADD COLUMN paid INTEGER DEFAULT 0",
+        # one entry per telegram_payment_charge_id
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_charge ON transactions (charge_id) WHERE charge_id IS NOT NULL",
+        # a user's entries after a given id (the implicit rowid column)
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions (user_id)",
+        """
+        CREATE TRIGGER IF NOT EXISTS transactions_no_update BEFORE UPDATE ON transactions
+        BEGIN SELECT RAISE(ABORT, 'transactions is append-only'); END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS transactions_no_delete BEFORE DELETE ON transactions
+        BEGIN SELECT RAISE(ABORT, 'transactions is append-only'); END
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS balance_snapshots (
+            user_id INTEGER,
+            txn_id INTEGER,
+            balance INTEGER,
+            timestamp INTEGER,
+            PRIMARY KEY (user_id, txn_id)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_balance_snapshots_txn ON balance_snapshots (txn_id)",
+        # the history so far is trusted as it stands: users.stars is the
+        # starting point of every later audit
+        """
+        INSERT INTO balance_snapshots (user_id, txn_id, balance, timestamp)
+        SELECT id, (SELECT COALESCE(MAX(id), 0) FROM transactions), stars, CAST(strftime('%s') AS INTEGER)
+        FROM users WHERE stars != 0 OR id IN (SELECT user_id FROM transactions)
+        """,
+    ),
+]
+
+
+def schema_version():
+    conn = _connect()
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate():
+    """
+    Applies every pending step, each in its own transaction together
+    with the user_version bump.
+    """
+    version = schema_version()
+
+    for number in range(version + 1, len(MIGRATIONS) + 1):
+        with transaction() as cur:
+            for sql in MIGRATIONS[number - 1]:
+                cur.execute(sql)
+            cur.execute(f"PRAGMA user_version = {number}")
 
 
 # ---------------------------------------------------------
@@ -89,18 +282,18 @@ def create_user(user_id):
         (user_id, int(time()))
     )
     conn.commit()
-    conn.close()
 
 
-def update_last_active(user_id):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE users SET last_active=? WHERE id=?",
-        (int(time()), user_id)
-    )
-    conn.commit()
-    conn.close()
+def save_last_active(rows):
+    """
+    rows: [(last_active, user_id)] — presence.py's batch, one transaction.
+    Never moves last_active back (another worker may have seen them later).
+    """
+    with transaction() as cur:
+        cur.executemany(
+            "UPDATE users SET last_active=?1 WHERE id=?2 AND (last_active IS NULL OR last_active < ?1)",
+            rows
+        )
 
 
 def get_last_active(user_id):
@@ -108,19 +301,26 @@ def get_last_active(user_id):
     cur = conn.cursor()
     cur.execute("SELECT last_active FROM users WHERE id=?", (user_id,))
     row = cur.fetchone()
-    conn.close()
     return row[0] if row else 0
 
 
+def get_last_active_many(user_ids):
+    """
+    {user_id: last_active} for the given users, one query.
+    """
+    user_ids = list(user_ids)
+    conn = _connect()
+    return dict(conn.execute(
+        f"SELECT id, last_active FROM users WHERE id IN ({','.join('?' * len(user_ids))})",
+        user_ids
+    ).fetchall())
+
+
 def update_user_state(user_id, state):
     conn = _connect()
     cur = conn.cursor()
-    cur.execute(
-        "UPDATE users SET state=?, last_active=? WHERE id=?",
-        (state, int(time()), user_id)
-    )
+    cur.execute("UPDATE users SET state=? WHERE id=?", (state, user_id))
     conn.commit()
-    conn.close()
 
 
 def get_user_state(user_id):
@@ -128,10 +328,32 @@ def get_user_state(user_id):
     cur = conn.cursor()
     cur.execute("SELECT state FROM users WHERE id=?", (user_id,))
     row = cur.fetchone()
-    conn.close()
     return row[0] if row else None
 
 
+def get_session(user_id):
+    """
+    (state, partner_id) in one query, None for unknown users.
+    """
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute("SELECT state, partner_id FROM users WHERE id=?", (user_id,))
+    return cur.fetchone()
+
+
+def load_sessions():
+    """
+    Everyone not idle, for warming session_cache on startup.
+    """
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, state, partner_id FROM users
+        WHERE state IN ('searching', 'chatting')
+    """)
+    return cur.fetchall()
+
+
 # ---------------------------------------------------------
 # PARTNER SYSTEM
 # ---------------------------------------------------------
@@ -141,19 +363,118 @@ def set_partner(user_id, partner_id):
     cur = conn.cursor()
     cur.execute("UPDATE users SET partner_id=? WHERE id=?", (partner_id, user_id))
     conn.commit()
-    conn.close()
 
 
 def clear_partner(user_id):
     set_partner(user_id, None)
 
 
+def _pair(cur, u1, u2):
+    # Only pairs users who are both still searching; anything else
+    # (/stop, already matched elsewhere) leaves both rows untouched.
+    if u1 == u2:
+        return False
+    cur.execute(
+        "SELECT COUNT(*) FROM users WHERE id IN (?, ?) AND state='searching'",
+        (u1, u2)
+    )
+    if cur.fetchone()[0] != 2:
+        return False
+
+    cur.executemany(
+        "UPDATE users SET partner_id=?, state='chatting' WHERE id=?",
+        ((u2, u1), (u1, u2))
+    )
+    cur.execute("DELETE FROM queue WHERE user_id IN (?, ?)", (u1, u2))
+    return True
+
+
+def pair_users(u1, u2):
+    """
+    Links two searching users in one transaction (partners, 'chatting',
+    queue rows). Returns False and changes nothing if either of them is
+    no longer searching.
+    """
+    with transaction() as cur:
+        return _pair(cur, u1, u2)
+
+
+def link_pairs(pairs):
+    """
+    pair_users() for a whole matcher batch, one transaction.
+    Returns the pairs that were actually linked.
+    """
+    with transaction() as cur:
+        return [(u1, u2) for u1, u2 in pairs if _pair(cur, u1, u2)]
+
+
+def unpair(user_id):
+    """
+    Disconnects user_id in one transaction: user goes idle and leaves the
+    queue, their partner (if still linked back) goes idle too.
+    The partner is remembered as user_id's last_partner (see rematch()).
+    Returns the partner id, or None if nobody was linked back.
+    """
+    with transaction() as cur:
+        cur.execute("SELECT partner_id FROM users WHERE id=?", (user_id,))
+        row = cur.fetchone()
+        partner = row[0] if row else None
+
+        if partner and partner != user_id:
+            # whoever was left cannot rematch: it was not their choice
+            cur.execute(
+                "UPDATE users SET partner_id=NULL, state='idle', last_partner=NULL WHERE id=? AND partner_id=?",
+                (partner, user_id)
+            )
+            if cur.rowcount != 1:
+                partner = None      # stale link, they already moved on
+        else:
+            partner = None
+
+        if partner:
+            cur.execute(
+                "UPDATE users SET partner_id=NULL, state='idle', last_partner=?, last_partner_at=? WHERE id=?",
+                (partner, time(), user_id)
+            )
+        else:
+            cur.execute("UPDATE users SET partner_id=NULL, state='idle' WHERE id=?", (user_id,))
+        cur.execute("DELETE FROM queue WHERE user_id=?", (user_id,))
+    return partner
+
+
+def rematch(user_id, since):
+    """
+    Links user_id straight back to the partner they last left, if they
+    left after `since` and both are free (idle or searching).
+    One transaction; returns the partner id, or None and changes nothing.
+    """
+    with transaction() as cur:
+        cur.execute("SELECT last_partner, last_partner_at FROM users WHERE id=?", (user_id,))
+        row = cur.fetchone()
+        if not row or not row[0] or row[1] < since:
+            return None
+        partner = row[0]
+
+        cur.execute(
+            "SELECT COUNT(*) FROM users WHERE id IN (?, ?) AND partner_id IS NULL AND state IN ('idle', 'searching')",
+            (user_id, partner)
+        )
+        if cur.fetchone()[0] != 2:
+            return None
+
+        cur.executemany(
+            "UPDATE users SET partner_id=?, state='chatting', last_partner=NULL WHERE id=?",
+            ((partner, user_id), (user_id, partner))
+        )
+        cur.execute("DELETE FROM queue WHERE user_id IN (?, ?)", (user_id, partner))
+    return partner
+
+
 def get_partner(user_id):
     conn = _connect()
     cur = conn.cursor()
     cur.execute("SELECT partner_id FROM users WHERE id=?", (user_id,))
     row = cur.fetchone()
-    conn.close()
     return row[0] if row else None
 
 
@@ -166,7 +487,6 @@ def update_gender(user_id, gender):
     cur = conn.cursor()
     cur.execute("UPDATE users SET gender=? WHERE id=?", (gender, user_id))
     conn.commit()
-    conn.close()
 
 
 def update_region(user_id, region):
@@ -174,7 +494,6 @@ def update_region(user_id, region):
     cur = conn.cursor()
     cur.execute("UPDATE users SET region=? WHERE id=?", (region, user_id))
     conn.commit()
-    conn.close()
 
 
 def get_user_gender(user_id):
@@ -182,10 +501,36 @@ def get_user_gender(user_id):
     cur = conn.cursor()
     cur.execute("SELECT gender FROM users WHERE id=?", (user_id,))
     row = cur.fetchone()
-    conn.close()
     return row[0] if row else None
 
 
+def update_wanted_gender(user_id, gender):
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute("UPDATE users SET want_gender=? WHERE id=?", (gender, user_id))
+    conn.commit()
+
+
+def update_wanted_region(user_id, region):
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute("UPDATE users SET want_region=? WHERE id=?", (region, user_id))
+    conn.commit()
+
+
+def get_match_profile(user_id):
+    """
+    (gender, region, want_gender, want_region) or None.
+    """
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT gender, region, want_gender, want_region FROM users WHERE id=?",
+        (user_id,)
+    )
+    return cur.fetchone()
+
+
 # ---------------------------------------------------------
 # MATCHMAKING QUEUE
 # ---------------------------------------------------------
@@ -198,7 +543,6 @@ def add_to_queue(user_id, priority=0):
         (user_id, priority, int(time()))
     )
     conn.commit()
-    conn.close()
 
 
 def remove_from_queue(user_id):
@@ -206,7 +550,6 @@ def remove_from_queue(user_id):
     cur = conn.cursor()
     cur.execute("DELETE FROM queue WHERE user_id=?", (user_id,))
     conn.commit()
-    conn.close()
 
 
 def get_queue():
@@ -217,20 +560,190 @@ def get_queue():
         ORDER BY priority DESC, timestamp ASC
     """)
     rows = cur.fetchall()
-    conn.close()
     return [r[0] for r in rows]
 
 
-# ---------------------------------------------------------
-# SESSION LOG
-# ---------------------------------------------------------
+def load_queue():
+    """
+    Queue snapshot for match_queue on startup: [(user_id, gender, region,
+    want_gender, want_region, priority, timestamp)] in queue order.
+    """
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT q.user_id, u.gender, u.region, u.want_gender, u.want_region,
+               q.priority, q.timestamp
+        FROM queue q JOIN users u ON u.id = q.user_id
+        WHERE u.state = 'searching'
+        ORDER BY q.priority DESC, q.timestamp ASC
+    """)
+    return cur.fetchall()
 
-def create_session(user1, user2):
+
+def sweep_queue():
+    """
+    One pass over the queue for the cleaner:
+    [(user_id, reason)] with reason 'chatting' | 'broken'.
+    (Inactive searchers time out in presence.py.)
+    """
     conn = _connect()
     cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO sessions (user1, user2, started_at) VALUES (?, ?, ?)",
-        (user1, user2, int(time()))
+    cur.execute("""
+        SELECT q.user_id,
+            CASE
+                WHEN u.state = 'chatting' THEN 'chatting'
+                WHEN u.partner_id IS NOT NULL AND p.user_id IS NULL THEN 'broken'
+            END AS reason
+        FROM queue q
+        JOIN users u ON u.id = q.user_id
+        LEFT JOIN queue p ON p.user_id = u.partner_id
+        WHERE reason IS NOT NULL
+    """)
+    return cur.fetchall()
+
+
+def save_queue_snapshot(upserts, deletes):
+    """
+    Write-behind flush from match_queue, one transaction.
+    """
+    conn = _connect()
+    cur = conn.cursor()
+    cur.executemany(
+        "INSERT OR REPLACE INTO queue (user_id, priority, timestamp) VALUES (?, ?, ?)",
+        upserts
     )
+    cur.executemany("DELETE FROM queue WHERE user_id=?", [(u,) for u in deletes])
     conn.commit()
-    conn.close()
+
+
+# ---------------------------------------------------------
+# ACTION LOG
+# ---------------------------------------------------------
+
+def log_events(rows):
+    """
+    rows: [(user_id, action, timestamp)] — one transaction per batch.
+    """
+    with transaction() as cur:
+        cur.executemany("INSERT INTO events (user_id, action, timestamp) VALUES (?, ?, ?)", rows)
+
+
+# ---------------------------------------------------------
+# SESSION LOG
+# ---------------------------------------------------------
+# Hourly rollups are updated in the same transaction as the sessions
+# they count, so dashboards never scan the sessions table.
+
+DURATION_BUCKETS = (10, 30, 60, 120, 300, 600, 1800, 3600, 7200)   # seconds, upper bounds
+
+
+def _hour(timestamp):
+    return int(timestamp // 3600 * 3600)
+
+
+def _roll_up_session(cur, ended_at, duration, messages):
+    hour = _hour(ended_at)
+    cur.execute("""
+        INSERT INTO session_rollups (hour, sessions, duration_sum, messages) VALUES (?, 1, ?, ?)
+        ON CONFLICT (hour) DO UPDATE SET
+            sessions = sessions + 1,
+            duration_sum = duration_sum + excluded.duration_sum,
+            messages = messages + excluded.messages
+    """, (hour, duration, messages))
+    cur.execute("""
+        INSERT INTO session_duration_buckets (hour, bucket, count) VALUES (?, ?, 1)
+        ON CONFLICT (hour, bucket) DO UPDATE SET count = count + 1
+    """, (hour, bisect_left(DURATION_BUCKETS, duration)))
+
+
+def record_sessions(started, messages, ended):
+    """
+    One transaction for a batch from session_log:
+      started:  [(user1, user2, started_at, wait1, wait2, ended_at, reason, messages1, messages2)]
+                sessions that began in this batch (ended_at None = still open)
+      messages: {user_id: count} for sessions opened in an earlier batch
+      ended:    [(user_id, ended_at, reason)] for sessions opened earlier
+    Earlier sessions get their messages before they are closed.
+    """
+    with transaction() as cur:
+        for user_id, count in messages.items():
+            cur.execute("UPDATE sessions SET messages1 = messages1 + ? WHERE user1=? AND ended_at IS NULL", (count, user_id))
+            cur.execute("UPDATE sessions SET messages2 = messages2 + ? WHERE user2=? AND ended_at IS NULL", (count, user_id))
+
+        for user_id, ended_at, reason in ended:
+            for row in cur.execute("""
+                SELECT session_id, started_at, messages1 + messages2 FROM sessions
+                WHERE user1=? AND ended_at IS NULL
+                UNION ALL
+                SELECT session_id, started_at, messages1 + messages2 FROM sessions
+                WHERE user2=? AND ended_at IS NULL
+            """, (user_id, user_id)).fetchall():
+                session_id, started_at, count = row
+                cur.execute(
+                    "UPDATE sessions SET ended_at=?, end_reason=? WHERE session_id=?",
+                    (ended_at, reason, session_id)
+                )
+                _roll_up_session(cur, ended_at, ended_at - started_at, count)
+
+        for user1, user2, started_at, wait1, wait2, ended_at, reason, m1, m2 in started:
+            # a row left open by a crash must not soak up the new session's messages
+            for column in ("user1", "user2"):
+                cur.execute(
+                    f"UPDATE sessions SET ended_at=started_at, end_reason='lost' "
+                    f"WHERE {column} IN (?, ?) AND ended_at IS NULL",
+                    (user1, user2)
+                )
+            cur.execute("""
+                INSERT INTO sessions (user1, user2, started_at, ended_at, end_reason, messages1, messages2)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (user1, user2, started_at, ended_at, reason, m1, m2))
+            cur.execute("""
+                INSERT INTO session_rollups (hour, matches, match_wait_sum) VALUES (?, 1, ?)
+                ON CONFLICT (hour) DO UPDATE SET
+                    matches = matches + 1,
+                    match_wait_sum = match_wait_sum + excluded.match_wait_sum
+            """, (_hour(started_at), (wait1 + wait2) / 2))
+            if ended_at is not None:
+                _roll_up_session(cur, ended_at, ended_at - started_at, m1 + m2)
+
+
+def hourly_session_stats(since):
+    """
+    Dashboard read, from the rollups only: [(hour, sessions, median_duration,
+    avg_duration, messages_per_session, avg_match_wait)] for hours >= since.
+    The median is the upper bound of the bucket that holds it.
+    """
+    conn = _connect()
+    buckets = {}
+    for hour, bucket, count in conn.execute(
+        "SELECT hour, bucket, count FROM session_duration_buckets WHERE hour >= ? ORDER BY hour, bucket",
+        (_hour(since),)
+    ):
+        buckets.setdefault(hour, []).append((bucket, count))
+
+    stats = []
+    for hour, sessions, duration_sum, messages, matches, wait_sum in conn.execute(
+        """
+        SELECT hour, sessions, duration_sum, messages, matches, match_wait_sum
+        FROM session_rollups WHERE hour >= ? ORDER BY hour
+        """,
+        (_hour(since),)
+    ):
+        stats.append((
+            hour,
+            sessions,
+            _median_bucket(buckets.get(hour, []), sessions),
+            duration_sum / sessions if sessions else None,
+            messages / sessions if sessions else None,
+            wait_sum / matches if matches else None,
+        ))
+    return stats
+
+
+def _median_bucket(buckets, total):
+    seen = 0
+    for bucket, count in buckets:
+        seen += count
+        if 2 * seen >= total:
+            return DURATION_BUCKETS[bucket] if bucket < len(DURATION_BUCKETS) else float("inf")
+    return None
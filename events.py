@@ -0,0 +1,26 @@
+# events.py — buffered action log (search / match / disconnect ...)
+#
+# register_action() only appends to a write-behind buffer (write_behind.py),
+# so the match path never waits for a commit. flush_loop() writes it to
+# the append-only `events` table with one executemany transaction every
+# FLUSH_INTERVAL seconds, or as soon as FLUSH_BATCH actions are waiting.
+
+from time import time
+
+from async_database import log_events
+from write_behind import WriteBehind
+import metrics
+
+FLUSH_INTERVAL = 0.5        # seconds
+
+_buffer = WriteBehind(
+    log_events, FLUSH_INTERVAL, "events",
+    dropped=metrics.events_dropped, written=metrics.events_written,
+)
+
+flush = _buffer.flush
+flush_loop = _buffer.flush_loop
+
+
+def register_action(user_id, action):
+    _buffer.append((user_id, action, time()))
@@ -1,8 +1,9 @@
 # features.py — premium feature logic (final stable version)
 
-from database import add_to_queue, update_user_state
+from async_database import run_write
+from database import update_wanted_gender, update_wanted_region
+from matchmaking import enqueue, prepare_for_search, VIP_PRIORITY
 from premium_logic import has_vip, charge_stars
-from config import FEATURE_PRICES
 
 
 # ------------------------------------
@@ -13,16 +14,15 @@ def apply_gender_filter(user_id, target_gender):
     """
     If VIP → free.
     If not VIP → charges stars.
+    Saves the filter for matching (None = anyone).
     Returns dict: {success: bool, gender: str}
     """
 
-    if has_vip(user_id):
-        return {"success": True, "gender": target_gender}
-
-    if charge_stars(user_id, "gender_filter"):
-        return {"success": True, "gender": target_gender}
+    if not has_vip(user_id) and not charge_stars(user_id, "gender_filter"):
+        return {"success": False, "error": "not_enough_stars"}
 
-    return {"success": False, "error": "not_enough_stars"}
+    update_wanted_gender(user_id, target_gender)
+    return {"success": True, "gender": target_gender}
 
 
 # ------------------------------------
@@ -33,33 +33,34 @@ def apply_region_filter(user_id, target_region):
     """
     Same logic as gender filter.
     """
-    if has_vip(user_id):
-        return {"success": True, "region": target_region}
-
-    if charge_stars(user_id, "region_filter"):
-        return {"success": True, "region": target_region}
+    if not has_vip(user_id) and not charge_stars(user_id, "region_filter"):
+        return {"success": False, "error": "not_enough_stars"}
 
-    return {"success": False, "error": "not_enough_stars"}
+    update_wanted_region(user_id, target_region)
+    return {"success": True, "region": target_region}
 
 
 # ------------------------------------
 # 3. Priority Queue
 # ------------------------------------
 
-def enter_priority_queue(user_id):
+async def enter_priority_queue(user_id):
     """
     VIP = priority 10 (top).
     Normal user = priority 5 (paid).
     """
     if has_vip(user_id):
-        priority = 10
+        priority = VIP_PRIORITY
     else:
-        if not charge_stars(user_id, "priority"):
+        if not await run_write(charge_stars, user_id, "priority"):
             return {"success": False, "error": "not_enough_stars"}
         priority = 5
 
-    add_to_queue(user_id, priority)
-    update_user_state(user_id, "searching")
+    # "searching" is committed before the queue op, as for /search: a
+    # matcher run (maybe on another worker) must not find us queued but
+    # not searching
+    await prepare_for_search(user_id)
+    await enqueue(user_id, priority)
 
     return {"success": True, "priority": priority}
 
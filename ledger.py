@@ -0,0 +1,151 @@
+# ledger.py — Stars ledger: atomic debits, idempotent payments, snapshots
+#
+# users.stars is the balance (a primary-key read); the transactions table
+# is the append-only history behind it. Every change goes through
+# append(), which moves the balance with one conditional UPDATE and
+# writes the entry, with the balance it left, in the same transaction. A
+# debit that would go below zero changes nothing, so two purchases racing
+# for the last stars cannot both pass.
+#
+# Telegram payments are written with their telegram_payment_charge_id
+# under a unique index: a redelivered successful_payment is recognised
+# and applied once.
+#
+# snapshot_balances() (hourly, bot.py) stores every balance that changed
+# together with the last entry it covers. audit() checks users.stars
+# against the latest snapshot plus the entries after it, so an audit
+# reads the tail of the history instead of all of it.
+
+import time
+
+from database import _connect, transaction
+
+SNAPSHOT_INTERVAL = 3600    # seconds
+
+
+# ---------------------------------------------------------
+# Entries
+# ---------------------------------------------------------
+
+def append(cur, user_id, amount, feature, charge_id=None, paid=0):
+    """
+    Moves users.stars by `amount` and writes the entry, on the caller's
+    transaction. Returns False, writing nothing, when a debit would take
+    the balance below zero or charge_id was already recorded.
+    """
+    if charge_id is not None and cur.execute(
+        "SELECT 1 FROM transactions WHERE charge_id=?", (charge_id,)
+    ).fetchone():
+        return False
+
+    if amount:
+        # check and debit in one statement: nothing can slip in between
+        row = cur.execute(
+            "UPDATE users SET stars = stars + ?1 WHERE id=?2 AND stars + ?1 >= 0 RETURNING stars",
+            (amount, user_id)
+        ).fetchone()
+        if row is None:
+            return False
+    else:
+        row = cur.execute("SELECT stars FROM users WHERE id=?", (user_id,)).fetchone()
+
+    cur.execute("""
+        INSERT INTO transactions (user_id, amount, feature, timestamp, balance, charge_id, paid)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (user_id, amount, feature, int(time.time()), row[0] if row else 0, charge_id, paid))
+    return True
+
+
+def credit(user_id, amount, feature="stars_added", charge_id=None, paid=0):
+    with transaction() as cur:
+        return append(cur, user_id, amount, feature, charge_id, paid)
+
+
+def debit(user_id, amount, feature):
+    """
+    Takes `amount` stars if the user has them. Returns whether it did.
+    """
+    with transaction() as cur:
+        return append(cur, user_id, -amount, feature)
+
+
+def record(user_id, feature):
+    # zero-amount entry (unlocks, VIP grants)
+    with transaction() as cur:
+        append(cur, user_id, 0, feature)
+
+
+def record_payment(user_id, feature, charge_id, paid):
+    """
+    A Telegram payment that moves no stars. False if it was already recorded.
+    """
+    with transaction() as cur:
+        return append(cur, user_id, 0, feature, charge_id, paid)
+
+
+def balance(user_id):
+    conn = _connect()
+    row = conn.execute("SELECT stars FROM users WHERE id=?", (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+# ---------------------------------------------------------
+# Snapshots and audits
+# ---------------------------------------------------------
+
+def _covered(cur):
+    return cur.execute("SELECT COALESCE(MAX(txn_id), 0) FROM balance_snapshots").fetchone()[0]
+
+
+def snapshot_balances(now=None):
+    """
+    Snapshots every user with entries since the last run, as of their
+    latest entry. Returns the number of snapshots taken.
+    """
+    now = int(time.time()) if now is None else now
+    with transaction() as cur:
+        # under the write lock users.stars is exactly the balance after MAX(t.id)
+        cur.execute("""
+            INSERT OR IGNORE INTO balance_snapshots (user_id, txn_id, balance, timestamp)
+            SELECT t.user_id, MAX(t.id), COALESCE(u.stars, 0), ?
+            FROM transactions t LEFT JOIN users u ON u.id = t.user_id
+            WHERE t.id > ?
+            GROUP BY t.user_id
+        """, (now, _covered(cur)))
+        return cur.rowcount
+
+
+def audit(user_ids=None):
+    """
+    Replays each user's entries since their latest snapshot onto it and
+    compares the result with users.stars (default: every user with a
+    balance or a ledger entry). Returns [(user_id, ledger, stars)] for
+    every mismatch.
+    """
+    conn = _connect()
+    conn.execute("BEGIN")       # one read snapshot for the whole audit
+    try:
+        if user_ids is None:
+            user_ids = [row[0] for row in conn.execute("""
+                SELECT id FROM users WHERE stars != 0
+                UNION SELECT user_id FROM balance_snapshots
+                UNION SELECT user_id FROM transactions WHERE id > ?
+            """, (_covered(conn),))]
+
+        mismatches = []
+        for user_id in user_ids:
+            txn_id, start = conn.execute("""
+                SELECT txn_id, balance FROM balance_snapshots
+                WHERE user_id=? ORDER BY txn_id DESC LIMIT 1
+            """, (user_id,)).fetchone() or (0, 0)
+            tail = conn.execute(
+                "SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE user_id=? AND id > ?",
+                (user_id, txn_id)
+            ).fetchone()[0]
+            stars = conn.execute("SELECT stars FROM users WHERE id=?", (user_id,)).fetchone()
+            stars = stars[0] if stars else 0
+            if start + tail != stars:
+                mismatches.append((user_id, start + tail, stars))
+        return mismatches
+    finally:
+        conn.rollback()
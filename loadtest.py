@@ -0,0 +1,570 @@
+# loadtest.py — end-to-end load tests against a local fake Bot API
+#
+# Usage:
+#   python loadtest.py                     (polling vs webhook, one subprocess each)
+#   python loadtest.py webhook --updates 5000 --users 5000 --concurrency 64
+#   python loadtest.py scenario --users 2000 --json run.json --baseline last.json
+#
+# polling / webhook:
+# Runs bot.build_application() with the real handlers against a local
+# fake Bot API (aiohttp), delivers synthetic /start updates and times each
+# one from delivery (POST to the webhook, or handed to getUpdates) until
+# the bot's reply reaches the fake API. Uses a throwaway database in a
+# temp dir, never chatroulette.db.
+#
+# --api-latency stands in for the round trip to api.telegram.org (the fake
+# answers in well under a millisecond otherwise); it is what concurrent
+# handling overlaps, so keep it realistic when comparing modes.
+#
+# scenario: capacity run in one process. N simulated users /start, pick a
+# gender, some pay for VIP, then do search → chat → next cycles through
+# the real handlers. Reports matches/sec, relay latency percentiles, SQL
+# statements per update and memory per user; --json saves the numbers,
+# --baseline prints the change against an earlier file.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+from collections import Counter, deque
+from itertools import count
+from time import perf_counter, time
+
+_TMP = tempfile.mkdtemp(prefix="chatroulette-load-")
+os.environ["DB_PATH"] = os.path.join(_TMP, "load.db")
+
+from aiohttp import ClientSession, web  # noqa: E402
+from telegram import Update  # noqa: E402
+
+TOKEN = "123456:LOADTEST"
+SECRET = "loadtest-secret"
+WEBHOOK_PATH = "/telegram"
+MODES = ("polling", "webhook")
+SCENARIO = "scenario"
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+def _message(message_id, user_id, **fields):
+    return {
+        "message_id": message_id,
+        "date": int(time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        **fields,
+    }
+
+
+def command_update(update_id, user_id, text="/start"):
+    entity = {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+    return {"update_id": update_id, "message": _message(update_id, user_id, text=text, entities=[entity])}
+
+
+def text_update(update_id, user_id, text):
+    return {"update_id": update_id, "message": _message(update_id, user_id, text=text)}
+
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": _message(update_id, user_id, text="menu"),
+        },
+    }
+
+
+def payment_update(update_id, user_id, payload="vip_7", stars=50):
+    payment = {
+        "currency": "XTR",
+        "total_amount": stars,
+        "invoice_payload": payload,
+        "telegram_payment_charge_id": f"charge-{update_id}",
+        "provider_payment_charge_id": "",
+    }
+    return {"update_id": update_id, "message": _message(update_id, user_id, successful_payment=payment)}
+
+
+# ---------------------------------------------------------
+# Fake Bot API
+# ---------------------------------------------------------
+
+class FakeBotAPI:
+    """
+    Just enough of api.telegram.org for the bot to start, poll and reply.
+    Every sendMessage closes the oldest open delivery for that chat.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.latencies = []
+        self._pending = deque()         # updates waiting for getUpdates
+        self._has_updates = asyncio.Event()
+        self._delivered = {}            # chat_id -> deque[delivery time]
+        self._open = 0
+        self._all_replied = asyncio.Event()
+        self._message_ids = count(1)
+        self.port = _free_port()
+        self.on_message = None          # callback(chat_id, text) for every sendMessage
+        self.relay_sent = {}            # (from_chat_id, message_id) -> delivery time
+        self.relay_latencies = []
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._call)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    # ---- bookkeeping ----
+
+    def delivered(self, update):
+        chat_id = update["message"]["chat"]["id"]
+        self._delivered.setdefault(chat_id, deque()).append(perf_counter())
+        self._open += 1
+        self._all_replied.clear()
+
+    def queue_update(self, update):
+        self.delivered(update)
+        self._pending.append(update)
+        self._has_updates.set()
+
+    async def wait_replies(self, timeout):
+        await asyncio.wait_for(self._all_replied.wait(), timeout)
+
+    # ---- API methods ----
+
+    async def _call(self, request):
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+
+        if self.latency and method != "getupdates":
+            await asyncio.sleep(self.latency)
+        handler = getattr(self, f"_api_{method}", None)
+        result = await handler(params) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _api_getme(self, params):
+        return {"id": 1, "is_bot": True, "first_name": "ChatRoulette", "username": "loadtest_bot"}
+
+    async def _api_getupdates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        while self._pending and self._pending[0]["update_id"] < offset:
+            self._pending.popleft()
+
+        if not self._pending:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                return []
+        return [u for _, u in zip(range(limit), self._pending)]
+
+    async def _api_sendmessage(self, params):
+        chat_id = int(params["chat_id"])
+        sent = self._delivered.get(chat_id)
+        if sent:
+            self.latencies.append(perf_counter() - sent.popleft())
+            self._open -= 1
+            if not self._open:
+                self._all_replied.set()
+        if self.on_message:
+            self.on_message(chat_id, params.get("text", ""))
+        return self._bot_message(chat_id, params.get("text", ""))
+
+    async def _api_editmessagetext(self, params):
+        return self._bot_message(int(params["chat_id"]), params.get("text", ""))
+
+    async def _api_copymessage(self, params):
+        sent = self.relay_sent.pop((int(params["from_chat_id"]), int(params["message_id"])), None)
+        if sent is not None:
+            self.relay_latencies.append(perf_counter() - sent)
+        return {"message_id": next(self._message_ids)}
+
+    def _bot_message(self, chat_id, text):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        }
+
+
+# ---------------------------------------------------------
+# One run
+# ---------------------------------------------------------
+# The bot runs in its own process, started through the same entry points
+# as production (run_polling / run_webhook), so the harness and the fake
+# API never compete with it for the event loop.
+
+async def _start_bot(mode, api, port):
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, __file__, "--bot", mode, "--api", api.base_url, "--port", str(port),
+    )
+    # ready once it polls (polling) or accepts connections (webhook)
+    while True:
+        if proc.returncode is not None:
+            raise SystemExit(f"bot process exited with {proc.returncode}")
+        if mode == "polling" and api.calls["getupdates"]:
+            return proc
+        if mode == "webhook" and api.calls["getme"]:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.close()
+                return proc
+            except OSError:
+                pass
+        await asyncio.sleep(0.05)
+
+
+async def _post_updates(url, updates, concurrency, api):
+    gate = asyncio.Semaphore(concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+
+    async with ClientSession() as session:
+        async with session.post(url, json=updates[0]) as resp:
+            assert resp.status == 403, "webhook accepted an update without the secret"
+
+        async def post(update):
+            async with gate:
+                api.delivered(update)
+                async with session.post(url, json=update, headers=headers) as resp:
+                    resp.raise_for_status()
+
+        await asyncio.gather(*(post(u) for u in updates))
+
+
+async def run(mode, updates, users, concurrency, api_latency, timeout=300):
+    api = FakeBotAPI(api_latency)
+    await api.start()
+    port = _free_port()
+    bot = await _start_bot(mode, api, port)
+
+    batch = [command_update(i + 1, 10_000 + i % users) for i in range(updates)]
+
+    start = perf_counter()
+    if mode == "webhook":
+        await _post_updates(f"http://127.0.0.1:{port}{WEBHOOK_PATH}", batch, concurrency, api)
+    else:
+        for update in batch:
+            api.queue_update(update)
+    await api.wait_replies(timeout)
+    seconds = perf_counter() - start
+
+    bot.terminate()
+    await bot.wait()
+    await api.stop()
+
+    lat = api.latencies
+    print(
+        f"{mode:<8} {updates:>7} updates  {seconds:7.2f}s  {updates / seconds:>8,.0f} updates/sec  "
+        f"latency p50 {_percentile(lat, 0.5) * 1000:7.1f}ms  p99 {_percentile(lat, 0.99) * 1000:7.1f}ms"
+    )
+
+
+def serve_bot(mode, api_url, port):
+    """
+    Child process: the real bot against the fake API (and a temp DB).
+    """
+    import database
+    from bot import build_application
+    from webhook import run_webhook
+
+    database.init_db()
+    app = build_application(token=TOKEN, webhook=(mode == "webhook"), base_url=api_url)
+    if mode == "webhook":
+        run_webhook(app, None, SECRET, WEBHOOK_PATH, listen="127.0.0.1", port=port)
+    else:
+        app.run_polling(poll_interval=0, timeout=10)
+
+
+# ---------------------------------------------------------
+# Scenario (capacity run, one process)
+# ---------------------------------------------------------
+
+PARTNER_LEFT = "⚠️ Собеседник отключился."
+
+_sql_lock = threading.Lock()
+_sql_statements = 0
+
+
+def _count_sql(statement):
+    global _sql_statements
+    if not statement.startswith("PRAGMA"):
+        with _sql_lock:
+            _sql_statements += 1
+
+
+def _trace_sqlite():
+    """
+    Every SQLite connection opened from now on counts its statements.
+    """
+    connect = sqlite3.connect
+
+    def traced_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(_count_sql)
+        return conn
+
+    sqlite3.connect = traced_connect
+
+
+def _rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Simulation:
+    def __init__(self, app, api, think, match_timeout):
+        from matchmaking import MATCH_TEXT
+
+        self.app = app
+        self.api = api
+        self.think = think
+        self.match_timeout = match_timeout
+        self.match_text = MATCH_TEXT
+        self.ids = count(1)
+        self.updates = 0
+        self.errors = 0
+        self.matches = 0
+        self.timeouts = 0
+        self.relays_sent = 0
+        self.first_search = None
+        self.last_match = None
+        self._matched = {}          # user_id -> Event, set by the match notice
+        self._left = set()          # users whose partner disconnected
+        api.on_message = self._on_message
+
+    def _on_message(self, chat_id, text):
+        if text == self.match_text:
+            self.matches += 1
+            self.last_match = perf_counter()
+            self._matched[chat_id].set()
+        elif text == PARTNER_LEFT:
+            self._left.add(chat_id)
+
+    async def on_error(self, update, context):
+        self.errors += 1
+
+    async def send(self, data):
+        self.updates += 1
+        await self.app.update_queue.put(Update.de_json(data, self.app.bot))
+
+    async def search(self, user_id, command):
+        matched = self._matched.setdefault(user_id, asyncio.Event())
+        matched.clear()
+        self._left.discard(user_id)
+        if self.first_search is None:
+            self.first_search = perf_counter()
+        await self.send(command_update(next(self.ids), user_id, command))
+        try:
+            await asyncio.wait_for(matched.wait(), self.match_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return False
+
+    async def user(self, user_id, cycles, messages, pays, delay=0.0):
+        await asyncio.sleep(delay)
+        gender = ("set_gender_male", "set_gender_female")[user_id % 2]
+        await self.send(command_update(next(self.ids), user_id, "/start"))
+        await self.send(callback_update(next(self.ids), user_id, gender))
+        if pays:
+            await self.send(payment_update(next(self.ids), user_id))
+
+        command = "/search"
+        for _ in range(cycles):
+            if not await self.search(user_id, command):
+                break
+            for _ in range(messages):
+                await asyncio.sleep(random.uniform(0, 2 * self.think))
+                if user_id in self._left:
+                    break
+                message_id = next(self.ids)
+                self.api.relay_sent[(user_id, message_id)] = perf_counter()
+                self.relays_sent += 1
+                await self.send(text_update(message_id, user_id, "привет"))
+            command = "/search" if user_id in self._left else "/next"
+
+        await self.send(command_update(next(self.ids), user_id, "/stop"))
+
+
+def _unthrottle_outbox(workers=64):
+    # The fake API has no rate limits: measure the bot, not Telegram's
+    # caps. More workers too, or 8 × api-latency becomes the ceiling.
+    import outbox
+
+    outbox.CHAT_RATE = outbox.CHAT_BURST = 1e9
+    outbox.outbox._global = outbox.TokenBucket(1e9, 1e9)
+    outbox.outbox._workers = workers
+
+
+async def run_scenario(users, cycles, messages, vip_share, think, ramp, match_timeout, api_latency, telegram_limits):
+    import database
+    from bot import build_application
+    from outbox import outbox
+
+    _trace_sqlite()
+    database.init_db()
+    if not telegram_limits:
+        _unthrottle_outbox()
+
+    api = FakeBotAPI(api_latency)
+    await api.start()
+    app = build_application(token=TOKEN, base_url=api.base_url)
+    sim = Simulation(app, api, think, match_timeout)
+    app.add_error_handler(sim.on_error)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+
+    rss_before = _rss()
+    sql_before = _sql_statements
+    start = perf_counter()
+    await asyncio.gather(*(
+        sim.user(100_000 + i, cycles, messages, random.random() < vip_share, ramp * i / users)
+        for i in range(users)
+    ))
+    while not app.update_queue.empty() or any(outbox.stats()["depth"].values()):
+        await asyncio.sleep(0.05)
+    seconds = perf_counter() - start
+    sql = _sql_statements - sql_before
+    rss_after = _rss()
+
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await api.stop()
+
+    relay = api.relay_latencies
+    match_seconds = (sim.last_match - sim.first_search) if sim.last_match else 0.0
+    return {
+        "seconds": round(seconds, 3),
+        "updates": sim.updates,
+        "updates_per_sec": round(sim.updates / seconds, 1),
+        "handler_errors": sim.errors,
+        "matches": sim.matches // 2,
+        "matches_per_sec": round(sim.matches / 2 / match_seconds, 1) if match_seconds else 0.0,
+        "match_timeouts": sim.timeouts,
+        "relays": len(relay),
+        "relays_dropped": sim.relays_sent - len(relay),
+        "relay_latency_ms": {
+            f"p{int(p * 100)}": round(_percentile(relay, p) * 1000, 2) for p in (0.5, 0.9, 0.99)
+        },
+        "sql_per_update": round(sql / sim.updates, 2),
+        "rss_per_user_kb": round((rss_after - rss_before) / users / 1024, 2),
+    }
+
+
+def _flat(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from _flat(value, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", value
+
+
+def report_scenario(results, baseline=None):
+    old = dict(_flat(baseline["results"])) if baseline else {}
+    for key, value in _flat(results):
+        line = f"{key:<24} {value:>12}"
+        if isinstance(old.get(key), (int, float)) and old[key]:
+            line += f"   {(value - old[key]) / old[key]:+7.1%} vs baseline"
+        print(line)
+
+
+# ---------------------------------------------------------
+# ENTRY
+# ---------------------------------------------------------
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", nargs="?", choices=MODES + (SCENARIO,), help="default: polling and webhook")
+    parser.add_argument("--updates", type=int, default=2_000)
+    parser.add_argument("--users", type=int, default=2_000, help="distinct senders / simulated users")
+    parser.add_argument("--concurrency", type=int, default=64, help="webhook POSTs in flight")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="seconds per Bot API call")
+    parser.add_argument("--cycles", type=int, default=3, help="scenario: search/chat/next rounds per user")
+    parser.add_argument("--messages", type=int, default=3, help="scenario: messages per chat")
+    parser.add_argument("--vip-share", type=float, default=0.1, help="scenario: users who buy VIP")
+    parser.add_argument("--think", type=float, default=0.2, help="scenario: mean pause between messages")
+    parser.add_argument("--ramp", type=float, default=10.0, help="scenario: seconds until every user has arrived")
+    parser.add_argument("--match-timeout", type=float, default=30.0, help="scenario: give up searching after this")
+    parser.add_argument("--telegram-limits", action="store_true", help="scenario: keep the outbox rate limits")
+    parser.add_argument("--json", help="scenario: save results here")
+    parser.add_argument("--baseline", help="scenario: compare with an earlier --json file")
+    parser.add_argument("--bot", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--api", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.bot:
+        serve_bot(args.bot, args.api, args.port)
+        return 0
+
+    if args.mode == SCENARIO:
+        config = {
+            k: getattr(args, k)
+            for k in (
+                "users", "cycles", "messages", "vip_share", "think",
+                "ramp", "match_timeout", "api_latency", "telegram_limits",
+            )
+        }
+        results = asyncio.run(run_scenario(**config))
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        report_scenario(results, baseline)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"config": config, "results": results}, f, indent=2)
+        return 0
+
+    for mode in [args.mode] if args.mode else MODES:
+        asyncio.run(run(mode, args.updates, args.users, args.concurrency, args.api_latency))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,329 @@
+# match_queue.py — in-memory matchmaking queue (priority heap + preference buckets)
+#
+# The queue lives in process memory; the SQLite `queue` table is only a
+# write-behind snapshot (see flush()) so a restart can pick up where it
+# left off. Every heap holds one tier (queue priority) in join order, so
+# its head is the member who has waited longest; which tier goes first is
+# up to the scheduling policy (see scheduling.py). Removal is lazy —
+# stale heap items are skipped when they surface.
+#
+# Every searcher sits in three heaps, all per tier:
+#   - order[priority] (who gets matched first)
+#   - by_region[(priority, gender, region, want_gender, want_region)]
+#   - by_gender[(priority, gender, want_gender, want_region)]   (any region)
+# A searcher's acceptable partners are a handful of these buckets (at most
+# 3 genders x 2 want_gender x 2 want_region per tier), so picking a mutual
+# match is a few heap peeks no matter how many people are queued. With a
+# RecentPartners ring, a bucket head the searcher talked to lately is
+# passed over (at most ring-size extra peeks).
+
+import heapq
+from collections import namedtuple
+from itertools import count
+from time import time
+
+from scheduling import FairShare
+
+GENDERS = ("male", "female", None)
+
+Profile = namedtuple("Profile", "gender region want_gender want_region")
+ANYONE = Profile(None, None, None, None)
+
+
+def compatible_genders(gender):
+    """
+    Default rule when no gender filter is set:
+    no gender → anyone, otherwise no same-gender pairs.
+    """
+    if not gender:
+        return GENDERS
+    return tuple(g for g in GENDERS if g != gender)
+
+
+def wanted_genders(profile):
+    if profile.want_gender:
+        return (profile.want_gender,)
+    return compatible_genders(profile.gender)
+
+
+def accepts(p1, p2):
+    """
+    Would a searcher with profile p1 take p2 as a partner?
+    """
+    if p2.gender not in wanted_genders(p1):
+        return False
+    return not p1.want_region or p1.want_region == p2.region
+
+
+def compatible(p1, p2):
+    return accepts(p1, p2) and accepts(p2, p1)
+
+
+def normalize(profile):
+    gender, region, want_gender, want_region = profile
+    return Profile(
+        gender if gender in GENDERS else None,
+        region or None,
+        want_gender if want_gender in GENDERS else None,
+        want_region or None,
+    )
+
+
+class MatchQueue:
+    def __init__(self, policy=None, recent=None):
+        self.policy = policy or FairShare()
+        self.recent = recent    # RecentPartners, or None: anyone may meet again
+        self._entries = {}      # user_id -> (key, Profile, priority); key = (timestamp, seq)
+        self._order = {}        # priority -> heap of (key, user_id)
+        self._by_region = {}    # (priority, gender, region, want_gender, want_region) -> heap
+        self._by_gender = {}    # (priority, gender, want_gender, want_region) -> heap
+        self._seq = count()
+        self._dirty = {}        # user_id -> (priority, timestamp) | None
+        self._popped = {}       # user_id -> (key, priority) of the last pop_pairs() pairs
+        self.retry_at = None    # see pop_pairs()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        return user_id in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    # -----------------------------------------------------
+    # Mutations
+    # -----------------------------------------------------
+
+    def push(self, user_id, profile=ANYONE, priority=0, timestamp=None, dirty=True):
+        if timestamp is None:
+            timestamp = int(time())
+        self._insert(user_id, (timestamp, next(self._seq)), normalize(profile), priority)
+
+        if dirty:
+            self._dirty[user_id] = (priority, timestamp)
+        self._maybe_compact()
+
+    def _insert(self, user_id, key, profile, priority):
+        self._entries[user_id] = (key, profile, priority)
+        heapq.heappush(self._order.setdefault(priority, []), (key, user_id))
+        self._index(key, user_id, profile, priority)
+
+    def clear(self):
+        """
+        Forgets everything, including unflushed snapshot changes.
+        """
+        self.__init__(self.policy, self.recent)
+
+    def remove(self, user_id):
+        if self._entries.pop(user_id, None) is not None:
+            self._dirty[user_id] = None
+
+    def requeue(self, user_id, profile=ANYONE):
+        """
+        Puts back one half of a pair from the last pop_pairs() that could
+        not be linked, with the priority and join time it was popped with.
+        Returns False if that pop_pairs() did not pair user_id.
+        """
+        popped = self._popped.pop(user_id, None)
+        if popped is None:
+            return False
+        if user_id not in self._entries:    # else: queued again meanwhile
+            key, priority = popped
+            self._insert(user_id, (key[0], next(self._seq)), normalize(profile), priority)
+            self._dirty[user_id] = (priority, key[0])
+            self._maybe_compact()
+        return True
+
+    def update_profile(self, user_id, profile):
+        """
+        Moves a queued user to the buckets of a new profile, keeping their
+        join time. The new seq retires the heap items of the old profile.
+        """
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        key, _, priority = entry
+        self._insert(user_id, (key[0], next(self._seq)), normalize(profile), priority)
+        self._maybe_compact()
+
+    # -----------------------------------------------------
+    # Matching
+    # -----------------------------------------------------
+
+    def pop_pairs(self, now=None):
+        """
+        Drains every match currently possible.
+
+        Searchers are taken in the policy's order as of `now`, except that
+        anyone waiting max_wait or longer goes before everyone who is not.
+        Each searcher gets the policy's favourite among the mutually
+        compatible partners they have not met lately (one heap peek per
+        candidate bucket; past max_wait, anyone will do). Whoever finds
+        nobody stays queued with their original place.
+
+        The result is maximal: a leftover searcher found no partner while
+        the pool still held every later leftover, so no two leftovers are
+        compatible — except recent partners. Those pair up once one of them
+        turns overdue or their ring entry expires; retry_at is the earliest
+        such time (None: nothing changes until the queue does), for the
+        caller to run pop_pairs() again then.
+        """
+        if now is None:
+            now = time()
+        score = self.policy.score
+        max_wait = self.policy.max_wait
+        deadline = now - max_wait if max_wait is not None else None
+        recent = self.recent
+        if recent is not None:
+            recent.prune(now)
+        pairs = []
+        unmatched = []
+        retry_at = None
+        self._popped = {}
+
+        while True:
+            head = self._next_searcher(now, deadline)
+            if head is None:
+                break
+            key, u1 = head
+            _, profile, priority = self._entries.pop(u1)
+            overdue = deadline is not None and key[0] <= deadline
+            skip = recent.of(u1) if recent is not None and not overdue else None
+
+            best = None
+            for tier, heap in self._candidate_heaps(profile):
+                candidate = self._head_skipping(heap, skip) if skip else self._head(heap)
+                if candidate is None:
+                    continue
+                rank = score(tier, now - candidate[0][0])
+                if best is None or rank > best_rank or (rank == best_rank and candidate < best):
+                    best, best_rank = candidate, rank
+
+            if best is None:
+                unmatched.append((u1, key, profile, priority))
+                if not overdue:
+                    at = key[0] + max_wait if max_wait is not None else None
+                    if skip:
+                        expires = next(iter(skip.values()))     # ring order is by expiry
+                        at = expires if at is None else min(at, expires)
+                    if at is not None and (retry_at is None or at < retry_at):
+                        retry_at = at
+                continue
+
+            u2 = best[1]
+            self._popped[u1] = (key, priority)
+            self._popped[u2] = (best[0], self._entries.pop(u2)[2])
+            self._dirty[u1] = None
+            self._dirty[u2] = None
+            pairs.append((u1, u2))
+
+        for u1, key, profile, priority in unmatched:
+            self._insert(u1, key, profile, priority)
+        self.retry_at = retry_at if len(unmatched) >= 2 else None
+
+        self._maybe_compact()
+        return pairs
+
+    def _next_searcher(self, now, deadline):
+        # pops the longest-waiting member of the tier the policy ranks
+        # highest; tiers whose head is past the deadline rank above the rest
+        best = best_tier = None
+        for tier, heap in self._order.items():
+            head = self._head(heap)
+            if head is None:
+                continue
+            if deadline is not None and head[0][0] <= deadline:
+                rank = (1, self.policy.score(tier, now - head[0][0]))
+            else:
+                rank = (0, self.policy.score(tier, now - head[0][0]))
+            if best is None or rank > best_rank or (rank == best_rank and head < best):
+                best, best_rank, best_tier = head, rank, tier
+        if best is not None:
+            heapq.heappop(self._order[best_tier])
+        return best
+
+    def _candidate_heaps(self, p):
+        # Partner gender g must be wanted by p; the partner's own filters
+        # must accept p: want_gender None (default rule) or p.gender,
+        # want_region None or p.region.
+        want_genders = (None, p.gender) if p.gender else (None,)
+        want_regions = (None, p.region) if p.region else (None,)
+
+        for g in wanted_genders(p):
+            for wg in want_genders:
+                if wg is None and p.gender not in compatible_genders(g):
+                    continue
+                for wr in want_regions:
+                    for tier in self._order:
+                        if p.want_region:
+                            heap = self._by_region.get((tier, g, p.want_region, wg, wr))
+                        else:
+                            heap = self._by_gender.get((tier, g, wg, wr))
+                        if heap:
+                            yield tier, heap
+
+    # -----------------------------------------------------
+    # Write-behind snapshot
+    # -----------------------------------------------------
+
+    def flush(self):
+        """
+        Returns (upserts, deletes) accumulated since the last flush.
+        upserts: [(user_id, priority, timestamp)], deletes: [user_id]
+        """
+        upserts = []
+        deletes = []
+        for user_id, row in self._dirty.items():
+            if row is None:
+                deletes.append(user_id)
+            else:
+                upserts.append((user_id, row[0], row[1]))
+        self._dirty = {}
+        return upserts, deletes
+
+    # -----------------------------------------------------
+    # Heap housekeeping
+    # -----------------------------------------------------
+
+    def _index(self, key, user_id, p, priority):
+        item = (key, user_id)
+        heapq.heappush(
+            self._by_region.setdefault((priority, p.gender, p.region, p.want_gender, p.want_region), []), item
+        )
+        heapq.heappush(self._by_gender.setdefault((priority, p.gender, p.want_gender, p.want_region), []), item)
+
+    def _alive(self, item):
+        key, user_id = item
+        entry = self._entries.get(user_id)
+        return entry is not None and entry[0] == key
+
+    def _head(self, heap):
+        while heap and not self._alive(heap[0]):
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def _head_skipping(self, heap, skip):
+        # _head(), passing over (and keeping) the users in `skip`
+        aside = []
+        head = self._head(heap)
+        while head is not None and head[1] in skip:
+            aside.append(heapq.heappop(heap))
+            head = self._head(heap)
+        for item in aside:
+            heapq.heappush(heap, item)
+        return head
+
+    def _maybe_compact(self):
+        # Lazy deletion leaves garbage behind; rebuild once it dominates.
+        size = sum(len(h) for h in self._order.values()) + sum(len(h) for h in self._by_gender.values())
+        if size <= 4 * len(self._entries) + 128:
+            return
+        self._order = {}
+        self._by_region = {}
+        self._by_gender = {}
+        for user_id, (key, profile, priority) in self._entries.items():
+            self._order.setdefault(priority, []).append((key, user_id))
+            self._index(key, user_id, profile, priority)
+        for heap in self._order.values():
+            heapq.heapify(heap)
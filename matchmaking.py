@@ -1,128 +1,378 @@
-# matchmaking.py — premium-aware + gender-aware match engine (FINAL)
+# matchmaking.py — premium-aware + gender/region-aware match engine (FINAL)
 
 import asyncio
-import random
-
-from database import (
-    get_queue,
-    remove_from_queue,
-    set_partner,
+from time import monotonic, time
+
+from config import (
+    MATCH_COALESCE_WINDOW,
+    MAX_QUEUE_WAIT,
+    INACTIVE_TIMEOUT,
+    RECENT_PARTNER_TTL,
+    WORKER_ID,
+    LEASE_TTL,
+)
+from async_database import (
     clear_partner,
+    link_pairs,
+    unpair,
+    rematch as db_rematch,
     update_user_state,
-    get_partner,
-    add_to_queue,
-    get_user_gender
+    get_session,
+    get_match_profile,
+    load_queue as db_load_queue,
+    save_queue_snapshot,
 )
+from coordination import backend, MATCHER_LEASE
+from events import register_action
+from match_queue import MatchQueue, Profile, ANYONE
+from recent_partners import RecentPartners
+from scheduling import FairShare
+from outbox import outbox
+from premium_logic import has_vip
+import metrics
+import presence
+import session_cache
+import session_log
+
+
+# ---------------------------------------------------------
+# Queue (in memory, snapshotted to SQLite)
+# ---------------------------------------------------------
+
+recent_partners = RecentPartners()
+match_queue = MatchQueue(FairShare(max_wait=MAX_QUEUE_WAIT), recent_partners)
+_queue_changed = asyncio.Event()
+_queued_at = {}         # user_id -> monotonic() when they joined (time-to-match)
+
+metrics.queue_length.track(lambda: len(match_queue))
+
+
+async def load_queue():
+    offset = monotonic() - time()
+    for user_id, *profile, priority, timestamp in await db_load_queue():
+        match_queue.push(user_id, Profile(*profile), priority, timestamp, dirty=False)
+        _queued_at[user_id] = timestamp + offset
+        presence.watch(user_id, INACTIVE_TIMEOUT, since=timestamp)
+
+
+async def save_queue():
+    upserts, deletes = match_queue.flush()
+    if upserts or deletes:
+        await save_queue_snapshot(upserts, deletes)
+
+
+VIP_PRIORITY = 10
+
+
+async def enqueue(user_id, priority=None):
+    """
+    priority=None → VIP_PRIORITY for VIPs, 0 otherwise (cached check).
+    """
+    if priority is None:
+        priority = VIP_PRIORITY if has_vip(user_id) else 0
+    await _queue_op("push", user_id, priority)
+
+
+async def dequeue(user_id):
+    await _queue_op("remove", user_id)
 
 
+async def update_queued_profile(user_id):
+    """
+    Call after changing gender/region/filters: re-buckets a queued user.
+    """
+    await _queue_op("profile", user_id)
+
+
+async def _queue_op(op, user_id, priority=0):
+    # Only the matcher leader holds the queue; other workers hand it the op.
+    if _leader:
+        await apply_queue_op(op, user_id, priority)
+    else:
+        await backend.push_event({"op": op, "user": user_id, "priority": priority})
+
+
+async def apply_queue_op(op, user_id, priority=0):
+    if op == "push":
+        match_queue.push(user_id, await _profile(user_id), priority)
+        _queued_at.setdefault(user_id, monotonic())
+        presence.watch(user_id, INACTIVE_TIMEOUT)
+        notify_queue()
+    elif op == "remove":
+        drop_queued(user_id)
+    elif op == "profile" and user_id in match_queue:
+        match_queue.update_profile(user_id, await _profile(user_id))
+        notify_queue()
+
+
+def drop_queued(user_id):
+    match_queue.remove(user_id)
+    _queued_at.pop(user_id, None)
+    presence.unwatch(user_id)
+
+
+def _reset_queue():
+    for user_id in match_queue:
+        presence.unwatch(user_id)
+    match_queue.clear()
+    _queued_at.clear()
+
+
+async def pump_queue_events():
+    """
+    Leader only: applies queue ops forwarded by other workers, in order.
+    """
+    for event in await backend.pop_events():
+        await apply_queue_op(event["op"], event["user"], event["priority"])
+
+
+async def _profile(user_id):
+    row = await get_match_profile(user_id)
+    return Profile(*row) if row else ANYONE
+
 
 # ---------------------------------------------------------
-# Prepare user
+# Matcher lease (exactly one worker owns the queue)
 # ---------------------------------------------------------
 
-def prepare_for_search(user_id):
-    remove_from_queue(user_id)        # avoid duplicates
-    clear_partner(user_id)
-    update_user_state(user_id, "searching")
-    register_action(user_id, "search")
+_leader = False
+
+
+def is_leader():
+    return _leader
+
+
+async def hold_matcher_lease():
+    """
+    Takes or renews the lease; call every LEASE_TTL / 3. A new leader
+    rebuilds the queue from the snapshot, a worker that lost the lease
+    drops its copy (the snapshot now belongs to the new leader).
+    """
+    global _leader
+    held = await backend.hold_lease(MATCHER_LEASE, WORKER_ID, LEASE_TTL)
+    if held and not _leader:
+        _leader = True
+        _reset_queue()
+        await load_queue()
+        notify_queue()
+    elif not held and _leader:
+        _leader = False
+        _reset_queue()
+    return held
+
+
+async def release_matcher_lease():
+    global _leader
+    if _leader:
+        await save_queue()
+        _leader = False
+    await backend.release_lease(MATCHER_LEASE, WORKER_ID)
 
 
 # ---------------------------------------------------------
-# Gender compatibility
+# Queue events (wake the matcher instead of polling)
 # ---------------------------------------------------------
 
-def compatible(u1, u2):
+def notify_queue():
+    _queue_changed.set()
+
+
+RETRY_SLACK = 0.01      # seconds past match_queue.retry_at, so the clock has surely passed it
+
+
+async def wait_for_queue(window=MATCH_COALESCE_WINDOW):
     """
-    Basic gender filter logic.
-    Expand later with region, VIP, custom filters.
+    Sleeps until someone joins the queue, or until time alone lets the
+    last matcher run's leftovers pair up (match_queue.retry_at: one turns
+    overdue, or a recent-partner entry expires). The optional window lets
+    a burst of /search commands land in the same matcher run.
     """
+    timeout = None
+    if match_queue.retry_at is not None and len(match_queue) >= 2:
+        timeout = max(0.0, match_queue.retry_at - time()) + RETRY_SLACK
+    try:
+        await asyncio.wait_for(_queue_changed.wait(), timeout)
+    except asyncio.TimeoutError:
+        return
+    if window:
+        await asyncio.sleep(window)
+    _queue_changed.clear()
 
-    g1 = get_user_gender(u1)
-    g2 = get_user_gender(u2)
 
-    # If nobody selected gender -> fine
-    if not g1 or not g2:
-        return True
+# ---------------------------------------------------------
+# Sessions (cache first, DB once on a miss)
+# ---------------------------------------------------------
+# With several workers the local cache only sees this worker's writes,
+# so lookups go to the shared backend instead.
+
+async def lookup_session(user_id):
+    """
+    Returns (state, partner_id) for the relay and disconnect paths.
+    """
+    if backend.shared:
+        session = await backend.get_session(user_id)
+    else:
+        session = session_cache.get(user_id)
+    if session is None:
+        session = await get_session(user_id) or (None, None)
+        await set_sessions({user_id: session})
+    return session
 
-    # If both selected gender -> forbids same-gender (unless you want to allow)
-    if g1 == g2:
-        return False
 
-    return True
+async def set_sessions(sessions):
+    """
+    sessions: {user_id: (state, partner_id)}, written right after the DB.
+    """
+    for user_id, (state, partner) in sessions.items():
+        session_cache.put(user_id, state, partner)
+    if backend.shared:
+        await backend.set_sessions(sessions)
 
 
 # ---------------------------------------------------------
-# Main matchmaker
+# Prepare user
 # ---------------------------------------------------------
 
-async def matchmaker(bot):
-    queue = get_queue()
-    if len(queue) < 2:
-        return
+async def prepare_for_search(user_id):
+    await dequeue(user_id)        # avoid duplicates
+    await clear_partner(user_id)
+    await update_user_state(user_id, "searching")
+    await set_sessions({user_id: ("searching", None)})
+    presence.touch(user_id)
+    register_action(user_id, "search")
 
-    u1 = queue[0]
-    partner = None
 
-    # Find someone compatible
-    for u2 in queue[1:]:
-        if compatible(u1, u2):
-            partner = u2
-            break
+# ---------------------------------------------------------
+# Main matchmaker
+# ---------------------------------------------------------
 
-    if not partner:
-        return  # no match possible yet
+MATCH_TEXT = "✅ Собеседник найден! Пишите.\n/next — следующий, /stop — выйти"
 
-    u2 = partner
 
-    
-    # realism
-    await asyncio.sleep(random.uniform(0.03, 0.08))
+async def matchmaker(bot):
+    """
+    Pairs every compatible couple in the queue in one tick and commits
+    the whole batch at once. Gender/region rules live in
+    match_queue.compatible().
+    """
+    if len(match_queue) >= 2:
+        pairs = match_queue.pop_pairs()
+
+        # connect everyone in one transaction; pairs where someone stopped
+        # searching in the meantime are skipped by the DB check
+        linked = await link_pairs(pairs) if pairs else []
+        metrics.matches_per_tick.observe(len(linked))
+        # all sessions in one write, before anything else can run: a
+        # disconnect_users() whose unpair committed after link_pairs then
+        # always writes over these, never the other way round
+        sessions = {}
+        for u1, u2 in linked:
+            sessions[u1] = ("chatting", u2)
+            sessions[u2] = ("chatting", u1)
+        if sessions:
+            await set_sessions(sessions)
+
+        now = monotonic()
+        for u1, u2 in linked:
+            wait1 = now - _queued_at.pop(u1, now)
+            wait2 = now - _queued_at.pop(u2, now)
+            presence.unwatch(u1)
+            presence.unwatch(u2)
+            metrics.time_to_match.observe(wait1)
+            metrics.time_to_match.observe(wait2)
+            session_log.started(u1, u2, wait1, wait2)
+            recent_partners.add(u1, u2)
+            await outbox.send(bot.send_message, u1, text=MATCH_TEXT)
+            await outbox.send(bot.send_message, u2, text=MATCH_TEXT)
+            register_action(u1, "match")
+            register_action(u2, "match")
+
+        if len(linked) != len(pairs):
+            await _requeue_leftovers(set(pairs) - set(linked))
+
+    await save_queue()
+
+
+async def _requeue_leftovers(pairs):
+    # The other half of a failed pair is still searching: back in line
+    # with the priority and join time it was popped with, so a paid
+    # priority and the wait so far (_queued_at) carry over. Decided on the
+    # DB row (not the cache) — it is what link_pairs checked.
+    requeued = False
+    for pair in pairs:
+        for user_id in pair:
+            session = await get_session(user_id) or (None, None)
+            await set_sessions({user_id: session})
+            if session[0] == "searching":
+                if match_queue.requeue(user_id, await _profile(user_id)):
+                    requeued = True
+                else:
+                    await enqueue(user_id)      # lost the lease meanwhile
+            else:
+                _queued_at.pop(user_id, None)
+                presence.unwatch(user_id)
+    if requeued:
+        notify_queue()
 
-    # safety re-check
-    queue = get_queue()
-    if u1 not in queue or u2 not in queue:
-        return
 
-    # remove from queue
-    remove_from_queue(u1)
-    remove_from_queue(u2)
+# ---------------------------------------------------------
+# VIP rematch
+# ---------------------------------------------------------
 
-    # connect users
-    set_partner(u1, u2)
-    set_partner(u2, u1)
+REMATCH_TEXT = "🔁 Вы снова на связи с прошлым собеседником. Пишите!\n/next — следующий, /stop — выйти"
 
-    update_user_state(u1, "chatting")
-    update_user_state(u2, "chatting")
 
-    register_action(u1, "match")
-    register_action(u2, "match")
+async def rematch(bot, user_id):
+    """
+    Links user_id straight back to the partner they last left, past the
+    queue. Returns the partner id, or None if that partner is busy or it
+    was more than RECENT_PARTNER_TTL ago.
+    """
+    partner = await db_rematch(user_id, time() - RECENT_PARTNER_TTL)
+    if not partner:
+        return None
 
-    
+    # the DB rows are out of the queue already; now the in-memory queue
+    await dequeue(user_id)
+    await dequeue(partner)
+    presence.touch(user_id)
+    session_log.started(user_id, partner, 0, 0)
+    await set_sessions({user_id: ("chatting", partner), partner: ("chatting", user_id)})
+    await outbox.send(bot.send_message, user_id, text=REMATCH_TEXT)
+    await outbox.send(bot.send_message, partner, text=REMATCH_TEXT)
+    register_action(user_id, "rematch")
+    register_action(partner, "rematch")
+    return partner
 
 
 # ---------------------------------------------------------
 # Disconnect logic
 # ---------------------------------------------------------
 
-async def disconnect_users(bot, user_id):
-    partner = get_partner(user_id)
+async def disconnect_users(bot, user_id, reason="stop"):
+    await set_sessions({user_id: ("idle", None)})     # stop relaying right away
+    await dequeue(user_id)
+
+    # one transaction: both sides idle, links cleared, queue row gone
+    partner = await unpair(user_id)
+    # again from the DB result: a matcher tick that linked us just before
+    # the unpair may have cached "chatting" in between
+    sessions = {user_id: ("idle", None)}
+    if partner:
+        sessions[partner] = ("idle", None)
+    await set_sessions(sessions)
+    presence.touch(user_id)
 
     register_action(user_id, "disconnect")
 
-    if not partner or partner == user_id:
-        update_user_state(user_id, "idle")
-        await bot.send_message(user_id, "❌ Вы отключились.")
+    if not partner:
+        await outbox.send(bot.send_message, user_id, text="❌ Вы отключились.")
         return
 
-    # notify both
-    await bot.send_message(user_id, "❌ Вы отключились.")
-    await bot.send_message(partner, "⚠️ Собеседник отключился.")
+    session_log.ended(user_id, reason)
 
-    # reset
-    clear_partner(user_id)
-    clear_partner(partner)
-
-    update_user_state(user_id, "idle")
-    update_user_state(partner, "idle")
+    # notify both
+    await outbox.send(bot.send_message, user_id, text="❌ Вы отключились.")
+    await outbox.send(bot.send_message, partner, text="⚠️ Собеседник отключился.")
 
     register_action(partner, "partner_disconnect")
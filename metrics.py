@@ -0,0 +1,215 @@
+# metrics.py — counters, gauges and histograms in Prometheus text format
+#
+# Observations are plain attribute updates (plus one C bisect for
+# histograms), so they cost well under a microsecond and can sit on the
+# relay path. Metrics updated from DB threads take a lock; everything
+# else runs on the event loop. GET /metrics on METRICS_PORT serves
+# the lot (127.0.0.1 by default).
+
+import logging
+import threading
+from bisect import bisect_left
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+WAIT_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+_registry = []
+
+
+# ---------------------------------------------------------
+# Metric types
+# ---------------------------------------------------------
+
+class Counter:
+    __slots__ = ("value",)
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge:
+    __slots__ = ("value", "read")
+    kind = "gauge"
+
+    def __init__(self, read=None):
+        self.value = 0
+        self.read = read        # optional callable, evaluated on scrape
+
+    def set(self, value):
+        self.value = value
+
+    def track(self, read):
+        self.read = read
+
+    def samples(self, name, labels):
+        yield name, labels, self.read() if self.read else self.value
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+    kind = "histogram"
+
+    def __init__(self, buckets=LATENCY_BUCKETS, threadsafe=False):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)      # last one is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock() if threadsafe else None
+
+    def observe(self, value):
+        if self._lock is None:
+            self.counts[bisect_left(self.bounds, value)] += 1
+            self.sum += value
+            return
+        with self._lock:
+            self.counts[bisect_left(self.bounds, value)] += 1
+            self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def samples(self, name, labels):
+        total = 0
+        for bound, n in zip(self.bounds + ("+Inf",), self.counts):
+            total += n
+            yield f"{name}_bucket", labels + (("le", _format(bound)),), total
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, total
+
+
+class Family:
+    """
+    A named metric split by one label: family.labels("x").inc().
+    """
+
+    def __init__(self, cls, name, help, label=None, **kwargs):
+        self.cls = cls
+        self.name = name
+        self.help = help
+        self.label = label
+        self._kwargs = kwargs
+        self._children = {}
+        _registry.append(self)
+
+    def labels(self, value):
+        child = self._children.get(value)
+        if child is None:
+            child = self._children[value] = self.cls(**self._kwargs)
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.cls.kind}"]
+        for value, child in list(self._children.items()):
+            labels = () if value is None else ((self.label, value),)
+            for name, sample_labels, sample in child.samples(self.name, labels):
+                lines.append(f"{name}{_labels(sample_labels)} {_format(sample)}")
+        return "\n".join(lines)
+
+
+# Without a label these return the metric itself, so hot paths call
+# observe()/inc() directly with no lookup in between.
+
+def counter(name, help, label=None):
+    return _metric(Family(Counter, name, help, label))
+
+
+def gauge(name, help):
+    return _metric(Family(Gauge, name, help))
+
+
+def histogram(name, help, label=None, buckets=LATENCY_BUCKETS, threadsafe=False):
+    return _metric(Family(Histogram, name, help, label, buckets=buckets, threadsafe=threadsafe))
+
+
+def _metric(family):
+    return family if family.label else family.labels(None)
+
+
+def render():
+    return "\n".join(family.render() for family in _registry) + "\n"
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# ---------------------------------------------------------
+# The bot's metrics
+# ---------------------------------------------------------
+
+queue_length = gauge("chatroulette_queue_length", "Users waiting in the match queue")
+time_to_match = histogram(
+    "chatroulette_time_to_match_seconds", "Queue wait until a partner was found", buckets=WAIT_BUCKETS,
+)
+matches_per_tick = histogram(
+    "chatroulette_matches_per_tick", "Pairs linked per matcher run", buckets=COUNT_BUCKETS,
+)
+relay_latency = histogram(
+    "chatroulette_relay_latency_seconds", "Relayed message: queued in the outbox until sent",
+)
+outbox_depth = gauge("chatroulette_outbox_depth", "Sends waiting in the outbox")
+telegram_errors = counter("chatroulette_telegram_errors_total", "Failed Bot API calls", "error")
+telegram_retry_after = counter("chatroulette_telegram_retry_after_total", "429 RetryAfter answers")
+db_seconds = histogram(
+    "chatroulette_db_seconds", "Time spent in each database call", "function", threadsafe=True,
+)
+events_written = counter("chatroulette_events_written_total", "Actions written to the events table")
+events_dropped = counter("chatroulette_events_dropped_total", "Actions lost to a full buffer or a failed write")
+sessions_ended = counter("chatroulette_sessions_ended_total", "Chat sessions ended", "reason")
+session_ops_dropped = counter(
+    "chatroulette_session_ops_dropped_total", "Session log entries lost to a full buffer or a failed write",
+)
+vip_purchases = counter("chatroulette_vip_purchases_total", "Successful VIP payments", "plan")
+duplicate_payments = counter(
+    "chatroulette_duplicate_payments_total", "successful_payment updates for a charge already applied",
+)
+session_cache_hits = counter("chatroulette_session_cache_hits_total", "Session lookups served from memory")
+session_cache_misses = counter("chatroulette_session_cache_misses_total", "Session lookups that went to the DB")
+
+
+# ---------------------------------------------------------
+# HTTP endpoint
+# ---------------------------------------------------------
+
+async def _scrape(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_server(host, port):
+    """
+    Serves GET /metrics. Returns the runner (cleanup() to stop), or None
+    if the port is taken — metrics are not worth failing startup for.
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", _scrape)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        log.warning("metrics endpoint disabled: %s", e)
+        await runner.cleanup()
+        return None
+    return runner
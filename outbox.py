@@ -0,0 +1,253 @@
+# outbox.py — rate-limited outbound dispatcher for every bot → user send
+#
+# All sends (relay, match/disconnect notices, cleaner warnings) go through
+# one Outbox instead of calling bot.send_* directly:
+#   - global + per-chat token buckets keep us under Telegram's limits
+#   - priority lanes: relay traffic is picked before notifications
+#   - per-chat FIFO, one send in flight per chat (message order is kept)
+#   - 429 RetryAfter pauses the chat and all sends for the requested
+#     time, then retries
+#   - only connection errors are retried: BadRequest / Forbidden are
+#     permanent, and a timed-out send may have arrived (no duplicates)
+#   - bounded lanes: send() waits for a free slot (backpressure)
+
+import asyncio
+import heapq
+import logging
+from collections import deque
+from itertools import count
+from time import monotonic
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+RELAY = 0
+NOTIFY = 1
+LANES = (RELAY, NOTIFY)
+
+GLOBAL_RATE = 30            # msgs/sec across all chats
+GLOBAL_BURST = 30
+CHAT_RATE = 1               # msgs/sec per chat
+CHAT_BURST = 3
+LANE_LIMIT = {RELAY: 5000, NOTIFY: 2000}
+WORKERS = 8
+MAX_ATTEMPTS = 3
+LATENCY_WINDOW = 1000       # recent sends kept for percentiles
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now):
+        """
+        Seconds until one token is available (0 = send now).
+        """
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = monotonic() + seconds
+
+
+class _Job:
+    __slots__ = ("lane", "method", "kwargs", "future", "enqueued_at", "attempts")
+
+    def __init__(self, lane, method, kwargs, future):
+        self.lane = lane
+        self.method = method
+        self.kwargs = kwargs
+        self.future = future
+        self.enqueued_at = monotonic()
+        self.attempts = 0
+
+
+class Outbox:
+    def __init__(self, workers=WORKERS):
+        self._workers = workers
+        self._tasks = []
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._buckets = {}          # chat_id -> TokenBucket
+        self._chats = {}            # chat_id -> deque[_Job]
+        self._ready = []            # heap of (lane, seq, chat_id)
+        self._queued = set()        # chats in _ready, parked or in flight
+        self._seq = count()
+        self._wakeup = asyncio.Event()
+        self._slots = {lane: asyncio.Semaphore(LANE_LIMIT[lane]) for lane in LANES}
+        self._depth = {lane: 0 for lane in LANES}
+        self._latency = deque(maxlen=LATENCY_WINDOW)
+        self._sent = 0
+        self._retried = 0
+        self._failed = 0
+
+    # -----------------------------------------------------
+    # Public API
+    # -----------------------------------------------------
+
+    async def send(self, method, chat_id, lane=NOTIFY, **kwargs):
+        """
+        Queues `method(chat_id=chat_id, **kwargs)` (e.g. bot.send_message).
+        Returns once the job is queued; await the returned future for the
+        API result. Failures are logged, so nobody has to await it.
+        """
+        await self._slots[lane].acquire()
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_log_failure)
+
+        self._depth[lane] += 1
+        self._chats.setdefault(chat_id, deque()).append(_Job(lane, method, kwargs, future))
+        if chat_id not in self._queued:
+            self._schedule(chat_id)
+        return future
+
+    def start(self):
+        for _ in range(self._workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self, timeout=5):
+        """
+        Gives queued sends `timeout` seconds to drain, then cancels workers.
+        """
+        deadline = monotonic() + timeout
+        while any(self._depth.values()) and monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def stats(self):
+        latencies = sorted(self._latency)
+
+        def pct(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0.0
+
+        return {
+            "depth": dict(self._depth),
+            "chats": len(self._chats),
+            "sent": self._sent,
+            "retried": self._retried,
+            "failed": self._failed,
+            "latency_p50": pct(0.50),
+            "latency_p99": pct(0.99),
+        }
+
+    # -----------------------------------------------------
+    # Scheduling
+    # -----------------------------------------------------
+
+    def _schedule(self, chat_id):
+        jobs = self._chats.get(chat_id)
+        if not jobs:
+            self._chats.pop(chat_id, None)
+            self._queued.discard(chat_id)
+            return
+        self._queued.add(chat_id)
+        heapq.heappush(self._ready, (jobs[0].lane, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    async def _next_chat(self):
+        while not self._ready:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        return heapq.heappop(self._ready)[2]
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self._next_chat()
+
+            bucket = self._buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._buckets[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+
+            wait = bucket.delay(monotonic())
+            if wait > 0:
+                # park the chat, the worker moves on to someone else
+                loop.call_later(wait, self._schedule, chat_id)
+                continue
+
+            wait = self._global.delay(monotonic())
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self._global.delay(monotonic())
+
+            self._global.take()
+            bucket.take()
+            await self._send_head(chat_id, bucket)
+            self._schedule(chat_id)
+
+            if len(self._buckets) > 4 * len(self._chats) + 10_000:
+                self._drop_idle_buckets()
+
+    async def _send_head(self, chat_id, bucket):
+        jobs = self._chats[chat_id]
+        job = jobs[0]
+        job.attempts += 1
+        try:
+            result = await job.method(chat_id=chat_id, **job.kwargs)
+        except RetryAfter as e:
+            # flood control is per bot, not only per chat
+            self._retried += 1
+            bucket.block(e.retry_after)
+            self._global.block(e.retry_after)
+            return
+        except (BadRequest, Forbidden, TimedOut) as e:
+            # BadRequest and TimedOut are NetworkErrors in PTB: never retried
+            self._finish(jobs.popleft(), error=e)
+        except NetworkError as e:
+            if job.attempts < MAX_ATTEMPTS:
+                self._retried += 1
+                return
+            self._finish(jobs.popleft(), error=e)
+        except Exception as e:
+            self._finish(jobs.popleft(), error=e)
+        else:
+            self._finish(jobs.popleft(), result=result)
+
+    def _finish(self, job, result=None, error=None):
+        self._depth[job.lane] -= 1
+        self._slots[job.lane].release()
+        if error is None:
+            self._sent += 1
+            latency = monotonic() - job.enqueued_at
+            self._latency.append(latency)
+            if job.lane == RELAY:
+                metrics.relay_latency.observe(latency)
+            if not job.future.done():
+                job.future.set_result(result)
+        else:
+            self._failed += 1
+            if not job.future.done():
+                job.future.set_exception(error)
+
+    def _drop_idle_buckets(self):
+        now = monotonic()
+        for chat_id in list(self._buckets):
+            bucket = self._buckets[chat_id]
+            if chat_id not in self._chats and bucket.delay(now) == 0 and bucket.tokens >= bucket.burst:
+                del self._buckets[chat_id]
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        log.warning("outbound send failed: %s", future.exception())
+
+
+outbox = Outbox()
+metrics.outbox_depth.track(lambda: sum(outbox._depth.values()))
@@ -1,29 +1,24 @@
 # payment_engine.py — Telegram Stars payments + premium handling
+#
+# Products come from catalog.py; FULFIL maps a product's feature to what
+# delivers it, so a payment is two dict lookups away from its handler.
 
-import time
-from premium_logic import (
-    grant_vip,
-    log_transaction
-)
-from config import (
-    GENDER_FILTER_COST,
-    REGION_FILTER_COST,
-    PRIORITY_QUEUE_COST,
-    INSTANT_REMATCH_COST,
-    VIP_COST_WEEK
-)
+import catalog
+from ledger import record_payment
+from premium_logic import grant_vip
 
 
 # ------------------------------
-# FEATURE PRICE MAP
+# FULFILMENT PER FEATURE
 # ------------------------------
+# Each returns False for a charge_id already applied.
 
-FEATURE_PRICES = {
-    "gender_filter": GENDER_FILTER_COST,
-    "region_filter": REGION_FILTER_COST,
-    "priority": PRIORITY_QUEUE_COST,
-    "instant_rematch": INSTANT_REMATCH_COST,
-    "vip_week": VIP_COST_WEEK
+def _grant_vip(user_id, product, charge_id, paid):
+    return grant_vip(user_id, product.days, charge_id, paid)
+
+
+FULFIL = {
+    "vip": _grant_vip,
 }
 
 
@@ -31,58 +26,49 @@ FEATURE_PRICES = {
 # 1. Validate payment from Telegram
 # ------------------------------
 
-def verify_star_payment(amount_sent, feature_name):
+def verify_star_payment(amount_sent, payload):
     """
-    Makes sure the user sent the correct amount of Stars.
-    Prevents cheating.
+    Makes sure the user pays the current price of a product on sale.
+    Prevents cheating. Called on pre_checkout_query, before money moves.
     """
-    if feature_name not in FEATURE_PRICES:
+    product = catalog.get(payload)
+    if product is None or not product.invoice:
         return False
-
-    required = FEATURE_PRICES[feature_name]
-    return amount_sent >= required
+    return amount_sent >= product.price
 
 
 # ------------------------------
 # 2. Process payment
 # ------------------------------
 
-def process_payment(user_id, amount, feature_name):
+def process_payment(user_id, payload, amount, charge_id):
     """
-    Called right after Telegram confirms payment.
-    It updates VIP, grants features, and logs the transaction.
+    Called right after Telegram confirms payment (on the DB writer).
+    Delivers the product and records the payment once per charge_id.
+    Returns {"success": True, "product": ...} or an "error":
+    "duplicate" (already applied) or "unknown_product".
     """
+    product = catalog.get(payload)
+    fulfil = FULFIL.get(product.feature) if product else None
 
-    # Validate
-    if not verify_star_payment(amount, feature_name):
-        return {"success": False, "error": "Invalid payment"}
-
-    # VIP purchase
-    if feature_name == "vip_week":
-        grant_vip(user_id, days=7)
-
-    # Log in DB
-    log_transaction(user_id, amount, feature_name)
+    if fulfil is None:
+        # taken off the catalog after the invoice went out: keep the payment on record
+        if not record_payment(user_id, f"paid_{payload}", charge_id, amount):
+            return {"success": False, "error": "duplicate"}
+        return {"success": False, "error": "unknown_product"}
 
-    return {"success": True, "feature": feature_name}
+    if not fulfil(user_id, product, charge_id, amount):
+        return {"success": False, "error": "duplicate"}
+    return {"success": True, "product": product}
 
 
 # ------------------------------
-# 3. Inline button payload builder
+# 3. Invoice description
 # ------------------------------
 
-def get_payment_description(feature_name):
+def get_payment_description(payload):
     """
     Returns a clean description for payment dialogs.
     """
-    if feature_name == "gender_filter":
-        return "Unlock Gender Filter (Stars)"
-    if feature_name == "region_filter":
-        return "Unlock Region Filter (Stars)"
-    if feature_name == "priority":
-        return "Priority Queue (Stars)"
-    if feature_name == "instant_rematch":
-        return "Instant Rematch (Stars)"
-    if feature_name == "vip_week":
-        return "VIP (7 Days)"
-    return "Purchase"
+    product = catalog.get(payload)
+    return product.title if product and product.title else "Purchase"
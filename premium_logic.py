@@ -1,81 +1,105 @@
 # premium_logic.py — Telegram Stars Edition (FINAL)
 
+import threading
 import time
-import sqlite3
-from config import DB_PATH, FEATURE_PRICES
-
-def _connect():
-    return sqlite3.connect(DB_PATH)
+from database import _connect, transaction
+import catalog
+import ledger
 
 # -------------------------------
-# STAR BALANCE
+# STAR BALANCE (ledger.py)
 # -------------------------------
 
 def get_stars(user_id):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("SELECT stars FROM users WHERE id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else 0
+    return ledger.balance(user_id)
 
 def add_stars(user_id, amount):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET stars = stars + ? WHERE id=?", (amount, user_id))
-    conn.commit()
-    conn.close()
-    log_transaction(user_id, amount, "stars_added")
+    ledger.credit(user_id, amount, "stars_added")
 
 # -------------------------------
 # SPENDING (just in case)
 # -------------------------------
 
 def charge_stars(user_id, feature_name):
-    price = FEATURE_PRICES.get(feature_name)
-    if price is None:
-        return False
-    current = get_stars(user_id)
-    if current < price:
+    # balance check and debit are one statement: never below zero
+    product = catalog.get(feature_name)
+    if product is None or product.invoice:
         return False
-
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET stars = stars - ? WHERE id=?", (price, user_id))
-    conn.commit()
-    conn.close()
-
-    log_transaction(user_id, -price, f"buy_{feature_name}")
-    return True
+    return ledger.debit(user_id, product.price, f"buy_{feature_name}")
 
 # -------------------------------
 # VIP LOGIC
 # -------------------------------
-
-def has_vip(user_id):
+# user_id -> vip_until (0 = no VIP). Entries expire by themselves (plain
+# timestamp compare) and grant_vip overwrites them after its write. Once
+# warm_vip_cache() has loaded every active VIP, a miss means "no VIP"
+# and costs no query.
+#
+# With several workers (REDIS_URL set) another process may have granted
+# VIP: bot.py re-runs warm_vip_cache() every VIP_REFRESH seconds on a DB
+# reader thread, so such a grant shows up here within that time and
+# has_vip() still never queries on the event loop. Writes to _vip_until
+# and the refresh's merge-and-swap hold _vip_lock: a grant lands either
+# in the dict being merged or in the one swapped in.
+
+VIP_REFRESH = 30
+
+_vip_until = {}
+_vip_warm = False
+_vip_lock = threading.Lock()
+
+def warm_vip_cache():
+    global _vip_until, _vip_warm
+    now = int(time.time())
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute("SELECT user_id, vip_until FROM premium WHERE vip_until > ?", (now,))
+    fresh = dict(cur.fetchall())
+    with _vip_lock:
+        # keep grant_vip() writes that landed while we were reading
+        for user_id, until in _vip_until.items():
+            if until > fresh.get(user_id, now):
+                fresh[user_id] = until
+        _vip_until = fresh      # swapped whole: readers never see it half-built
+        _vip_warm = True
+    return len(fresh)
+
+def _vip_until_of(user_id):
+    until = _vip_until.get(user_id)
+    if until is not None or _vip_warm:
+        return until or 0
+    # cold cache (scripts; the bot warms it before taking updates)
     conn = _connect()
     cur = conn.cursor()
     cur.execute("SELECT vip_until FROM premium WHERE user_id=?", (user_id,))
     row = cur.fetchone()
-    conn.close()
-    if not row:
-        return False
-    return row[0] > int(time.time())
+    until = row[0] if row else 0
+    with _vip_lock:
+        _vip_until[user_id] = until
+    return until
+
+def has_vip(user_id):
+    return _vip_until_of(user_id) > int(time.time())
 
-def grant_vip(user_id, days=7):
+def grant_vip(user_id, days=7, charge_id=None, paid=0):
+    """
+    charge_id: the Telegram payment behind the grant. A payment already
+    recorded grants nothing and returns False.
+    """
     now = int(time.time())
     vip_until = now + days * 86400
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO premium (user_id, vip_until)
-        VALUES (?, ?)
-        ON CONFLICT(user_id)
-        DO UPDATE SET vip_until = excluded.vip_until
-    """, (user_id, vip_until))
-    conn.commit()
-    conn.close()
-    log_transaction(user_id, 0, f"vip_granted_{days}_days")
+    with transaction() as cur:
+        if not ledger.append(cur, user_id, 0, f"vip_granted_{days}_days", charge_id, paid):
+            return False
+        cur.execute("""
+            INSERT INTO premium (user_id, vip_until)
+            VALUES (?, ?)
+            ON CONFLICT(user_id)
+            DO UPDATE SET vip_until = excluded.vip_until
+        """, (user_id, vip_until))
+    with _vip_lock:
+        _vip_until[user_id] = vip_until
+    return True
 
 # -------------------------------
 # UNLOCKS (VIP-only features)
@@ -101,11 +125,8 @@ def unlock_vip(user_id):
 # -------------------------------
 
 def log_transaction(user_id, amount, feature):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO transactions (user_id, amount, feature, timestamp)
-        VALUES (?, ?, ?, ?)
-    """, (user_id, amount, feature, int(time.time())))
-    conn.commit()
-    conn.close()
+    # a ledger entry: a non-zero amount moves the balance too
+    if amount:
+        ledger.credit(user_id, amount, feature)
+    else:
+        ledger.record(user_id, feature)
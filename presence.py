@@ -0,0 +1,142 @@
+# presence.py — last activity in memory, inactivity timers instead of polling
+#
+# touch() is a dict write: no commit on /start, /search or a state change.
+# flush_loop() hands the users touched since the last flush to the DB in
+# one batch every FLUSH_INTERVAL seconds (users.last_active, for dashboards
+# and for the other workers, see queue_cleaner.evict_inactive).
+#
+# watch() arms an inactivity timer in an expiry heap; expire_loop() sleeps
+# until the earliest one is due, so a timeout fires on time and costs
+# O(expired) instead of a sweep over the whole queue. Activity does not
+# touch the heap: a timer that fires for someone active since then is just
+# pushed back to their new deadline.
+
+import asyncio
+import heapq
+import logging
+from collections import OrderedDict
+from time import time
+
+from async_database import save_last_active
+from write_behind import KeyedWriteBehind
+
+log = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 5.0        # seconds
+KEEP = 600                  # seconds a flushed, idle entry stays in memory
+
+
+async def _save(batch):
+    await save_last_active([(int(t), u) for u, t in batch.items()])
+
+
+_seen = OrderedDict()   # user_id -> time() of last activity, least recent first
+_dirty = KeyedWriteBehind(_save, FLUSH_INTERVAL, "last_active updates")    # not yet in the DB
+_watched = {}           # user_id -> (timeout, since, deadline)
+_timers = []            # heap of (deadline, user_id); stale ones are skipped
+_wakeup = asyncio.Event()
+
+
+def touch(user_id):
+    _seen[user_id] = now = time()
+    _seen.move_to_end(user_id)
+    _dirty.put(user_id, now)
+
+
+def last_seen(user_id, default=None):
+    return _seen.get(user_id, default)
+
+
+# ---------------------------------------------------------
+# Inactivity timers
+# ---------------------------------------------------------
+
+def watch(user_id, timeout, since=None):
+    """
+    Reports user_id to expire_loop() once they have been inactive for
+    `timeout` seconds, counting from their last touch() or `since`
+    (default: now), whichever is later.
+    """
+    since = time() if since is None else since
+    _schedule(user_id, timeout, since, max(since, _seen.get(user_id, since)) + timeout)
+
+
+def unwatch(user_id):
+    _watched.pop(user_id, None)
+
+
+def _schedule(user_id, timeout, since, deadline):
+    _watched[user_id] = (timeout, since, deadline)
+    heapq.heappush(_timers, (deadline, user_id))
+    if _timers[0][1] == user_id:
+        _wakeup.set()       # new earliest deadline: expire_loop sleeps too long
+
+
+def expired(now):
+    """
+    Pops every timer due by `now`: returns the users inactive for their
+    whole timeout, re-arms the ones active since.
+    """
+    due = []
+    while _timers and _timers[0][0] <= now:
+        deadline, user_id = heapq.heappop(_timers)
+        entry = _watched.get(user_id)
+        if entry is None or entry[2] != deadline:
+            continue        # unwatched or re-armed since
+        timeout, since, _ = entry
+        active = max(since, _seen.get(user_id, since))
+        if active + timeout > now:
+            _schedule(user_id, timeout, since, active + timeout)
+        else:
+            del _watched[user_id]
+            due.append(user_id)
+    return due
+
+
+async def expire_loop(on_expired):
+    """
+    Calls `await on_expired(user_ids)` whenever watched users time out.
+    """
+    while True:
+        delay = _timers[0][0] - time() if _timers else None
+        _wakeup.clear()
+        if delay is None or delay > 0:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        due = expired(time())
+        if due:
+            try:
+                await on_expired(due)
+            except Exception:
+                log.exception("inactivity handler failed for %d users", len(due))
+
+
+# ---------------------------------------------------------
+# Write-behind to users.last_active
+# ---------------------------------------------------------
+
+async def flush():
+    """
+    Writes the activity seen since the last flush. Returns the number of users.
+    """
+    written = await _dirty.flush()      # a failed batch stays pending
+    if written:
+        _forget_idle(time() - KEEP)
+    return written
+
+
+def _forget_idle(before):
+    # oldest first; stops at the first entry that is still needed
+    while _seen:
+        user_id = next(iter(_seen))
+        if _seen[user_id] >= before or user_id in _dirty or user_id in _watched:
+            break
+        del _seen[user_id]
+
+
+async def flush_loop():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await flush()
@@ -1,58 +1,63 @@
 # queue_cleaner.py — removes dead, inactive, or invalid users from queue
 
+import asyncio
 import time
-from database import (
-    get_queue,
-    get_user_state,
-    get_partner,
-    remove_from_queue,
-    get_last_active,
-)
-
-INACTIVE_TIMEOUT = 30      # seconds — user inactive → removed
+from async_database import sweep_queue, get_last_active_many
+from config import INACTIVE_TIMEOUT, REDIS_URL
+from matchmaking import drop_queued, save_queue, match_queue
+from outbox import outbox
+import presence
+
 BROKEN_LINK_TIMEOUT = 10   # reserved for future
 
+INACTIVE_TEXT = "⚠️ Вы были удалены из очереди из-за неактивности."
+
 
 async def clean_queue(bot):
     """
-    Runs every 5 seconds (scheduled in bot.py).
+    Runs every 30 seconds on the matcher leader (scheduled in bot.py).
     Removes:
-    - inactive users
     - users already chatting
     - users with invalid partner links
+
+    One set-based sweep over the queue snapshot finds all of them,
+    the removals go out as one bulk delete. Inactive users are not
+    polled for: their presence timers fire evict_inactive().
     """
 
-    now = int(time.time())
-    queue = get_queue()
-
-    for user_id in queue:
-        # -------------------------
-        # 1. INACTIVE USER
-        # -------------------------
-        last = get_last_active(user_id)
-        if last and (now - last) > INACTIVE_TIMEOUT:
-            remove_from_queue(user_id)
-            try:
-                await bot.send_message(
-                    user_id,
-                    "⚠️ Вы были удалены из очереди из-за неактивности."
-                )
-            except:
-                pass
-            continue
-
-        # -------------------------
-        # 2. USER IS ALREADY CHATTING → shouldn't be in queue
-        # -------------------------
-        state = get_user_state(user_id)
-        if state == "chatting":
-            remove_from_queue(user_id)
-            continue
-
-        # -------------------------
-        # 3. BROKEN PARTNER LINK (rare)
-        # -------------------------
-        partner = get_partner(user_id)
-        if partner and partner not in queue and state != "chatting":
-            remove_from_queue(user_id)
-            continue
+    await save_queue()      # snapshot must be current before sweeping
+    stale = await sweep_queue()
+    if not stale:
+        return
+
+    for user_id, _ in stale:
+        drop_queued(user_id)
+    await save_queue()
+
+
+async def evict_inactive(bot, user_ids):
+    """
+    presence.expire_loop() callback on the matcher leader: user_ids have
+    not been seen for INACTIVE_TIMEOUT seconds.
+    """
+    user_ids = [u for u in user_ids if u in match_queue]
+    if REDIS_URL and user_ids:
+        # their updates may have gone to another worker, whose flushes
+        # land in users.last_active: re-arm whoever was active there
+        cutoff = time.time() - INACTIVE_TIMEOUT
+        seen = await get_last_active_many(user_ids)
+        for user_id in user_ids:
+            if (seen.get(user_id) or 0) > cutoff:
+                presence.watch(user_id, INACTIVE_TIMEOUT, since=seen[user_id])
+        user_ids = [u for u in user_ids if (seen.get(u) or 0) <= cutoff]
+    if not user_ids:
+        return
+
+    for user_id in user_ids:
+        drop_queued(user_id)
+    await save_queue()
+
+    await asyncio.gather(*(
+        outbox.send(bot.send_message, user_id, text=INACTIVE_TEXT)
+        for user_id in user_ids
+    ))
@@ -0,0 +1,57 @@
+# recent_partners.py — who each user talked to lately, for the matcher
+#
+# Every user has a small ring of their last `size` partners, each entry
+# valid for `ttl` seconds. The matcher skips ring members when picking a
+# partner (MatchQueue.pop_pairs), so /next does not land on the same
+# person again. A lookup is one dict get; expired entries are dropped in
+# time order by prune(), O(expired).
+
+from collections import deque
+from time import time
+
+from config import RECENT_PARTNERS, RECENT_PARTNER_TTL
+
+
+class RecentPartners:
+    def __init__(self, size=RECENT_PARTNERS, ttl=RECENT_PARTNER_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._rings = {}        # user_id -> {partner_id: expires_at}, oldest first
+        self._expiry = deque()  # (expires_at, user_id), oldest first
+
+    def __len__(self):
+        return len(self._rings)
+
+    def add(self, user1, user2, now=None):
+        expires = (time() if now is None else now) + self.ttl
+        self._remember(user1, user2, expires)
+        self._remember(user2, user1, expires)
+
+    def _remember(self, user_id, partner_id, expires):
+        ring = self._rings.setdefault(user_id, {})
+        ring.pop(partner_id, None)          # re-insert: ring order stays by expiry
+        ring[partner_id] = expires
+        if len(ring) > self.size:
+            del ring[next(iter(ring))]
+        self._expiry.append((expires, user_id))
+
+    def of(self, user_id):
+        """
+        The user's recent partners (a dict: `partner in ...` is the check).
+        Call prune() first for an exact answer.
+        """
+        return self._rings.get(user_id) or {}
+
+    def prune(self, now=None):
+        now = time() if now is None else now
+        while self._expiry and self._expiry[0][0] <= now:
+            _, user_id = self._expiry.popleft()
+            ring = self._rings.get(user_id)
+            while ring and next(iter(ring.values())) <= now:
+                del ring[next(iter(ring))]
+            if ring == {}:
+                del self._rings[user_id]
+
+    def clear(self):
+        self._rings = {}
+        self._expiry = deque()
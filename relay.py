@@ -0,0 +1,99 @@
+# relay.py — forwards any message type to the chat partner
+#
+# Nothing is downloaded: single messages go through copy_message (Telegram
+# copies server-side, no "forwarded from" header), albums are re-sent as
+# one send_media_group built from the original file_ids. Everything is
+# queued on the outbox relay lane.
+
+import asyncio
+import logging
+
+from outbox import outbox, RELAY
+from telegram import (
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+)
+
+log = logging.getLogger(__name__)
+
+ALBUM_WINDOW = 0.5      # seconds to collect the parts of one media group
+
+_albums = {}            # (chat_id, media_group_id) -> [Message]
+_album_tasks = set()    # pending album sends (the loop only keeps weak refs)
+
+
+async def relay_message(bot, partner, message):
+    if message.media_group_id:
+        _collect_album(bot, partner, message)
+        return
+
+    await outbox.send(
+        bot.copy_message,
+        partner,
+        lane=RELAY,
+        from_chat_id=message.chat_id,
+        message_id=message.message_id,
+    )
+
+
+# ---------------------------------------------------------
+# Albums
+# ---------------------------------------------------------
+
+def _collect_album(bot, partner, message):
+    # Album parts arrive as separate updates. The first one schedules the
+    # send; the handler itself never waits, so later parts are not blocked.
+    key = (message.chat_id, message.media_group_id)
+    parts = _albums.get(key)
+    if parts is not None:
+        parts.append(message)
+        return
+
+    _albums[key] = [message]
+    task = asyncio.create_task(_send_album_later(bot, partner, key))
+    _album_tasks.add(task)
+    task.add_done_callback(_album_sent)
+
+
+def _album_sent(task):
+    _album_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("album relay failed", exc_info=task.exception())
+
+
+async def _send_album_later(bot, partner, key):
+    await asyncio.sleep(ALBUM_WINDOW)
+    parts = sorted(_albums.pop(key), key=lambda m: m.message_id)
+
+    media = [_input_media(m) for m in parts]
+    if all(media):
+        await outbox.send(bot.send_media_group, partner, lane=RELAY, media=media)
+        return
+
+    # unknown album content — fall back to copying part by part
+    for m in parts:
+        await outbox.send(
+            bot.copy_message,
+            partner,
+            lane=RELAY,
+            from_chat_id=m.chat_id,
+            message_id=m.message_id,
+        )
+
+
+def _input_media(message):
+    caption = {
+        "caption": message.caption,
+        "caption_entities": message.caption_entities,
+    }
+    if message.photo:
+        return InputMediaPhoto(message.photo[-1].file_id, **caption)
+    if message.video:
+        return InputMediaVideo(message.video.file_id, **caption)
+    if message.document:
+        return InputMediaDocument(message.document.file_id, **caption)
+    if message.audio:
+        return InputMediaAudio(message.audio.file_id, **caption)
+    return None
@@ -0,0 +1,50 @@
+# scheduling.py — who gets a partner first when partners are scarce
+#
+# MatchQueue keeps each tier (queue priority) in its own FIFO and, at
+# every pick, asks the policy to score the oldest searcher of each tier:
+# the highest score goes first. Scores only grow while someone waits, so
+# a tier's oldest member is always its best, and a few comparisons per
+# pick are all it costs.
+#
+# FairShare (the default) scores weight × seconds waited:
+#   - aging: everyone's rank grows with their wait, so nobody sits
+#     behind a steady flow of newcomers forever
+#   - weighted fair share: under load, waits settle in inverse
+#     proportion to the weights — with TIER_WEIGHTS a VIP waits about a
+#     quarter of what a free user waits, instead of free users waiting
+#     for as long as VIPs keep coming
+#   - hard max wait: searchers queued for max_wait seconds or more pick a
+#     partner before anyone who is not (MatchQueue.pop_pairs). When
+#     partners run short for longer than that, the cap holds for nobody
+#     and higher tiers drift towards max_wait too — simulate.py shows how
+#     far
+#
+# StrictPriority is the old order (priority DESC, timestamp ASC), kept so
+# simulate.py can compare the two.
+
+TIER_WEIGHTS = {0: 1, 5: 2, 10: 4}      # queue priority -> weight
+HEAD_START = 1.0                        # seconds, so fresh arrivals still rank by tier
+
+
+class StrictPriority:
+    max_wait = None
+
+    def score(self, priority, waited):
+        return (priority, waited)
+
+
+class FairShare:
+    def __init__(self, max_wait=None, weights=TIER_WEIGHTS):
+        self.max_wait = max_wait
+        self.weights = dict(weights)
+
+    def weight(self, priority):
+        # unknown priorities count as the highest tier below them
+        weight = self.weights.get(priority)
+        if weight is None:
+            lower = [p for p in self.weights if p <= priority]
+            weight = self.weights[priority] = self.weights[max(lower)] if lower else 1
+        return weight
+
+    def score(self, priority, waited):
+        return self.weight(priority) * (waited + HEAD_START)
@@ -0,0 +1,49 @@
+# session_cache.py — in-memory user → (state, partner) map for the chat relay
+#
+# Write-through: matchmaking updates it in the same step as the DB write,
+# so chat_forward never has to touch SQLite. Rebuilt from the users
+# table on startup; anything missing is read once and then cached.
+# With several workers lookups go to the shared copy in coordination.py
+# instead (see matchmaking.lookup_session).
+
+import metrics
+
+_sessions = {}      # user_id -> (state, partner_id)
+_hits = metrics.session_cache_hits
+_misses = metrics.session_cache_misses
+
+
+def load(rows):
+    """
+    rows: [(user_id, state, partner_id)] from database.load_sessions()
+    """
+    _sessions.clear()
+    for user_id, state, partner in rows:
+        _sessions[user_id] = (state, partner)
+
+
+def get(user_id):
+    """
+    Returns (state, partner_id), or None on a miss.
+    """
+    session = _sessions.get(user_id)
+    if session is None:
+        _misses.inc()
+    else:
+        _hits.inc()
+    return session
+
+
+def put(user_id, state, partner=None):
+    _sessions[user_id] = (state, partner)
+
+
+def stats():
+    hits, misses = _hits.value, _misses.value
+    total = hits + misses
+    return {
+        "size": len(_sessions),
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / total if total else 0.0,
+    }
@@ -0,0 +1,78 @@
+# session_log.py — chat session lifecycle: start, end, reason, messages
+#
+# Like events.py, the handlers only append to a write-behind buffer:
+# started() from matchmaker, message() per relayed message, ended() from
+# disconnect_users. flush_loop() folds the buffer in order — a session
+# that starts and ends within one batch never touches the DB twice, and
+# messages of sessions written earlier become one increment per user —
+# and hands the result to database.record_sessions(), which also keeps
+# the hourly rollups (see hourly_session_stats) in the same transaction.
+
+from time import time
+
+from async_database import record_sessions
+from write_behind import WriteBehind
+import metrics
+
+FLUSH_INTERVAL = 1.0        # seconds
+
+STARTED, MESSAGE, ENDED = range(3)
+
+
+async def _write(ops):
+    await record_sessions(*_fold(ops))
+
+
+_buffer = WriteBehind(_write, FLUSH_INTERVAL, "session ops", dropped=metrics.session_ops_dropped)
+_append = _buffer.append
+
+flush = _buffer.flush
+flush_loop = _buffer.flush_loop
+
+
+def started(user1, user2, wait1, wait2):
+    """
+    wait1/wait2: seconds each user spent in the queue.
+    """
+    _append((STARTED, user1, user2, time(), wait1, wait2))
+
+
+def message(user_id):
+    _append((MESSAGE, user_id))
+
+
+def ended(user_id, reason):
+    metrics.sessions_ended.labels(reason).inc()
+    _append((ENDED, user_id, time(), reason))
+
+
+def _fold(ops):
+    started_rows = []
+    fresh = {}          # user_id -> row in started_rows, while that session is open
+    messages = {}       # user_id -> count, sessions already in the DB
+    ended_rows = []
+
+    for op in ops:
+        kind, user_id = op[0], op[1]
+        if kind == MESSAGE:
+            row = fresh.get(user_id)
+            if row is None:
+                messages[user_id] = messages.get(user_id, 0) + 1
+            else:
+                row[7 if row[0] == user_id else 8] += 1
+        elif kind == STARTED:
+            _, user1, user2, started_at, wait1, wait2 = op
+            row = [user1, user2, started_at, wait1, wait2, None, None, 0, 0]
+            started_rows.append(row)
+            fresh[user1] = fresh[user2] = row
+        else:
+            _, _, ended_at, reason = op
+            row = fresh.pop(user_id, None)
+            if row is None:
+                ended_rows.append((user_id, ended_at, reason))
+            else:
+                row[5], row[6] = ended_at, reason
+                fresh.pop(row[1] if row[0] == user_id else row[0], None)
+
+    return started_rows, messages, ended_rows
+
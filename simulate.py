@@ -0,0 +1,158 @@
+# simulate.py — replays queue arrivals against the scheduling policies
+#
+# Usage:
+#   python simulate.py                          (synthetic evening peak)
+#   python simulate.py --minutes 30 --rate 20 --male-share 0.6 --save-trace peak.csv
+#   python simulate.py --trace peak.csv --max-wait 45
+#
+# Pushes every arrival into a real MatchQueue at its time, runs the
+# matcher every --tick seconds and reports the wait-time distribution per
+# tier (queue priority) for each policy in scheduling.py. Searchers give
+# up after --patience seconds, by default INACTIVE_TIMEOUT, when the bot
+# evicts them from the queue. Nothing touches the database.
+#
+# A trace is a CSV file with one arrival per line:
+#   time,user_id,priority,gender[,region]
+# (time in seconds from the start, gender male/female/empty).
+
+import argparse
+import csv
+import random
+import sys
+
+from config import INACTIVE_TIMEOUT, MAX_QUEUE_WAIT
+from match_queue import MatchQueue, Profile
+from scheduling import FairShare, StrictPriority
+
+TIERS = {0: "free", 5: "paid", 10: "vip"}
+
+
+def synthetic_trace(minutes, rate, vip_share, paid_share, male_share, peak=3.0, seed=1):
+    """
+    Poisson arrivals at `rate`/s, `peak` times that in the middle third,
+    when men are also male_share of the arrivals. Partners get scarce
+    for men during the peak, which is when the policy decides who waits.
+    """
+    rng = random.Random(seed)
+    length = minutes * 60
+    trace = []
+    t = 0.0
+    user_id = 0
+    while True:
+        busy = length / 3 <= t < 2 * length / 3
+        t += rng.expovariate(rate * (peak if busy else 1))
+        if t >= length:
+            return trace
+        roll = rng.random()
+        priority = 10 if roll < vip_share else 5 if roll < vip_share + paid_share else 0
+        gender = "male" if rng.random() < (male_share if busy else 0.5) else "female"
+        trace.append((t, user_id, priority, gender, None))
+        user_id += 1
+
+
+def load_trace(path):
+    with open(path, newline="") as f:
+        return [
+            (float(row[0]), int(row[1]), int(row[2]), row[3] or None, row[4] or None if len(row) > 4 else None)
+            for row in csv.reader(f) if row and not row[0].startswith("#")
+        ]
+
+
+def save_trace(trace, path):
+    with open(path, "w", newline="") as f:
+        csv.writer(f).writerows((round(t, 3), u, p, g or "", r or "") for t, u, p, g, r in trace)
+
+
+def replay(trace, policy, tick=1.0, patience=INACTIVE_TIMEOUT):
+    """
+    Returns {priority: {"waits": [...], "abandoned": n, "arrived": n}}.
+    """
+    queue = MatchQueue(policy)
+    joined = {}
+    tiers = {}
+    i = 0
+    t = 0.0
+    end = trace[-1][0] + patience + tick if trace else 0
+    while t <= end:
+        while i < len(trace) and trace[i][0] <= t:
+            at, user_id, priority, gender, region = trace[i]
+            queue.push(user_id, Profile(gender, region, None, None), priority, at)
+            joined[user_id] = (at, priority)
+            tiers.setdefault(priority, {"waits": [], "abandoned": 0, "arrived": 0})["arrived"] += 1
+            i += 1
+
+        for pair in queue.pop_pairs(now=t):
+            for user_id in pair:
+                at, priority = joined.pop(user_id)
+                tiers[priority]["waits"].append(t - at)
+
+        for user_id, (at, priority) in list(joined.items()):
+            if t - at >= patience:
+                queue.remove(user_id)
+                del joined[user_id]
+                tiers[priority]["abandoned"] += 1
+        t += tick
+    return tiers
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(name, tiers, max_wait):
+    print(f"{name:<12} {'tier':<5} {'arrived':>8} {'matched':>8} {'gave up':>8} "
+          f"{'p50':>6} {'p90':>6} {'p99':>6} {'max':>6} {'>max_wait':>10}")
+    for priority in sorted(tiers, reverse=True):
+        tier = tiers[priority]
+        waits = tier["waits"]
+        print(
+            f"{'':<12} {TIERS.get(priority, priority):<5} {tier['arrived']:>8} {len(waits):>8} "
+            f"{tier['abandoned']:>8} {_percentile(waits, 50):>6.1f} {_percentile(waits, 90):>6.1f} "
+            f"{_percentile(waits, 99):>6.1f} {max(waits, default=0):>6.1f} "
+            f"{sum(w > max_wait for w in waits):>10}"
+        )
+
+
+def policies(max_wait):
+    return {
+        "strict": StrictPriority(),
+        "fair": FairShare(max_wait=max_wait),
+        "fair, no cap": FairShare(),
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace", help="replay this CSV instead of a synthetic peak")
+    parser.add_argument("--save-trace", help="write the synthetic trace here")
+    parser.add_argument("--minutes", type=float, default=20, help="synthetic: trace length")
+    parser.add_argument("--rate", type=float, default=10, help="synthetic: arrivals/sec off-peak")
+    parser.add_argument("--vip-share", type=float, default=0.3)
+    parser.add_argument("--paid-share", type=float, default=0.1)
+    parser.add_argument("--male-share", type=float, default=0.52, help="synthetic: during the peak")
+    parser.add_argument("--max-wait", type=float, default=MAX_QUEUE_WAIT)
+    parser.add_argument("--tick", type=float, default=1.0, help="seconds between matcher runs")
+    parser.add_argument("--patience", type=float, default=INACTIVE_TIMEOUT, help="searchers give up after this")
+    args = parser.parse_args(argv)
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = synthetic_trace(args.minutes, args.rate, args.vip_share, args.paid_share, args.male_share)
+        if args.save_trace:
+            save_trace(trace, args.save_trace)
+    trace.sort()
+    print(f"{len(trace)} arrivals over {trace[-1][0] / 60 if trace else 0:.1f} min, "
+          f"max_wait {args.max_wait:g}s, patience {args.patience:g}s\n")
+
+    for name, policy in policies(args.max_wait).items():
+        report(name, replay(trace, policy, args.tick, args.patience), args.max_wait)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,28 @@
+# conftest.py — shared fixtures
+#
+# Tests import the bot's modules from the repository root and never touch
+# chatroulette.db: DB_PATH points into a temp dir before config is read,
+# and the `db` fixture gives each test a fresh database of its own.
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="chatroulette-test-"), "test.db")
+
+import database  # noqa: E402  (DB_PATH must be set first)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """
+    An empty, fully migrated database; yields its path.
+    """
+    database.close_db()
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    database.init_db()
+    yield database.DB_PATH
+    database.close_db()
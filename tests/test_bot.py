@@ -0,0 +1,42 @@
+# test_bot.py — Bot API error metrics cover calls outside the outbox
+
+import asyncio
+import json
+
+import pytest
+from telegram import Bot
+from telegram.error import BadRequest, RetryAfter
+
+import metrics
+from bot import CountedRequest
+
+
+class FailingRequest(CountedRequest):
+    # answers every call with one fixed Bot API error, no network
+    def __init__(self, status, error):
+        super().__init__()
+        self.answer = (status, json.dumps({"ok": False, **error}).encode())
+
+    async def do_request(self, *args, **kwargs):
+        return self.answer
+
+
+def _call(request):
+    bot = Bot("123:abc", request=request)
+    return asyncio.run(bot.answer_callback_query("1", text="x"))
+
+
+def test_direct_call_errors_are_counted():
+    errors = metrics.telegram_errors.labels("BadRequest")
+    before = errors.value
+    with pytest.raises(BadRequest):
+        _call(FailingRequest(400, {"error_code": 400, "description": "Bad Request: query is too old"}))
+    assert errors.value == before + 1
+
+
+def test_direct_call_retry_after_is_counted():
+    before = metrics.telegram_retry_after.value
+    with pytest.raises(RetryAfter):
+        _call(FailingRequest(429, {"error_code": 429, "description": "Too Many Requests",
+                                   "parameters": {"retry_after": 3}}))
+    assert metrics.telegram_retry_after.value == before + 1
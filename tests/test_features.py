@@ -0,0 +1,31 @@
+# test_features.py — paid features that touch the queue
+
+import asyncio
+
+import database
+import features
+import matchmaking
+import session_cache
+
+
+def test_priority_queue_commits_searching_before_queueing(db, monkeypatch):
+    conn = database._connect()
+    conn.execute("INSERT INTO users (id, state, partner_id) VALUES (1, 'chatting', 7)")
+    conn.commit()
+    monkeypatch.setattr(features, "has_vip", lambda user_id: True)
+    monkeypatch.setattr(matchmaking, "_leader", False)
+    # a non-leader hands the push to the matcher leader; whatever the
+    # leader does with it must find the user searching already
+    pushed = []
+
+    async def push_event(event):
+        pushed.append((event["op"], event["priority"], database.get_user_state(1)))
+
+    monkeypatch.setattr(matchmaking.backend, "push_event", push_event)
+
+    result = asyncio.run(features.enter_priority_queue(1))
+
+    assert result == {"success": True, "priority": matchmaking.VIP_PRIORITY}
+    assert pushed[-1] == ("push", matchmaking.VIP_PRIORITY, "searching")
+    assert database.get_session(1) == ("searching", None)
+    assert session_cache.get(1) == ("searching", None)
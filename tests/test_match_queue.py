@@ -0,0 +1,62 @@
+# test_match_queue.py — MatchQueue pairs only mutually compatible users
+
+import random
+
+import pytest
+
+from match_queue import MatchQueue, Profile, compatible, normalize
+from scheduling import FairShare
+
+GENDERS = ("male", "female", None)
+REGIONS = ("ru", "ua", None)
+
+
+def _random_profile(rng):
+    return Profile(rng.choice(GENDERS), rng.choice(REGIONS), rng.choice(GENDERS), rng.choice(REGIONS))
+
+
+def test_profile_change_moves_user_out_of_old_buckets():
+    queue = MatchQueue()
+    queue.push(2, Profile("female", None, None, None), timestamp=99)
+    queue.push(1, Profile("male", None, None, None), timestamp=100)
+    queue.update_profile(1, Profile("female", None, None, None))
+
+    assert queue.pop_pairs(now=101) == []
+    assert 1 in queue and 2 in queue
+
+
+def test_profile_change_keeps_join_time():
+    queue = MatchQueue()
+    queue.push(1, Profile("male", None, None, None), timestamp=100)
+    queue.push(2, Profile("male", None, None, None), timestamp=200)
+    queue.update_profile(1, Profile("male", "ru", None, None))
+    queue.push(3, Profile("female", None, None, None), timestamp=300)
+
+    # the longest waiter still goes first
+    assert queue.pop_pairs(now=301) == [(1, 3)]
+
+
+@pytest.mark.parametrize("seed", range(2_000))
+def test_pairs_after_profile_changes_are_compatible(seed):
+    rng = random.Random(seed)
+    queue = MatchQueue(FairShare(max_wait=60))
+    profiles = {}
+    for user_id in range(8):
+        profiles[user_id] = _random_profile(rng)
+        queue.push(user_id, profiles[user_id], rng.choice((0, 5, 10)), timestamp=rng.randrange(100))
+    for user_id in rng.sample(range(8), 3):
+        profiles[user_id] = _random_profile(rng)
+        queue.update_profile(user_id, profiles[user_id])
+
+    pairs = queue.pop_pairs(now=rng.randrange(100, 200))
+
+    paired = [u for pair in pairs for u in pair]
+    assert len(paired) == len(set(paired))
+    for u1, u2 in pairs:
+        assert compatible(normalize(profiles[u1]), normalize(profiles[u2]))
+    leftovers = set(queue)
+    assert leftovers == set(profiles) - set(paired)
+    # maximal: no two leftovers could have been paired
+    for u1 in leftovers:
+        for u2 in leftovers - {u1}:
+            assert not compatible(normalize(profiles[u1]), normalize(profiles[u2]))
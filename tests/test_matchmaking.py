@@ -0,0 +1,50 @@
+# test_matchmaking.py — matcher ticks against a real (temp) database
+
+import asyncio
+
+import pytest
+
+import database
+import matchmaking
+from match_queue import ANYONE
+
+
+class SilentBot:
+    async def send_message(self, *args, **kwargs):
+        pass
+
+
+@pytest.fixture
+def leader(db):
+    matchmaking._reset_queue()
+    matchmaking._leader = True
+    yield matchmaking
+    matchmaking._leader = False
+    matchmaking._reset_queue()
+
+
+def _searching(*user_ids):
+    conn = database._connect()
+    conn.executemany("INSERT INTO users (id, state) VALUES (?, 'searching')", [(u,) for u in user_ids])
+    conn.commit()
+
+
+def test_failed_pair_survivor_keeps_priority_and_join_time(leader):
+    _searching(1, 2)
+    leader.match_queue.push(1, ANYONE, priority=5, timestamp=100)
+    leader.match_queue.push(2, ANYONE, priority=0, timestamp=110)
+    # user 2 stops searching between pop_pairs and link_pairs
+    real_link_pairs = leader.link_pairs
+
+    async def link_pairs(pairs):
+        database.update_user_state(2, "idle")
+        return await real_link_pairs(pairs)
+
+    leader.link_pairs = link_pairs
+    try:
+        asyncio.run(leader.matchmaker(SilentBot()))
+    finally:
+        leader.link_pairs = real_link_pairs
+
+    assert list(leader.match_queue) == [1]
+    assert [row[-2:] for row in database.load_queue()] == [(5, 100)]
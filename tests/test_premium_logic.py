@@ -0,0 +1,40 @@
+# test_premium_logic.py — the in-memory VIP cache
+
+import threading
+
+import premium_logic
+
+
+class GrantDuringMerge(dict):
+    # warm_vip_cache() merges the live dict into the fresh one; grant VIP
+    # from another thread once the merge has read it, before the swap
+    grant = None
+
+    def items(self):
+        yield from super().items()
+        self.grant = threading.Thread(target=premium_logic.grant_vip, args=(1, 7))
+        self.grant.start()
+        self.grant.join(0.2)    # with the lock it waits for the swap
+
+
+def test_grant_during_refresh_is_kept(db, monkeypatch):
+    live = GrantDuringMerge()
+    monkeypatch.setattr(premium_logic, "_vip_until", live)
+    monkeypatch.setattr(premium_logic, "_vip_warm", True)
+
+    premium_logic.warm_vip_cache()      # reads before the grant commits
+    live.grant.join()
+
+    assert premium_logic.has_vip(1)
+
+
+def test_refresh_picks_up_grants_from_other_workers(db, monkeypatch):
+    monkeypatch.setattr(premium_logic, "_vip_until", {})
+    monkeypatch.setattr(premium_logic, "_vip_warm", True)
+    premium_logic.grant_vip(1, 7)
+    premium_logic._vip_until.clear()    # granted elsewhere: not in this cache
+    assert not premium_logic.has_vip(1)
+
+    premium_logic.warm_vip_cache()
+
+    assert premium_logic.has_vip(1)
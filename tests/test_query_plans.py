@@ -0,0 +1,142 @@
+# test_query_plans.py — the hot queries must stay on their indexes
+#
+# A query that falls back to a table scan or a temp b-tree sort still
+# returns the right rows, just slower as the table grows; these tests
+# catch it from EXPLAIN QUERY PLAN on a small database.
+
+import random
+import sqlite3
+from time import time
+
+import pytest
+
+import database
+
+HOT_QUERIES = [
+    (
+        "get_queue order",
+        "SELECT user_id FROM queue ORDER BY priority DESC, timestamp ASC",
+        (),
+        "idx_queue_order",
+    ),
+    (
+        "inactive users",
+        "SELECT id FROM users WHERE last_active < ?",
+        (0,),
+        "idx_users_last_active",
+    ),
+    (
+        "user transaction history",
+        "SELECT amount, feature, timestamp FROM transactions WHERE user_id=? ORDER BY timestamp",
+        (1,),
+        "idx_transactions_user_time",
+    ),
+    (
+        "transactions by time range",
+        "SELECT user_id, amount FROM transactions WHERE timestamp >= ?",
+        (0,),
+        "idx_transactions_time",
+    ),
+    (
+        "open session of user1",
+        "UPDATE sessions SET messages1 = messages1 + 1 WHERE user1=? AND ended_at IS NULL",
+        (1,),
+        "idx_sessions_open_user1",
+    ),
+    (
+        "open session of user2",
+        "UPDATE sessions SET messages2 = messages2 + 1 WHERE user2=? AND ended_at IS NULL",
+        (1,),
+        "idx_sessions_open_user2",
+    ),
+    (
+        "hourly session rollups",
+        "SELECT hour, sessions FROM session_rollups WHERE hour >= ? ORDER BY hour",
+        (0,),
+        "PRIMARY KEY",
+    ),
+    (
+        "payment by charge id",
+        "SELECT 1 FROM transactions WHERE charge_id=?",
+        ("charge",),
+        "idx_transactions_charge",
+    ),
+    (
+        "ledger tail of a user",
+        "SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE user_id=? AND id > ?",
+        (1, 0),
+        "idx_transactions_user",
+    ),
+    (
+        "latest balance snapshot",
+        "SELECT txn_id, balance FROM balance_snapshots WHERE user_id=? ORDER BY txn_id DESC LIMIT 1",
+        (1,),
+        "PRIMARY KEY",
+    ),
+]
+
+
+
+@pytest.fixture
+def analyzed(db):
+    conn = database._connect()
+    conn.executemany(
+        "INSERT INTO users (id, gender, state, last_active) VALUES (?, ?, 'searching', ?)",
+        [(u, random.choice(("male", "female", None)), int(time())) for u in range(1_000)]
+    )
+    conn.commit()
+    conn.execute("ANALYZE")
+    return conn
+
+
+@pytest.mark.parametrize("sql, args, index", [q[1:] for q in HOT_QUERIES], ids=[q[0] for q in HOT_QUERIES])
+def test_hot_query_uses_index(analyzed, sql, args, index):
+    plan = " | ".join(row[3] for row in analyzed.execute("EXPLAIN QUERY PLAN " + sql, args))
+    assert index in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_migrations_reach_latest_version(db):
+    assert database.schema_version() == len(database.MIGRATIONS)
+
+
+def test_migrations_rerun_is_a_no_op(db):
+    database.init_db()
+    assert database.schema_version() == len(database.MIGRATIONS)
+
+
+# the tables as the first release created them, before any migration
+V0_SCHEMA = (
+    "CREATE TABLE users (id INTEGER PRIMARY KEY, gender TEXT, region TEXT, state TEXT,"
+    " partner_id INTEGER, stars INTEGER DEFAULT 0, vip INTEGER DEFAULT 0, last_active INTEGER)",
+    "CREATE TABLE queue (user_id INTEGER PRIMARY KEY, priority INTEGER DEFAULT 0, timestamp INTEGER)",
+    "CREATE TABLE premium (user_id INTEGER PRIMARY KEY, vip_until INTEGER)",
+    "CREATE TABLE sessions (session_id INTEGER PRIMARY KEY AUTOINCREMENT, user1 INTEGER,"
+    " user2 INTEGER, started_at INTEGER)",
+    "CREATE TABLE transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,"
+    " amount INTEGER, feature TEXT, timestamp INTEGER)",
+)
+
+
+def test_upgrades_existing_database_in_place(tmp_path, monkeypatch):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    for sql in V0_SCHEMA:
+        conn.execute(sql)
+    conn.execute("INSERT INTO users (id, gender, stars) VALUES (1, 'male', 7)")
+    conn.execute("INSERT INTO queue (user_id, priority, timestamp) VALUES (1, 0, 100)")
+    conn.commit()
+    conn.close()
+
+    database.close_db()
+    monkeypatch.setattr(database, "DB_PATH", path)
+    try:
+        database.init_db()
+        conn = database._connect()
+        assert database.schema_version() == len(database.MIGRATIONS)
+        assert conn.execute("SELECT gender, stars, want_gender FROM users WHERE id=1").fetchone() == ("male", 7, None)
+        assert conn.execute("SELECT user_id FROM queue").fetchall() == [(1,)]
+        indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+        assert {q[3] for q in HOT_QUERIES} - {"PRIMARY KEY"} <= indexes
+    finally:
+        database.close_db()
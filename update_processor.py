@@ -0,0 +1,66 @@
+# update_processor.py — concurrent update handling, in order per user
+#
+# PTB's stock concurrent_updates(N) runs any N updates at once, so a
+# user's /next and the message sent right after it can overtake each
+# other. Here every user gets a FIFO of pending handler coroutines that
+# one task drains; different users still run in parallel, up to N of
+# them at a time. One user's slow send_invoice or disconnect only holds
+# up that user.
+
+import logging
+from collections import deque
+
+from telegram.ext import BaseUpdateProcessor
+
+log = logging.getLogger(__name__)
+
+
+def update_owner(update):
+    """
+    Whose order an update belongs to: the sender, else the chat,
+    else None (no ordering needed).
+    """
+    user = getattr(update, "effective_user", None)
+    if user:
+        return user.id
+    chat = getattr(update, "effective_chat", None)
+    return chat.id if chat else None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    __slots__ = ("_pending",)
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._pending = {}      # owner -> deque of coroutines waiting their turn
+
+    async def do_process_update(self, update, coroutine):
+        owner = update_owner(update)
+        if owner is None:
+            await coroutine
+            return
+
+        pending = self._pending.get(owner)
+        if pending is not None:
+            # an earlier update of this user is running; its task runs this
+            # one next, and our concurrency slot is free again right away
+            pending.append(coroutine)
+            return
+
+        pending = self._pending[owner] = deque([coroutine])
+        try:
+            while pending:
+                try:
+                    await pending.popleft()
+                except Exception:
+                    log.exception("update of %s failed", owner)
+        finally:
+            del self._pending[owner]
+            for leftover in pending:        # only if we were cancelled
+                leftover.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
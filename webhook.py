@@ -0,0 +1,100 @@
+# webhook.py — aiohttp ingress for webhook mode
+#
+# Telegram POSTs every update to WEBHOOK_URL + WEBHOOK_PATH. The request
+# handler only checks the secret header, parses the update and puts it on
+# the application's update queue, so Telegram gets its 200 right away
+# and a slow handler never holds up the next delivery. How many updates
+# run at once is up to the Application (see bot.build_application).
+
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import signal
+
+from aiohttp import web
+from telegram import Update
+
+log = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+MAX_CONNECTIONS = 100       # parallel deliveries Telegram may open
+
+
+def default_secret(token):
+    """
+    Stable across restarts and workers, unguessable without the token.
+    """
+    return hashlib.sha256(f"webhook:{token}".encode()).hexdigest()
+
+
+def make_web_app(application, secret, path):
+    expected = secret.encode()
+
+    async def receive(request):
+        given = request.headers.get(SECRET_HEADER, "").encode()
+        if not hmac.compare_digest(given, expected):
+            return web.Response(status=403)
+        try:
+            data = await request.json(loads=json.loads)
+        except ValueError:
+            return web.Response(status=400)
+
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    return app
+
+
+async def start_webhook(application, secret, path, listen="0.0.0.0", port=8080, url=None):
+    """
+    Starts serving; registers `url + path` with Telegram when url is given.
+    Returns the aiohttp runner — await runner.cleanup() to stop.
+    """
+    runner = web.AppRunner(make_web_app(application, secret, path), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, listen, port).start()
+
+    if url:
+        await application.bot.set_webhook(
+            url.rstrip("/") + path,
+            secret_token=secret,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=MAX_CONNECTIONS,
+        )
+    log.info("webhook listening on %s:%s%s", listen, port, path)
+    return runner
+
+
+def run_webhook(application, url, secret, path, listen="0.0.0.0", port=8080):
+    """
+    Blocking entry point, the webhook twin of Application.run_polling().
+    """
+    asyncio.run(_serve(application, url, secret, path, listen, port))
+
+
+async def _serve(application, url, secret, path, listen, port):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    runner = await start_webhook(application, secret, path, listen, port, url)
+
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,118 @@
+# write_behind.py — in-memory buffers that reach the DB in batches
+#
+# Handlers add to a buffer and return: no commit on the hot path. The
+# buffer's flush_loop() hands everything pending to one write call every
+# `interval` seconds, or as soon as `batch` items are waiting. flush() on
+# shutdown writes whatever is left.
+#
+# WriteBehind     — a bounded list of items in arrival order (events.py,
+#                   session_log.py). Past `size` the oldest are dropped
+#                   and counted, so memory stays bounded when the writer
+#                   falls behind; a failed batch is dropped and counted.
+# KeyedWriteBehind — the latest value per key (presence.py). A failed
+#                   batch goes back into the buffer, under any newer value.
+
+import asyncio
+import logging
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+BUFFER_SIZE = 100_000
+FLUSH_BATCH = 1_000
+
+
+class WriteBehind:
+    """
+    write: async callable taking the list of pending items.
+    dropped / written: optional metrics counters.
+    """
+
+    def __init__(self, write, interval, what, batch=FLUSH_BATCH, size=BUFFER_SIZE,
+                 dropped=None, written=None):
+        self._write = write
+        self.interval = interval
+        self.what = what            # for the log: "lost 12 <what>"
+        self.batch = batch
+        self._dropped = dropped
+        self._written = written
+        self._ready = asyncio.Event()
+        self.pending = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def append(self, item):
+        if len(self.pending) == self.pending.maxlen and self._dropped:
+            self._dropped.inc()
+        self.pending.append(item)
+        self._added()
+
+    def clear(self):
+        self.pending.clear()
+
+    def _added(self):
+        if self.batch and len(self.pending) >= self.batch:
+            self._ready.set()
+
+    def _take(self):
+        items = list(self.pending)
+        self.pending.clear()
+        return items
+
+    def _lost(self, items):
+        if self._dropped:
+            self._dropped.inc(len(items))
+
+    async def flush(self):
+        """
+        Writes everything pending. Returns the number of items written.
+        """
+        if not self.pending:
+            return 0
+        items = self._take()
+        try:
+            # shielded: a cancelled flush_loop must not cancel the write itself
+            await asyncio.shield(self._write(items))
+        except Exception:
+            log.exception("lost %d %s", len(items), self.what)
+            self._lost(items)
+            return 0
+        if self._written:
+            self._written.inc(len(items))
+        return len(items)
+
+    async def flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._ready.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._ready.clear()
+            await self.flush()
+
+
+class KeyedWriteBehind(WriteBehind):
+    """
+    write: async callable taking {key: value}.
+    """
+
+    def __init__(self, write, interval, what, batch=None, **kwargs):
+        super().__init__(write, interval, what, batch=batch, **kwargs)
+        self.pending = {}
+
+    def put(self, key, value):
+        self.pending[key] = value
+        self._added()
+
+    def __contains__(self, key):
+        return key in self.pending
+
+    def _take(self):
+        items, self.pending = self.pending, {}
+        return items
+
+    def _lost(self, items):
+        # back in line for the next flush, unless a newer value arrived
+        for key, value in items.items():
+            self.pending.setdefault(key, value)